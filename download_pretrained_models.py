@@ -1,4 +1,8 @@
-from huggingface_hub import hf_hub_download
+import os
+
+from huggingface_hub import snapshot_download
+
+from emulator.src.utils.model_registry import ModelRegistry
 
 
 # Path of the directory where the checkpoints will be downloaded in your local machine
@@ -11,4 +15,5 @@ repo_id = "climateset/causalpaca_models"
 repo_type = "model"
 snapshot_download(repo_id=repo_id, repo_type=repo_type, local_dir=local_directory, local_dir_use_symlinks=False)
 
-
+# index the downloaded runs, so that they can be reloaded by run id without the wandb API
+ModelRegistry(local_directory).scan()
@@ -0,0 +1,144 @@
+"""
+Helpers shared by the benchmark scripts: run metadata, summary statistics, JSON reports and the comparison of two
+reports. A report is a dict {"meta": {...}, "results": {benchmark name: {metric: value}}}.
+
+Metrics are compared by the suffix of their name: "*_per_sec" is better when higher, "*_ms", "*_s" and "*_mb" are
+better when lower. All other metrics (sizes, counts, ...) are reported but never flagged.
+"""
+
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import torch
+
+HIGHER_IS_BETTER_SUFFIXES = ("_per_sec",)
+LOWER_IS_BETTER_SUFFIXES = ("_ms", "_s", "_mb")
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return (
+            subprocess.check_output(
+                ["git", "rev-parse", "--short", "HEAD"],
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                stderr=subprocess.DEVNULL,
+            )
+            .decode()
+            .strip()
+        )
+    except (subprocess.CalledProcessError, OSError):
+        return None
+
+
+def get_meta(**kwargs) -> dict:
+    """Metadata of a benchmark run, kwargs (e.g. the benchmark arguments) are added as they are."""
+    meta = {
+        "commit": git_commit(),
+        "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "host": platform.node(),
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "num_threads": torch.get_num_threads(),
+        "cuda": torch.cuda.get_device_name(0) if torch.cuda.is_available() else None,
+    }
+    meta.update(kwargs)
+    return meta
+
+
+def peak_rss_mb() -> float:
+    """Peak resident set size of this process in MB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macOS
+    return peak / 1024**2 if sys.platform == "darwin" else peak / 1024
+
+
+def peak_device_mem_mb() -> Optional[float]:
+    """Peak allocated CUDA memory in MB since the last reset, None without CUDA."""
+    if not torch.cuda.is_available():
+        return None
+    return torch.cuda.max_memory_allocated() / 1024**2
+
+
+def latency_stats(seconds: Sequence[float], prefix: str = "latency") -> Dict[str, float]:
+    """Mean and percentiles of a list of durations, in milliseconds."""
+    ms = np.asarray(seconds, dtype=np.float64) * 1e3
+    if len(ms) == 0:
+        return {}
+    return {
+        f"{prefix}_mean_ms": float(ms.mean()),
+        f"{prefix}_p50_ms": float(np.percentile(ms, 50)),
+        f"{prefix}_p90_ms": float(np.percentile(ms, 90)),
+        f"{prefix}_p99_ms": float(np.percentile(ms, 99)),
+        f"{prefix}_max_ms": float(ms.max()),
+    }
+
+
+def save_report(path: str, meta: dict, results: Dict[str, dict]):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "w") as f:
+        json.dump({"meta": meta, "results": results}, f, indent=2)
+    print(f"Wrote {path}")
+
+
+def load_report(path: str) -> dict:
+    with open(path) as f:
+        return json.load(f)
+
+
+def metric_direction(metric: str) -> int:
+    """1 if higher is better, -1 if lower is better, 0 if the metric is not compared."""
+    if metric.endswith(HIGHER_IS_BETTER_SUFFIXES):
+        return 1
+    if metric.endswith(LOWER_IS_BETTER_SUFFIXES):
+        return -1
+    return 0
+
+
+def compare_reports(
+    baseline: dict, current: dict, tolerance: float = 0.1
+) -> Tuple[List[Tuple[str, str, float, float, float, bool]], List[str]]:
+    """
+    Compare the metrics of two reports.
+
+    Args:
+        baseline (dict): Report of the reference commit.
+        current (dict): Report to check.
+        tolerance (float): Relative change in the bad direction that is still accepted, e.g. 0.1 for 10%.
+
+    Returns:
+        list: (benchmark, metric, baseline, current, relative change, is regression) for every compared metric.
+        list: Benchmarks that are only in one of the reports.
+    """
+    rows = []
+    base_results, cur_results = baseline["results"], current["results"]
+    missing = sorted(set(base_results) ^ set(cur_results))
+    for name in sorted(set(base_results) & set(cur_results)):
+        for metric, base_value in base_results[name].items():
+            cur_value = cur_results[name].get(metric)
+            direction = metric_direction(metric)
+            if direction == 0 or base_value is None or cur_value is None or base_value == 0:
+                continue
+            change = (cur_value - base_value) / abs(base_value)
+            rows.append((name, metric, base_value, cur_value, change, -direction * change > tolerance))
+    return rows, missing
+
+
+def print_comparison(baseline: dict, current: dict, tolerance: float = 0.1) -> bool:
+    """Print the comparison of two reports, returns True if any metric regressed by more than the tolerance."""
+    rows, missing = compare_reports(baseline, current, tolerance)
+    print(f"Baseline: {baseline['meta'].get('commit')}  Current: {current['meta'].get('commit')}  Tolerance: {tolerance:.0%}")
+    for name, metric, base_value, cur_value, change, regressed in rows:
+        flag = "REGRESSION" if regressed else ""
+        print(f"{name:<30} {metric:<28} {base_value:>12.3f} {cur_value:>12.3f} {change:>+8.1%} {flag}")
+    for name in missing:
+        print(f"{name:<30} only in one of the reports")
+    regressions = [row for row in rows if row[-1]]
+    print(f"{len(regressions)} regression(s) in {len(rows)} compared metrics.")
+    return len(regressions) > 0
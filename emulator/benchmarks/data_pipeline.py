@@ -0,0 +1,326 @@
+"""
+Microbenchmarks of the super emulation data pipeline on a synthetic ClimateSet tree.
+
+The synthetic tree has the layout of the real data (outputs/CMIP6/<model>/<member>/<scenario>/<var>/250_km/mon/<year>
+and inputs/input4mips/<scenario>/<var>/250_km/mon/<year>) on the 96x144 grid, filled with random monthly data.
+For every point of the sweep over the number of climate models, ensemble members and years, this times:
+
+    - setup: building the StateManager and training dataset from the NetCDF files (SuperClimateDataModule)
+    - load_into_mem, get_mean_std, normalize_data and _reload_data on a single (model, member) block
+    - index resolution: StateManager.increment_cmip6_index over all indices
+    - getitem: SuperClimateDataset.__getitem__ over all training samples
+    - dataloader: iterating a DataLoader over the training set, including collation
+
+Each axis is swept with the other two at their first value, so the report holds one throughput curve per axis.
+
+Run from the root of the repository:
+
+    python -m emulator.benchmarks.data_pipeline run --models 1 2 4 --members 1 2 --years 1 2 4 --out bench/data_new.json
+    python -m emulator.benchmarks.data_pipeline compare bench/data_old.json bench/data_new.json
+    python -m emulator.benchmarks.data_pipeline generate /tmp/synthetic_climateset --models 2 --members 2 --years 3
+"""
+
+import argparse
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, List, Sequence
+
+import numpy as np
+import xarray as xr
+from torch.utils.data import DataLoader
+
+from emulator.benchmarks.common import get_meta, load_report, peak_rss_mb, print_comparison, save_report
+from emulator.src.data.constants import CMIP6_NOM_RES, CMIP6_TEMP_RES, LAT, LON, NO_OPENBURNING_VARS, SEQ_LEN
+from emulator.src.utils.utils import get_logger
+
+log = get_logger()
+
+# real model names, so that the openburning specs are resolved as for the real data
+SYNTHETIC_MODELS = [
+    "NorESM2-LM",
+    "GFDL-ESM4",
+    "MPI-ESM1-2-HR",
+    "EC-Earth3",
+    "TaiESM1",
+    "CESM2",
+    "AWI-CM-1-1-MR",
+    "BCC-CSM2-MR",
+]
+OPENBURNING_TYPES = ["no-fires", "anthro-fires", "all-fires"]
+SCENARIO = "ssp126"
+HISTORICAL_YEAR = 1850
+FIRST_YEAR = 2015
+
+
+def write_year(var_dir: str, var: str, fname: str, rng: np.random.Generator, offset: float = 0.0):
+    """Write one year of random monthly data of a variable on the 96x144 grid."""
+    os.makedirs(var_dir, exist_ok=True)
+    data = rng.standard_normal((SEQ_LEN, LON, LAT), dtype=np.float32) + offset
+    ds = xr.Dataset({var: (("time", "lon", "lat"), data)}, coords={"time": np.arange(SEQ_LEN)})
+    ds.to_netcdf(os.path.join(var_dir, fname))
+
+
+def generate_tree(
+    root: str,
+    num_models: int,
+    num_members: int,
+    num_years: int,
+    out_vars: Sequence[str] = ("pr", "tas"),
+    in_vars: Sequence[str] = ("BC_sum", "CO2_sum", "SO2_sum", "CH4_sum"),
+    seed: int = 0,
+) -> List[str]:
+    """
+    Generate a synthetic ClimateSet tree with the SSP126 scenario and a single historical year.
+
+    Args:
+        root (str): Directory to write the tree into.
+        num_models (int): Number of climate models (at most len(SYNTHETIC_MODELS)).
+        num_members (int): Number of ensemble members per climate model.
+        num_years (int): Number of SSP years, starting with 2015.
+        out_vars (list): CMIP6 output variables.
+        in_vars (list): Input4MIPs input variables.
+        seed (int): Seed of the random data.
+
+    Returns:
+        list: The climate models of the tree.
+    """
+    if num_models > len(SYNTHETIC_MODELS):
+        raise ValueError(f"At most {len(SYNTHETIC_MODELS)} synthetic climate models are supported.")
+    rng = np.random.default_rng(seed)
+    climate_models = SYNTHETIC_MODELS[:num_models]
+    years = {SCENARIO: range(FIRST_YEAR, FIRST_YEAR + num_years), "historical": [HISTORICAL_YEAR]}
+
+    for i, climate_model in enumerate(climate_models):
+        for member in range(num_members):
+            for scenario, scenario_years in years.items():
+                for var in out_vars:
+                    for year in scenario_years:
+                        var_dir = os.path.join(
+                            root, "outputs/CMIP6", climate_model, f"r{member + 1}i1p1f1", scenario, var,
+                            CMIP6_NOM_RES, CMIP6_TEMP_RES, str(year),
+                        )
+                        write_year(var_dir, var, f"{var}_{year}.nc", rng, offset=i)
+
+    for scenario, scenario_years in years.items():
+        for var in in_vars:
+            # variables without openburning types only have a single file per year
+            openburning_types = [""] if var in NO_OPENBURNING_VARS else OPENBURNING_TYPES
+            for year in scenario_years:
+                var_dir = os.path.join(
+                    root, "inputs/input4mips", scenario, var, CMIP6_NOM_RES, CMIP6_TEMP_RES, str(year)
+                )
+                for openburning in openburning_types:
+                    write_year(var_dir, var, f"{var}_{openburning}_{year}.nc".replace("__", "_"), rng)
+    return climate_models
+
+
+def time_repeated(fn: Callable, repeats: int) -> float:
+    """Median wall time of fn in seconds."""
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def benchmark_point(data_dir: str, num_models: int, num_members: int, num_years: int, args: argparse.Namespace) -> Dict:
+    """Run all microbenchmarks for one point of the sweep."""
+    from emulator.src.datamodules.super_climate_datamodule import SuperClimateDataModule
+
+    output_save_dir = tempfile.mkdtemp(prefix="data_pipeline_bench_")
+    try:
+        kwargs = dict(
+            in_var_ids=list(args.in_vars),
+            out_var_ids=list(args.out_vars),
+            train_years=f"{FIRST_YEAR}-{FIRST_YEAR + num_years - 1}",
+            train_historical_years=f"{HISTORICAL_YEAR}-{HISTORICAL_YEAR}",
+            train_scenarios=[SCENARIO],
+            train_models=SYNTHETIC_MODELS[:num_models],
+            num_ensembles=num_members,
+            channels_last=args.channels_last,
+            val_split=0.1,
+            batch_size=args.batch_size,
+            data_dir=data_dir,
+            output_save_dir=output_save_dir,
+            use_block_cache=args.block_cache,
+        )
+        start = time.perf_counter()
+        datamodule = SuperClimateDataModule(**kwargs)
+        setup_s = time.perf_counter() - start
+
+        index_manager = datamodule.index_manager
+        block = index_manager.cmip6_ds_model[0][0]
+        block_mb = block.Data.nbytes / 1024**2
+        total_mb = sum(member.Data.nbytes for model in index_manager.cmip6_ds_model for member in model) / 1024**2
+        total_mb += sum(ds.Data.nbytes for ds in index_manager.input4mips_ds.values()) / 1024**2
+
+        # single block: reading, statistics, normalization and reloading of the cached npz file
+        years = range(FIRST_YEAR, FIRST_YEAR + num_years)
+        files_per_var = [[f for y in years for f in block.get_nc_files(SCENARIO, var, y)] for var in args.out_vars]
+        load_s = time_repeated(
+            lambda: block.load_into_mem(files_per_var, num_vars=len(args.out_vars), channels_last=args.channels_last),
+            args.repeats,
+        )
+        raw_data = block.load_into_mem(files_per_var, num_vars=len(args.out_vars), channels_last=args.channels_last)
+        mean_std_s = time_repeated(lambda: block.get_mean_std(raw_data), args.repeats)
+        mean, std = block.get_mean_std(raw_data)
+        normalize_s = time_repeated(lambda: block.normalize_data(raw_data, {"mean": mean, "std": std}), args.repeats)
+        npz_path = block.save_data_into_disk(raw_data, "reload_bench.npz", output_save_dir)
+        reload_s = time_repeated(lambda: block._reload_data(npz_path), args.repeats)
+
+        # index resolution and fetching over the whole training set
+        total_length = int(index_manager.total_length)
+
+        def resolve_indices():
+            for index in range(total_length):
+                index_manager.increment_cmip6_index(index)
+
+        index_s = time_repeated(resolve_indices, args.repeats)
+
+        dataset = datamodule._data_train
+        dataset.set_mode(train=True, indexes=index_manager.train_indexes, reset_index=index_manager.reset_train_index)
+        num_samples = len(dataset)
+
+        def get_items():
+            for index in range(num_samples):
+                dataset[index]
+
+        getitem_s = time_repeated(get_items, args.repeats)
+
+        dataloader = DataLoader(dataset, batch_size=args.batch_size, num_workers=args.num_workers)
+
+        def iterate():
+            for _ in dataloader:
+                pass
+
+        dataloader_s = time_repeated(iterate, args.repeats)
+    finally:
+        shutil.rmtree(output_save_dir, ignore_errors=True)
+
+    return {
+        "num_models": num_models,
+        "num_members": num_members,
+        "num_years": num_years,
+        "num_samples": total_length,
+        "data_megabytes": total_mb,
+        "setup_s": setup_s,
+        "setup_megabytes_per_sec": total_mb / setup_s,
+        "load_into_mem_megabytes_per_sec": block_mb / load_s,
+        "get_mean_std_megabytes_per_sec": block_mb / mean_std_s,
+        "normalize_data_megabytes_per_sec": block_mb / normalize_s,
+        "reload_data_megabytes_per_sec": block_mb / reload_s,
+        "index_lookups_per_sec": total_length / index_s,
+        "getitem_samples_per_sec": num_samples / getitem_s,
+        "dataloader_samples_per_sec": num_samples / dataloader_s,
+    }
+
+
+
+def sweep_points(args: argparse.Namespace) -> List[tuple]:
+    """Points (models, members, years) of the sweep: every axis is varied with the others at their first value."""
+    base = (args.models[0], args.members[0], args.years[0])
+    points = [base]
+    for axis, values in enumerate([args.models, args.members, args.years]):
+        for value in values[1:]:
+            point = list(base)
+            point[axis] = value
+            points.append(tuple(point))
+    return points
+
+
+def print_curves(results: Dict[str, dict], args: argparse.Namespace):
+    metrics = [m for m in next(iter(results.values())) if m.endswith("_per_sec")]
+    for axis, key, values in [("models", "num_models", args.models), ("members", "num_members", args.members), ("years", "num_years", args.years)]:
+        if len(values) < 2:
+            continue
+        print(f"\nThroughput over the number of {axis}:")
+        labels = [m.replace("_megabytes_per_sec", " MB/s").replace("_per_sec", "/s") for m in metrics]
+        print(f"{axis:>8} " + " ".join(f"{label:>{len(label)}}" for label in labels))
+        for value in values:
+            point = {"num_models": args.models[0], "num_members": args.members[0], "num_years": args.years[0], key: value}
+            name = point_name(point["num_models"], point["num_members"], point["num_years"])
+            print(f"{value:>8} " + " ".join(f"{results[name][m]:>{len(label)}.1f}" for m, label in zip(metrics, labels)))
+
+
+def point_name(num_models: int, num_members: int, num_years: int) -> str:
+    return f"models{num_models}_members{num_members}_years{num_years}"
+
+
+def run(args: argparse.Namespace):
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix="synthetic_climateset_")
+    try:
+        if args.data_dir is None:
+            log.info(f"Generating synthetic data in {data_dir}.")
+            generate_tree(data_dir, max(args.models), max(args.members), max(args.years), args.out_vars, args.in_vars)
+
+        results = {}
+        for num_models, num_members, num_years in sweep_points(args):
+            name = point_name(num_models, num_members, num_years)
+            log.info(f"Benchmarking {name}.")
+            results[name] = benchmark_point(data_dir, num_models, num_members, num_years, args)
+    finally:
+        if args.data_dir is None:
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+    print_curves(results, args)
+    meta = get_meta(benchmark="data_pipeline", peak_rss_mb=peak_rss_mb(), **{
+        k: v for k, v in vars(args).items() if k not in ["func", "out"]
+    })
+    out = args.out or f"bench/data_pipeline_{meta['commit']}.json"
+    save_report(out, meta, results)
+
+
+def generate(args: argparse.Namespace):
+    generate_tree(args.root, args.models, args.members, args.years, args.out_vars, args.in_vars)
+    print(f"Wrote synthetic data to {args.root}")
+
+
+def compare(args: argparse.Namespace):
+    regressed = print_comparison(load_report(args.baseline), load_report(args.current), args.tolerance)
+    sys.exit(1 if regressed else 0)
+
+
+def get_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(required=True)
+
+    run_parser = subparsers.add_parser("run", help="Run the sweep and write a JSON report.")
+    run_parser.add_argument("--models", type=int, nargs="+", default=[1, 2, 4], help="Numbers of climate models.")
+    run_parser.add_argument("--members", type=int, nargs="+", default=[1, 2], help="Numbers of ensemble members.")
+    run_parser.add_argument("--years", type=int, nargs="+", default=[1, 2, 4], help="Numbers of SSP years.")
+    run_parser.add_argument("--out-vars", nargs="+", default=["pr", "tas"])
+    run_parser.add_argument("--in-vars", nargs="+", default=["BC_sum", "CO2_sum", "SO2_sum", "CH4_sum"])
+    run_parser.add_argument("--channels-last", action="store_true")
+    run_parser.add_argument("--block-cache", action="store_true", help="Read the raw data through the block cache.")
+    run_parser.add_argument("--batch-size", type=int, default=4)
+    run_parser.add_argument("--num-workers", type=int, default=0)
+    run_parser.add_argument("--repeats", type=int, default=3, help="Every timing is the median of this many runs.")
+    run_parser.add_argument("--data-dir", type=str, default=None, help="Existing synthetic tree, generated if not given.")
+    run_parser.add_argument("--out", type=str, default=None, help="Defaults to bench/data_pipeline_<commit>.json")
+    run_parser.set_defaults(func=run)
+
+    generate_parser = subparsers.add_parser("generate", help="Only generate a synthetic tree.")
+    generate_parser.add_argument("root", type=str)
+    generate_parser.add_argument("--models", type=int, default=2)
+    generate_parser.add_argument("--members", type=int, default=2)
+    generate_parser.add_argument("--years", type=int, default=2)
+    generate_parser.add_argument("--out-vars", nargs="+", default=["pr", "tas"])
+    generate_parser.add_argument("--in-vars", nargs="+", default=["BC_sum", "CO2_sum", "SO2_sum", "CH4_sum"])
+    generate_parser.set_defaults(func=generate)
+
+    compare_parser = subparsers.add_parser("compare", help="Compare two reports and flag regressions.")
+    compare_parser.add_argument("baseline", type=str)
+    compare_parser.add_argument("current", type=str)
+    compare_parser.add_argument("--tolerance", type=float, default=0.1, help="Accepted relative change.")
+    compare_parser.set_defaults(func=compare)
+    return parser
+
+
+if __name__ == "__main__":
+    args = get_parser().parse_args()
+    args.func(args)
@@ -0,0 +1,212 @@
+"""
+Training throughput benchmark of the emulators on the DummyDataModule.
+
+Every model is trained for a few warmup and measured steps in a fresh process (so that peak memory is per model),
+recording samples/sec, step latency percentiles, peak RSS and peak device memory. The models are built from the
+hydra configs, so extra overrides can be passed through, either for all benchmarks (e.g. trainer.precision=16) or
+for a single one (e.g. climax:model.embed_dim=256). With --sweep, every model is benchmarked once per value of an
+override, e.g. to measure the memory/throughput curve of a setting, and reported as <model>[<value>].
+
+Run from the root of the repository:
+
+    python -m emulator.benchmarks.train_throughput run --out bench/train_<commit>.json
+    python -m emulator.benchmarks.train_throughput run --cpu --lon 32 --lat 32 --seq-len 4 --models unet climax
+    python -m emulator.benchmarks.train_throughput run --models climax --sweep model.checkpoint_every_k_blocks=0,1,2,4
+    python -m emulator.benchmarks.train_throughput compare bench/train_<old>.json bench/train_<new>.json
+"""
+
+import argparse
+import multiprocessing as mp
+import os
+import sys
+from typing import Dict, List, Optional
+
+import hydra
+import pytorch_lightning as pl
+import torch
+from hydra import compose, initialize_config_dir
+
+import emulator.src.utils.config_utils as cfg_utils
+
+from emulator.benchmarks.common import (
+    get_meta,
+    latency_stats,
+    load_report,
+    peak_device_mem_mb,
+    peak_rss_mb,
+    print_comparison,
+    save_report,
+)
+from emulator.src.core.callbacks import StepPhaseTimer
+from emulator.src.utils.utils import get_logger
+
+log = get_logger()
+
+CONFIG_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "configs")
+
+# hydra overrides selecting the model of every benchmark
+BENCHMARKS: Dict[str, List[str]] = {
+    "unet": ["model=unet"],
+    "cnn_lstm": ["model=conv_lstm"],
+    "convlstm": ["model=convlstm_fused"],
+    "climax": ["model=climax", "model.pretrained_path=null"],
+    "gp": ["model=gp"],
+    "unet_decoder": [
+        "model=unet",
+        "decoder=multihead_decoder",
+        "model.super_emulation=True",
+        "datamodule.train_models=[NorESM2-LM,MPI-ESM1-2-HR,EC-Earth3]",
+    ],
+}
+
+
+def get_sweep(args: argparse.Namespace) -> List[Optional[str]]:
+    """The overrides of --sweep, e.g. "model.depth=2,4" -> ["model.depth=2", "model.depth=4"], else [None]."""
+    if args.sweep is None:
+        return [None]
+    key, _, values = args.sweep.partition("=")
+    return [f"{key}={value}" for value in values.split(",")]
+
+
+def get_config(name: str, args: argparse.Namespace, sweep_override: Optional[str] = None):
+    overrides = [
+        "datamodule=dummy",
+        "logger=none",
+        f"work_dir={os.getcwd()}",
+        f"datamodule.lon={args.lon}",
+        f"datamodule.lat={args.lat}",
+        f"datamodule.seq_len={args.seq_len}",
+        f"datamodule.batch_size={args.batch_size}",
+        f"datamodule.size={args.num_samples}",
+        # everything for training
+        "++datamodule.test_split=0.0",
+        "++datamodule.val_split=0.0",
+        "datamodule.emissions_tracker=False",
+    ]
+    overrides += BENCHMARKS[name]
+    for override in args.overrides:
+        # "climax:model.depth=2" only applies to the climax benchmark
+        benchmark, _, override_for_benchmark = override.rpartition(":")
+        if benchmark in ["", name]:
+            overrides.append(override_for_benchmark)
+    if sweep_override is not None:
+        overrides.append(sweep_override)
+    with initialize_config_dir(config_dir=CONFIG_DIR, version_base=None):
+        config = compose("main_config", overrides=overrides)
+    cfg_utils.set_gradient_accumulation(config)
+    return config
+
+
+def run_benchmark(name: str, args: argparse.Namespace, sweep_override: Optional[str] = None) -> dict:
+    """Train one model and return its metrics, meant to be run in its own process."""
+    from emulator.src.utils.interface import get_model_and_data
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    pl.seed_everything(args.seed, workers=True)
+    config = get_config(name, args, sweep_override)
+    model, datamodule = get_model_and_data(config)
+
+    # never logs (the trainer has no logger), only records the step times after the warmup
+    timer = StepPhaseTimer(warmup_steps=args.warmup_steps, synchronize=True)
+    trainer: pl.Trainer = hydra.utils.instantiate(
+        config.trainer,
+        accelerator="gpu" if torch.cuda.is_available() else "cpu",
+        devices=1,
+        min_epochs=None,
+        max_epochs=-1,
+        max_steps=args.warmup_steps + args.steps,
+        limit_val_batches=0,
+        num_sanity_val_steps=0,
+        logger=False,
+        callbacks=[timer],
+        enable_checkpointing=False,
+        enable_progress_bar=False,
+        enable_model_summary=False,
+    )
+    trainer.fit(model=model, datamodule=datamodule)
+
+    wall = timer.last_end - timer.first_start
+    return {
+        "num_params": sum(p.numel() for p in model.parameters()),
+        "steps": len(timer.step_times),
+        "samples_per_sec": timer.samples / wall,
+        **latency_stats(timer.step_times, prefix="step"),
+        "peak_rss_mb": peak_rss_mb(),
+        "peak_device_mem_mb": peak_device_mem_mb(),
+    }
+
+
+def run(args: argparse.Namespace):
+    if args.cpu:
+        # hide the GPUs from the benchmark processes (models move themselves to CUDA if it is available)
+        os.environ["CUDA_VISIBLE_DEVICES"] = ""
+
+    results = {}
+    ctx = mp.get_context("spawn")
+    for name in args.models:
+        for sweep_override in get_sweep(args):
+            result_name = name if sweep_override is None else f"{name}[{sweep_override.partition('=')[2]}]"
+            log.info(f"Benchmarking {result_name}.")
+            if args.no_isolation:
+                results[result_name] = run_benchmark(name, args, sweep_override)
+            else:
+                with ctx.Pool(1) as pool:
+                    results[result_name] = pool.apply(run_benchmark, (name, args, sweep_override))
+            result = results[result_name]
+            peak_device_mem = result["peak_device_mem_mb"]
+            print(
+                f"{result_name}: {result['samples_per_sec']:.2f} samples/sec, "
+                f"step p50 {result['step_p50_ms']:.1f} ms, peak RSS {result['peak_rss_mb']:.0f} MB"
+                + (f", peak device memory {peak_device_mem:.0f} MB" if peak_device_mem is not None else "")
+            )
+
+    meta = get_meta(benchmark="train_throughput", cpu_only=args.cpu or not torch.cuda.is_available(), **{
+        k: v for k, v in vars(args).items() if k not in ["func", "out", "cpu"]
+    })
+    out = args.out or f"bench/train_throughput_{meta['commit']}.json"
+    save_report(out, meta, results)
+
+
+def compare(args: argparse.Namespace):
+    regressed = print_comparison(load_report(args.baseline), load_report(args.current), args.tolerance)
+    sys.exit(1 if regressed else 0)
+
+
+def get_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(required=True)
+
+    run_parser = subparsers.add_parser("run", help="Run the benchmarks and write a JSON report.")
+    run_parser.add_argument("--models", nargs="+", default=list(BENCHMARKS), choices=list(BENCHMARKS))
+    run_parser.add_argument("--lon", type=int, default=96)
+    run_parser.add_argument("--lat", type=int, default=144)
+    run_parser.add_argument("--seq-len", type=int, default=12)
+    run_parser.add_argument("--batch-size", type=int, default=4)
+    run_parser.add_argument("--num-samples", type=int, default=32, help="Size of the dummy dataset.")
+    run_parser.add_argument("--warmup-steps", type=int, default=3)
+    run_parser.add_argument("--steps", type=int, default=20)
+    run_parser.add_argument("--threads", type=int, default=0, help="torch threads, 0 keeps the default.")
+    run_parser.add_argument("--seed", type=int, default=42)
+    run_parser.add_argument("--cpu", action="store_true", help="Run on CPU even if a GPU is available.")
+    run_parser.add_argument("--no-isolation", action="store_true", help="Run all models in this process.")
+    run_parser.add_argument("--out", type=str, default=None, help="Defaults to bench/train_throughput_<commit>.json")
+    run_parser.add_argument(
+        "--sweep", type=str, default=None, help="Override with comma separated values to benchmark each of, e.g. model.depth=2,4"
+    )
+    run_parser.add_argument(
+        "overrides", nargs="*", help="Additional hydra overrides, prefixed by <benchmark>: if only for one benchmark."
+    )
+    run_parser.set_defaults(func=run)
+
+    compare_parser = subparsers.add_parser("compare", help="Compare two reports and flag regressions.")
+    compare_parser.add_argument("baseline", type=str)
+    compare_parser.add_argument("current", type=str)
+    compare_parser.add_argument("--tolerance", type=float, default=0.1, help="Accepted relative change.")
+    compare_parser.set_defaults(func=compare)
+    return parser
+
+
+if __name__ == "__main__":
+    args = get_parser().parse_args()
+    args.func(args)
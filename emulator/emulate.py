@@ -0,0 +1,161 @@
+"""
+Emulate emission scenarios with a trained emulator and write the fields into chunked NetCDF (or Zarr) files.
+
+The model is built from the hydra config it was trained with (same overrides as for training, e.g. an experiment)
+and its weights are reloaded from the checkpoint. Inputs are normalized and predictions denormalized with the
+statistics of the training data: either from a .npz written by a previous run (--stats), or computed by the
+datamodule of the config (which loads the training data), optionally saved for the next runs (--save-stats).
+
+Run from the root of the repository:
+
+    python -m emulator.emulate --ckpt checkpoints/last.ckpt --scenario ssp245 --out emulated/ssp245.nc \\
+        --save-stats emulated/stats.npz experiment=superemulator/<experiment>
+    python -m emulator.emulate --ckpt checkpoints/last.ckpt --emissions my_pathway.nc --stats emulated/stats.npz \\
+        --climate-models NorESM2-LM --out emulated/my_pathway.zarr experiment=superemulator/<experiment>
+"""
+
+import argparse
+import os
+from typing import List, Optional
+
+import torch
+from hydra import compose, initialize_config_dir
+from omegaconf import DictConfig
+
+from emulator.src.core.emulation import ScenarioEmulator, load_emissions_file, load_input4mips_scenario
+from emulator.src.data.constants import AVAILABLE_MODELS_FIRETYPE, OPENBURNING_MODEL_MAPPING
+from emulator.src.data.custom_transforms import Normalizer
+from emulator.src.utils.utils import get_logger
+
+log = get_logger()
+
+CONFIG_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "configs")
+
+
+def get_config(overrides: List[str]) -> DictConfig:
+    with initialize_config_dir(config_dir=CONFIG_DIR, version_base=None):
+        return compose("main_config", overrides=[f"work_dir={os.getcwd()}", "logger=none", *overrides])
+
+
+def get_normalizer(config: DictConfig, args: argparse.Namespace) -> Optional[Normalizer]:
+    """Training statistics from --stats, or from the datamodule of the config."""
+    if args.stats is not None:
+        return Normalizer.load(args.stats, channels_last=config.datamodule.channels_last)
+
+    from emulator.src.datamodules.climate_datamodule import ClimateDataModule
+    from emulator.src.datamodules.super_climate_datamodule import SuperClimateDataModule
+    from emulator.src.utils.interface import get_datamodule
+
+    log.info("Computing the normalization statistics from the training data of the datamodule.")
+    datamodule = get_datamodule(config)
+    if isinstance(datamodule, SuperClimateDataModule):
+        normalizer = datamodule.create_normalizer()
+    else:
+        datamodule.setup("fit")
+        normalizer = getattr(datamodule, "normalizer", None)
+        if normalizer is None and isinstance(datamodule, ClimateDataModule):
+            # the datasets were z-normalized on the host with the statistics of the training dataset
+            normalizer = datamodule.create_normalizer(norm_type="z-norm")
+    if normalizer is None:
+        raise ValueError(
+            f"{type(datamodule).__name__} does not provide the normalization statistics, pass them with --stats."
+        )
+    if args.save_stats is not None:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save_stats)), exist_ok=True)
+        normalizer.save(args.save_stats)
+        log.info(f"Saved the normalization statistics to {args.save_stats}.")
+    return normalizer
+
+
+def get_out_path(out: str, climate_model: Optional[str], num_climate_models: int) -> str:
+    """One output per climate model, suffixed with its name if there are several."""
+    if climate_model is None or num_climate_models == 1:
+        return out
+    root, ext = os.path.splitext(out.rstrip("/"))
+    return f"{root}_{climate_model}{ext}"
+
+
+def main(args: argparse.Namespace):
+    if args.cpu:
+        os.environ["CUDA_VISIBLE_DEVICES"] = ""
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    from emulator.src.utils.interface import reload_model_from_config_and_ckpt
+
+    config = get_config(args.overrides)
+    datamodule_config = config.datamodule
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    model = reload_model_from_config_and_ckpt(config, args.ckpt, device=device)["model"]
+    normalizer = get_normalizer(config, args)
+
+    climate_models = args.climate_models
+    if climate_models is None and (
+        getattr(model, "super_decoder", False) or (normalizer is not None and normalizer.climate_models is not None)
+    ):
+        climate_models = list(datamodule_config.train_models)
+    emulator = ScenarioEmulator(
+        model,
+        normalizer,
+        in_var_ids=datamodule_config.in_var_ids,
+        out_var_ids=datamodule_config.out_var_ids,
+        channels_last=datamodule_config.channels_last,
+        seq_len=datamodule_config.seq_len,
+        batch_size=args.batch_size,
+        device=device,
+        precision=args.precision,
+    )
+
+    first_year, last_year = map(int, args.years.split("-"))
+    data_dir = args.data_dir or datamodule_config.data_dir
+    for climate_model in climate_models or [None]:
+        if args.emissions is not None:
+            emissions = load_emissions_file(args.emissions, emulator.in_var_ids)
+        else:
+            openburning_specs = OPENBURNING_MODEL_MAPPING[
+                climate_model if climate_model in AVAILABLE_MODELS_FIRETYPE else "other"
+            ]
+            emissions = load_input4mips_scenario(
+                data_dir, args.scenario, range(first_year, last_year + 1), emulator.in_var_ids, openburning_specs
+            )
+        out_path = get_out_path(args.out, climate_model, len(climate_models or [None]))
+        summary = emulator.emulate(
+            emissions,
+            out_path,
+            climate_model=climate_model,
+            chunk_years=args.chunk_years,
+            compress=args.compress,
+            attrs={
+                "scenario": args.scenario or os.path.basename(args.emissions),
+                "checkpoint": os.path.abspath(args.ckpt),
+            },
+        )
+        print(f"Wrote {out_path}: {summary['years']} years at {summary['years_per_sec']:.1f} years/s")
+
+
+def get_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--ckpt", type=str, required=True, help="Checkpoint with the weights of the model.")
+    scenario = parser.add_mutually_exclusive_group(required=True)
+    scenario.add_argument("--scenario", type=str, help="Input4MIPs scenario, e.g. ssp245.")
+    scenario.add_argument("--emissions", type=str, help="NetCDF with one variable per input variable.")
+    parser.add_argument("--years", type=str, default="2015-2100", help="Years of the Input4MIPs scenario.")
+    parser.add_argument("--data-dir", type=str, default=None, help="Defaults to datamodule.data_dir.")
+    parser.add_argument(
+        "--climate-models", nargs="+", default=None, help="Climate models to emulate, defaults to the training models."
+    )
+    parser.add_argument("--out", type=str, required=True, help="NetCDF output, or Zarr if it ends with .zarr.")
+    parser.add_argument("--stats", type=str, default=None, help="Normalization statistics written with --save-stats.")
+    parser.add_argument("--save-stats", type=str, default=None, help="Write the normalization statistics to a .npz.")
+    parser.add_argument("--batch-size", type=int, default=64, help="Years per forward pass.")
+    parser.add_argument("--chunk-years", type=int, default=1, help="Years per chunk of the output.")
+    parser.add_argument("--compress", action="store_true", help="Compress the output chunks.")
+    parser.add_argument("--precision", type=str, default="32", choices=["32", "bf16"])
+    parser.add_argument("--threads", type=int, default=0, help="torch threads, 0 keeps the default.")
+    parser.add_argument("--cpu", action="store_true", help="Run on CPU even if a GPU is available.")
+    parser.add_argument("overrides", nargs="*", help="Hydra overrides of the training config.")
+    return parser
+
+
+if __name__ == "__main__":
+    main(get_parser().parse_args())
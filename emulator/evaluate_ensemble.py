@@ -0,0 +1,113 @@
+"""
+Evaluate many checkpoints of the same model (e.g. the seeds of an experiment) together on the test sets of the
+datamodule of their config, in a single pass over the test data.
+
+The weights of the members are stacked and vectorized over with torch.func, so every test batch is loaded once and
+run through all members together. The metrics of every member and of the ensemble mean are printed and, with --out,
+written to a CSV with one row per member. The model and overrides are handled as in emulate.py.
+
+Run from the root of the repository:
+
+    python -m emulator.evaluate_ensemble --ckpt pretrained_models/super_emulator/Unet/<experiment>/*/checkpoints/last.ckpt \\
+        --out scores/unet_seeds.csv experiment=superemulator/<experiment>
+"""
+
+import argparse
+import copy
+import csv
+import os
+from typing import List
+
+import torch
+from omegaconf import DictConfig
+
+from emulator.emulate import get_config
+from emulator.src.core.ensemble import StackedEnsemble, evaluate_ensemble
+from emulator.src.utils.utils import get_logger
+
+log = get_logger()
+
+
+def member_name(ckpt: str) -> str:
+    """The run id for checkpoints in .../<run id>/checkpoints/<name>.ckpt (as in pretrained_models/), else the path."""
+    parts = os.path.normpath(ckpt).split(os.sep)
+    if len(parts) >= 3 and parts[-2] == "checkpoints":
+        return parts[-3]
+    return ckpt
+
+
+def load_members(config: DictConfig, ckpts: List[str]) -> List[torch.nn.Module]:
+    """Build the model of the config once and reload the weights of every checkpoint into a copy of it."""
+    from emulator.src.utils.interface import get_model
+
+    model = get_model(config)
+    members = []
+    for ckpt in ckpts:
+        member = copy.deepcopy(model)
+        member.load_state_dict(torch.load(ckpt, map_location="cpu")["state_dict"])
+        members.append(member)
+    return members
+
+
+def write_csv(results: dict, path: str):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    metrics = list(next(iter(results.values())).keys())
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["member"] + metrics)
+        for member, stats in results.items():
+            writer.writerow([member] + [stats[metric] for metric in metrics])
+
+
+def main(args: argparse.Namespace):
+    if args.cpu:
+        os.environ["CUDA_VISIBLE_DEVICES"] = ""
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    from emulator.src.utils.interface import get_datamodule
+
+    config = get_config(args.overrides)
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    ensemble = StackedEnsemble(
+        load_members(config, args.ckpt),
+        device=device,
+        vectorize=not args.no_vectorize,
+        members_per_pass=args.members_per_pass,
+    )
+    names = [member_name(ckpt) for ckpt in args.ckpt]
+    if len(set(names)) != len(names):
+        names = list(args.ckpt)
+
+    results = evaluate_ensemble(
+        ensemble,
+        get_datamodule(config),
+        out_var_ids=config.datamodule.out_var_ids,
+        channels_last=config.datamodule.channels_last,
+        member_names=names,
+        precision=args.precision,
+    )
+
+    for member, stats in results.items():
+        summary = ", ".join(f"{k}={v:.4g}" for k, v in stats.items() if k.count("/") == 2 and k.endswith("rmse"))
+        print(f"{member}: {summary}")
+    if args.out is not None:
+        write_csv(results, args.out)
+        print(f"Wrote {args.out}")
+
+
+def get_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--ckpt", nargs="+", required=True, help="Checkpoints of the members.")
+    parser.add_argument("--out", type=str, default=None, help="CSV with the metrics of every member.")
+    parser.add_argument("--members-per-pass", type=int, default=None, help="Most members per forward pass.")
+    parser.add_argument("--no-vectorize", action="store_true", help="Run the members one by one on every batch.")
+    parser.add_argument("--precision", type=str, default="32", choices=["32", "bf16"])
+    parser.add_argument("--threads", type=int, default=0, help="torch threads, 0 keeps the default.")
+    parser.add_argument("--cpu", action="store_true", help="Run on CPU even if a GPU is available.")
+    parser.add_argument("overrides", nargs="*", help="Hydra overrides of the training config.")
+    return parser
+
+
+if __name__ == "__main__":
+    main(get_parser().parse_args())
@@ -0,0 +1,54 @@
+"""
+Index the pretrained_models/ tree (see download_pretrained_models.py) into a local SQLite registry and list the runs
+with their metrics, e.g. to score and rank many runs without the wandb API.
+See ModelRegistry in emulator/src/utils/model_registry.py, which reload_model_from_id uses to reload runs offline.
+
+Run from the root of the repository:
+
+    python -m emulator.registry --root pretrained_models
+    python -m emulator.registry --model-name ClimaX --metrics test/ssp245_NorESM2-LM/tas/rmse --sort \\
+        test/ssp245_NorESM2-LM/tas/rmse --out scores/climax.csv
+"""
+
+import argparse
+
+import pandas as pd
+
+from emulator.src.utils.model_registry import ModelRegistry
+
+
+def main(args: argparse.Namespace):
+    registry = ModelRegistry(args.root, db_path=args.db)
+    registry.scan(force=args.rescan)
+    df = registry.metrics_frame(
+        args.metrics,
+        experiment_type=args.experiment_type,
+        model_name=args.model_name,
+        experiment_name=args.experiment_name,
+    )
+    if args.sort is not None and len(df) > 0:
+        df = df.sort_values(args.sort)
+    if args.out is not None:
+        df.to_csv(args.out)
+        print(f"Wrote {len(df)} runs to {args.out}")
+    else:
+        with pd.option_context("display.max_rows", None, "display.width", 200):
+            print(df.drop(columns="ckpt_path") if len(df) > 0 else f"No runs indexed in {registry.db_path}.")
+
+
+def get_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--root", type=str, default=None, help="Defaults to $PRETRAINED_MODELS_DIR or ./pretrained_models.")
+    parser.add_argument("--db", type=str, default=None, help="Defaults to <root>/registry.sqlite.")
+    parser.add_argument("--rescan", action="store_true", help="Re-read all runs, not only the changed ones.")
+    parser.add_argument("--experiment-type", type=str, default=None, help="e.g. super_emulator")
+    parser.add_argument("--model-name", type=str, default=None, help="e.g. ClimaX")
+    parser.add_argument("--experiment-name", type=str, default=None)
+    parser.add_argument("--metrics", nargs="+", default=None, help="Metrics to list, defaults to all.")
+    parser.add_argument("--sort", type=str, default=None, help="Metric to sort the runs by.")
+    parser.add_argument("--out", type=str, default=None, help="CSV with the runs and their metrics.")
+    return parser
+
+
+if __name__ == "__main__":
+    main(get_parser().parse_args())
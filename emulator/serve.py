@@ -0,0 +1,103 @@
+"""
+Serve one or more trained emulators over HTTP on localhost, batching concurrent requests dynamically.
+See EmulationService in emulator/src/core/serving.py for the endpoints and the request format.
+
+Every model is given as name=checkpoint, hydra overrides apply to all models or, prefixed by <name>:, to one model
+only (as for the benchmarks). The statistics are handled as in emulate.py, --stats takes name=path per model.
+
+Run from the root of the repository:
+
+    python -m emulator.serve --ckpt unet=checkpoints/unet.ckpt --stats unet=emulated/stats.npz --port 8080 \\
+        experiment=superemulator/<experiment>
+    curl -X POST localhost:8080/emulate -d '{"scenario": "ssp245", "factors": {"SO2_sum": 0.5}, "output": "global"}'
+    curl localhost:8080/metrics
+"""
+
+import argparse
+import asyncio
+import os
+from typing import Dict, List
+
+import torch
+
+from emulator.emulate import get_config, get_normalizer
+from emulator.src.core.emulation import ScenarioEmulator
+from emulator.src.core.serving import EmulationService
+from emulator.src.utils.utils import get_logger
+
+log = get_logger()
+
+
+def parse_named(values: List[str]) -> Dict[str, str]:
+    """["unet=path"] -> {"unet": "path"}"""
+    return dict(value.split("=", 1) for value in values)
+
+
+def load_emulators(args: argparse.Namespace, device: torch.device) -> Dict[str, ScenarioEmulator]:
+    from emulator.src.utils.interface import reload_model_from_config_and_ckpt
+
+    stats = parse_named(args.stats)
+    emulators = {}
+    for name, ckpt in parse_named(args.ckpt).items():
+        overrides = []
+        for override in args.overrides:
+            model_name, _, override_for_model = override.rpartition(":")
+            if model_name in ["", name]:
+                overrides.append(override_for_model)
+        config = get_config(overrides)
+        model = reload_model_from_config_and_ckpt(config, ckpt, device=device)["model"]
+        normalizer = get_normalizer(config, argparse.Namespace(stats=stats.get(name), save_stats=None))
+        emulators[name] = ScenarioEmulator(
+            model,
+            normalizer,
+            in_var_ids=config.datamodule.in_var_ids,
+            out_var_ids=config.datamodule.out_var_ids,
+            channels_last=config.datamodule.channels_last,
+            seq_len=config.datamodule.seq_len,
+            device=device,
+            precision=args.precision,
+        )
+        if args.data_dir is None:
+            args.data_dir = config.datamodule.data_dir
+    return emulators
+
+
+def main(args: argparse.Namespace):
+    if args.cpu:
+        os.environ["CUDA_VISIBLE_DEVICES"] = ""
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    emulators = load_emulators(args, device)
+    first_year, last_year = map(int, args.years.split("-"))
+    service = EmulationService(
+        emulators,
+        data_dir=args.data_dir,
+        max_batch_size=args.max_batch_size,
+        max_latency_ms=args.max_latency_ms,
+        default_years=(first_year, last_year),
+    )
+    asyncio.run(service.serve_forever(args.host, args.port))
+
+
+def get_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--ckpt", nargs="+", required=True, help="Served models as name=checkpoint.")
+    parser.add_argument("--stats", nargs="*", default=[], help="Normalization statistics as name=path.")
+    parser.add_argument("--data-dir", type=str, default=None, help="Defaults to datamodule.data_dir.")
+    parser.add_argument("--years", type=str, default="2015-2100", help="Default years of scenario requests.")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--max-batch-size", type=int, default=64, help="Most years per forward pass.")
+    parser.add_argument("--max-latency-ms", type=float, default=10.0, help="Longest wait for a batch to fill.")
+    parser.add_argument("--precision", type=str, default="32", choices=["32", "bf16"])
+    parser.add_argument("--threads", type=int, default=0, help="torch threads, 0 keeps the default.")
+    parser.add_argument("--cpu", action="store_true", help="Run on CPU even if a GPU is available.")
+    parser.add_argument(
+        "overrides", nargs="*", help="Hydra overrides of the training configs, prefixed by <name>: if only for one model."
+    )
+    return parser
+
+
+if __name__ == "__main__":
+    main(get_parser().parse_args())
@@ -1,6 +1,9 @@
-from typing import List, Sequence, Union, Dict
+import time
+from collections import deque
+from typing import List, Sequence, Union, Dict, Optional
 import torch
 import numpy as np
+import pytorch_lightning as pl
 
 
 class PredictionPostProcessCallback:
@@ -35,3 +38,199 @@ class PredictionPostProcessCallback:
 
     def __call__(self, vector, *args, **kwargs):
         return self.split_vector_by_variable(vector)
+
+
+class StepPhaseTimer(pl.Callback):
+    """
+    Times the phases of every training step and logs their percentiles every ``log_every_n_steps`` steps.
+
+    Phases:
+        data_wait: waiting for the next batch of the dataloader, including on_before_batch_transfer (host time)
+        transfer: moving the batch to the device, including on_after_batch_transfer (e.g. normalization), but not
+            on_before_batch_transfer, which Lightning calls before strategy.batch_to_device
+        forward: forward pass of the model
+        loss: rest of the training step, mostly the loss
+        backward: backward pass
+        optimizer: optimizer step (including gradient clipping) and zero_grad up to the end of the batch
+
+    On CUDA the phases are timed with CUDA events, which are only resolved when logging, so timing does not add any
+    synchronization. Otherwise perf_counter is used. The durations of the last ``window`` steps are kept per phase.
+
+    Additionally, the wall time of every step from on_train_batch_start to on_train_batch_end after ``warmup_steps``
+    optimizer steps is kept in ``step_times``, with the number of samples (e.g. for throughput benchmarks). With
+    gradient accumulation, every batch is timed as a step, and the optimizer step is part of the last batch it
+    accumulates. These are only exact on CUDA with ``synchronize=True``, which synchronizes at their start and end.
+    """
+
+    PHASES = ["data_wait", "transfer", "forward", "loss", "backward", "optimizer"]
+    # (phase, start mark, end mark)
+    _PHASE_MARKS = [
+        ("transfer", "transfer_start", "transfer_end"),
+        ("forward", "forward_start", "forward_end"),
+        ("loss", "forward_end", "backward_start"),
+        ("backward", "backward_start", "backward_end"),
+        ("optimizer", "backward_end", "batch_end"),
+    ]
+
+    def __init__(
+        self,
+        log_every_n_steps: int = 50,
+        window: int = 1000,
+        prefix: str = "step_timing",
+        warmup_steps: int = 0,
+        synchronize: bool = False,
+    ):
+        """
+        Args:
+            log_every_n_steps (int): Log the percentiles every n training steps.
+            window (int): Number of most recent steps the percentiles are computed over.
+            prefix (str): Prefix of the logged metrics.
+            warmup_steps (int): Number of optimizer steps before the steps are recorded in step_times.
+            synchronize (bool): Synchronize the device at the start and end of the recorded steps.
+        """
+        super().__init__()
+        self.log_every_n_steps = log_every_n_steps
+        self.prefix = prefix
+        self.warmup_steps = warmup_steps
+        self.synchronize = synchronize
+        self.step_times: List[float] = []
+        self.samples = 0
+        self.first_start: Optional[float] = None
+        self.last_end: Optional[float] = None
+        self._step_start: Optional[float] = None
+        self.durations: Dict[str, deque] = {phase: deque(maxlen=window) for phase in self.PHASES}
+        # marks of the steps since the last log, resolved to durations when logging
+        self._pending: List[Dict] = []
+        self._marks: Dict = {}
+        self._fetch_start: Optional[float] = None
+        self._in_step = False
+        self._use_cuda = False
+        self._hooks = []
+        self._strategy = None
+
+    def _mark(self, name: str):
+        if self._use_cuda:
+            event = torch.cuda.Event(enable_timing=True)
+            event.record()
+            self._marks[name] = event
+        else:
+            self._marks[name] = time.perf_counter()
+
+    def _sync(self, pl_module):
+        if self.synchronize and pl_module.device.type == "cuda":
+            torch.cuda.synchronize(pl_module.device)
+
+    def _elapsed(self, start, end) -> float:
+        """Elapsed seconds between two marks."""
+        if self._use_cuda:
+            return start.elapsed_time(end) / 1e3
+        return end - start
+
+    def on_fit_start(self, trainer, pl_module):
+        self._use_cuda = pl_module.device.type == "cuda"
+        self._hooks = [
+            pl_module.register_forward_pre_hook(lambda *args: self._on_forward("forward_start")),
+            pl_module.register_forward_hook(lambda *args: self._on_forward("forward_end")),
+        ]
+
+        # time the batch transfer by wrapping the strategy's batch_to_device
+        self._strategy = trainer.strategy
+        batch_to_device = trainer.strategy.batch_to_device
+
+        def timed_batch_to_device(*args, **kwargs):
+            if not trainer.training:
+                return batch_to_device(*args, **kwargs)
+            self._marks = {"transfer_host_start": time.perf_counter()}
+            self._mark("transfer_start")
+            batch = batch_to_device(*args, **kwargs)
+            self._mark("transfer_end")
+            return batch
+
+        trainer.strategy.batch_to_device = timed_batch_to_device
+
+    def on_fit_end(self, trainer, pl_module):
+        for hook in self._hooks:
+            hook.remove()
+        self._hooks = []
+        # remove the instance attribute, falling back to the method of the strategy class
+        if self._strategy is not None and "batch_to_device" in vars(self._strategy):
+            del self._strategy.batch_to_device
+        self._strategy = None
+
+    def _on_forward(self, name: str):
+        # only the first forward start and the last forward end of a training step (validation is not timed)
+        if self._in_step and (name == "forward_end" or name not in self._marks):
+            self._mark(name)
+
+    def on_train_epoch_start(self, trainer, pl_module):
+        self._fetch_start = time.perf_counter()
+
+    def on_train_batch_start(self, trainer, pl_module, batch, batch_idx):
+        self._in_step = True
+        if self._fetch_start is not None and "transfer_host_start" in self._marks:
+            self._marks["data_wait"] = self._marks["transfer_host_start"] - self._fetch_start
+        if trainer.global_step >= self.warmup_steps:
+            self._sync(pl_module)
+            self._step_start = time.perf_counter()
+            if self.first_start is None:
+                if self.synchronize and pl_module.device.type == "cuda":
+                    torch.cuda.reset_peak_memory_stats(pl_module.device)
+                self.first_start = self._step_start
+
+    def on_before_backward(self, trainer, pl_module, loss):
+        if self._in_step:
+            self._mark("backward_start")
+
+    def on_after_backward(self, trainer, pl_module):
+        if self._in_step:
+            self._mark("backward_end")
+
+    def on_train_batch_end(self, trainer, pl_module, outputs, batch, batch_idx):
+        self._mark("batch_end")
+        self._in_step = False
+        if self._step_start is not None:
+            self._sync(pl_module)
+            self.last_end = time.perf_counter()
+            self.step_times.append(self.last_end - self._step_start)
+            self.samples += len(batch[0])
+            self._step_start = None
+        self._pending.append(self._marks)
+        self._marks = {}
+
+        if len(self._pending) >= self.log_every_n_steps:
+            self._resolve()
+            metrics = self.summary()
+            if metrics:
+                for logger in trainer.loggers:
+                    logger.log_metrics(metrics, step=trainer.global_step)
+        self._fetch_start = time.perf_counter()
+
+    def _resolve(self):
+        """Convert the marks of the pending steps into durations."""
+        if self._use_cuda:
+            torch.cuda.current_stream().synchronize()
+        for marks in self._pending:
+            if "data_wait" in marks:
+                self.durations["data_wait"].append(marks["data_wait"])
+            for phase, start, end in self._PHASE_MARKS:
+                if start in marks and end in marks:
+                    self.durations[phase].append(self._elapsed(marks[start], marks[end]))
+        self._pending = []
+
+    def summary(self) -> Dict[str, float]:
+        """Mean and percentiles (in ms) of every phase over the window and its fraction of the step time."""
+        self._resolve()
+        means = {phase: float(np.mean(d)) for phase, d in self.durations.items() if len(d) > 0}
+        total = sum(means.values())
+        metrics = {}
+        for phase, mean in means.items():
+            ms = np.asarray(self.durations[phase]) * 1e3
+            p50, p90, p99 = np.percentile(ms, [50, 90, 99])
+            metrics.update({
+                f"{self.prefix}/{phase}_mean_ms": mean * 1e3,
+                f"{self.prefix}/{phase}_p50_ms": p50,
+                f"{self.prefix}/{phase}_p90_ms": p90,
+                f"{self.prefix}/{phase}_p99_ms": p99,
+                f"{self.prefix}/{phase}_fraction": mean / total if total > 0 else 0.0,
+            })
+        return metrics
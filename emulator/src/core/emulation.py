@@ -0,0 +1,413 @@
+import glob
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional, Sequence, Tuple, Union
+
+import netCDF4
+import numpy as np
+import torch
+import xarray as xr
+
+from emulator.src.data.constants import (
+    CMIP6_NOM_RES,
+    INPUT4MIPS_TEMP_RES,
+    NO_OPENBURNING_VARS,
+    SEQ_LEN,
+)
+from emulator.src.data.custom_transforms import Normalizer
+from emulator.src.utils.utils import get_logger
+
+log = get_logger()
+
+# units the time coordinate is written with, so that every appended chunk is encoded alike
+TIME_UNITS = "days since 1850-01-01"
+
+
+def load_input4mips_scenario(
+    data_dir: str,
+    scenario: str,
+    years: Sequence[int],
+    in_var_ids: Sequence[str],
+    openburning_specs: Tuple[str, str] = ("no-fires", "no-fires"),
+) -> xr.Dataset:
+    """
+    Lazily open the Input4MIPs emissions of a scenario, with the same files as the Input4MipsDataset.
+
+    Args:
+        data_dir (str): Root of the ClimateSet data (holding inputs/input4mips).
+        scenario (str): E.g. "ssp245" or "historical".
+        years (list): Years to emulate.
+        in_var_ids (list): Input variables, in the order the model was trained with.
+        openburning_specs (tuple): (historical, ssp) openburning filter of the climate model to emulate.
+
+    Returns:
+        xr.Dataset: One variable per input variable of shape (time, lon, lat), chunked per file.
+    """
+    root_dir = os.path.join(data_dir, "inputs/input4mips", scenario)
+    openburning = openburning_specs[0] if scenario == "historical" else openburning_specs[1]
+    data_vars = {}
+    for var in in_var_ids:
+        var_filter = "" if var in NO_OPENBURNING_VARS else openburning
+        files = []
+        for year in years:
+            var_dir = os.path.join(root_dir, var, f"{CMIP6_NOM_RES}/{INPUT4MIPS_TEMP_RES}/{year}")
+            year_files = sorted(glob.glob(var_dir + f"/**/*{var_filter}*.nc", recursive=True))
+            if len(year_files) == 0:
+                raise FileNotFoundError(f"No Input4MIPs files for {scenario}, {var}, {year} in {var_dir}.")
+            files += year_files
+        ds = xr.open_mfdataset(files, concat_dim="time", combine="nested")
+        data_vars[var] = next(iter(ds.data_vars.values()))
+    return xr.Dataset(data_vars)
+
+
+def load_emissions_file(path: str, in_var_ids: Sequence[str]) -> xr.Dataset:
+    """
+    Lazily open a user supplied emissions NetCDF holding one variable per input variable, of shape (time, lon, lat)
+    with monthly time steps (in units of the training data).
+    """
+    ds = xr.open_dataset(path, chunks={})
+    missing = [var for var in in_var_ids if var not in ds.data_vars]
+    if missing:
+        raise ValueError(f"{path} misses the input variables {missing}, it holds {list(ds.data_vars)}.")
+    return ds[list(in_var_ids)]
+
+
+def _is_datetime(times: np.ndarray) -> bool:
+    """True for datetime64 and cftime time coordinates."""
+    return np.issubdtype(times.dtype, np.datetime64) or (times.dtype == object and hasattr(times.flat[0], "calendar"))
+
+
+class MemoryWriter:
+    """Collects the emulated fields in memory, see ScenarioEmulator.emulate."""
+
+    def __init__(self, out_var_ids: Sequence[str], spatial_coords: Dict[str, np.ndarray], attrs: Optional[Dict] = None):
+        self.out_var_ids = list(out_var_ids)
+        self.spatial_coords = spatial_coords
+        self.attrs = attrs or {}
+        self.times, self.fields = [], {var: [] for var in self.out_var_ids}
+
+    def write(self, times: np.ndarray, fields: Dict[str, np.ndarray]):
+        self.times.append(times)
+        for var in self.out_var_ids:
+            self.fields[var].append(fields[var])
+
+    def close(self):
+        pass
+
+    def dataset(self) -> xr.Dataset:
+        dims = ("time", *self.spatial_coords)
+        return xr.Dataset(
+            {var: (dims, np.concatenate(self.fields[var])) for var in self.out_var_ids},
+            coords={"time": np.concatenate(self.times), **self.spatial_coords},
+            attrs=self.attrs,
+        )
+
+
+class NetCDFWriter:
+    """
+    Streams the emulated fields into a NetCDF4 file with an unlimited time dimension, chunked by ``chunk_time``
+    time steps and (optionally) compressed.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        out_var_ids: Sequence[str],
+        spatial_coords: Dict[str, np.ndarray],
+        chunk_time: int = SEQ_LEN,
+        compress: bool = False,
+        attrs: Optional[Dict] = None,
+    ):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.out_var_ids = list(out_var_ids)
+        self.nc = netCDF4.Dataset(path, "w", format="NETCDF4")
+        self.nc.setncatts(attrs or {})
+        self.nc.createDimension("time", None)
+        self.nc.createVariable("time", "f8", ("time",))
+        self.calendar = None
+        for dim, values in spatial_coords.items():
+            self.nc.createDimension(dim, len(values))
+            self.nc.createVariable(dim, np.asarray(values).dtype, (dim,))[:] = values
+        shape = [len(values) for values in spatial_coords.values()]
+        for var in self.out_var_ids:
+            self.nc.createVariable(
+                var, "f4", ("time", *spatial_coords), chunksizes=(chunk_time, *shape), zlib=compress
+            )
+        self.length = 0
+
+    def write(self, times: np.ndarray, fields: Dict[str, np.ndarray]):
+        if _is_datetime(times):
+            encoded, _, calendar = xr.coding.times.encode_cf_datetime(times, TIME_UNITS, self.calendar)
+            if self.calendar is None:
+                self.calendar = calendar
+                self.nc["time"].setncatts({"units": TIME_UNITS, "calendar": calendar})
+        else:
+            encoded = times
+        end = self.length + len(times)
+        self.nc["time"][self.length : end] = encoded
+        for var in self.out_var_ids:
+            self.nc[var][self.length : end] = fields[var]
+        self.length = end
+
+    def close(self):
+        self.nc.close()
+
+
+class ZarrWriter:
+    """Streams the emulated fields into a Zarr store, appending along time in chunks of ``chunk_time`` time steps."""
+
+    def __init__(
+        self,
+        path: str,
+        out_var_ids: Sequence[str],
+        spatial_coords: Dict[str, np.ndarray],
+        chunk_time: int = SEQ_LEN,
+        compress: bool = False,
+        attrs: Optional[Dict] = None,
+    ):
+        try:
+            import zarr  # noqa: F401
+        except ImportError:
+            raise ImportError("Writing Zarr stores requires zarr, install it with `pip install zarr`.")
+        self.path = path
+        self.memory = MemoryWriter(out_var_ids, spatial_coords, attrs)
+        self.chunk_time = chunk_time
+        self.compress = compress
+        self.started = False
+
+    def write(self, times: np.ndarray, fields: Dict[str, np.ndarray]):
+        self.memory.write(times, fields)
+        ds = self.memory.dataset()
+        self.memory.times, self.memory.fields = [], {var: [] for var in self.memory.out_var_ids}
+        if self.started:
+            ds.to_zarr(self.path, append_dim="time")
+            return
+        encoding = {var: {"chunks": (self.chunk_time, *ds[var].shape[1:])} for var in self.memory.out_var_ids}
+        if not self.compress:
+            for var in self.memory.out_var_ids:
+                encoding[var]["compressor"] = None
+        if _is_datetime(ds["time"].values):
+            encoding["time"] = {"units": TIME_UNITS}
+        ds.to_zarr(self.path, mode="w", encoding=encoding)
+        self.started = True
+
+    def close(self):
+        pass
+
+
+def get_writer(path: Optional[str], out_var_ids: Sequence[str], spatial_coords: Dict[str, np.ndarray], **kwargs):
+    """Writer for the output path: Zarr for *.zarr, NetCDF otherwise and in memory if the path is None."""
+    if path is None:
+        return MemoryWriter(out_var_ids, spatial_coords, attrs=kwargs.get("attrs"))
+    if path.rstrip("/").endswith(".zarr"):
+        return ZarrWriter(path, out_var_ids, spatial_coords, **kwargs)
+    return NetCDFWriter(path, out_var_ids, spatial_coords, **kwargs)
+
+
+class ScenarioEmulator:
+    """
+    Emulates the climate response to emission scenarios with a trained emulator.
+
+    The years of a scenario are batched through the model in inference mode: every year is one sample of
+    ``seq_len`` monthly time steps, like in the datasets. Inputs are normalized and the predictions denormalized with
+    the training statistics, and the fields are streamed into a NetCDF or Zarr output while the next batch is read
+    and predicted.
+
+    Example:
+        model = reload_model_from_config_and_ckpt(config, ckpt_path)["model"]
+        emulator = ScenarioEmulator(model, Normalizer.load("stats.npz"), in_var_ids=config.datamodule.in_var_ids, ...)
+        emissions = load_input4mips_scenario(data_dir, "ssp245", range(2015, 2101), emulator.in_var_ids)
+        emulator.emulate(emissions, "ssp245_NorESM2-LM.nc", climate_model="NorESM2-LM")
+    """
+
+    def __init__(
+        self,
+        model: torch.nn.Module,
+        normalizer: Optional[Normalizer],
+        in_var_ids: Sequence[str],
+        out_var_ids: Sequence[str],
+        channels_last: bool = False,
+        seq_len: int = SEQ_LEN,
+        batch_size: int = 64,
+        device: Optional[Union[str, torch.device]] = None,
+        precision: str = "32",
+    ):
+        """
+        Args:
+            model (BaseModel): The trained emulator.
+            normalizer (Normalizer): Training statistics, None if the model was trained on unnormalized data.
+            in_var_ids (list): Input variables, in the order the model was trained with.
+            out_var_ids (list): Output variables, in the order the model was trained with.
+            channels_last (bool): Layout the model was trained with.
+            seq_len (int): Number of monthly time steps per sample.
+            batch_size (int): Number of years per forward pass.
+            device (str): Defaults to the device of the model.
+            precision (str): "32" or "bf16" (autocast).
+        """
+        self.device = torch.device(device) if device is not None else next(model.parameters()).device
+        self.model = model.to(self.device).eval()
+        self.normalizer = normalizer.to(self.device) if normalizer is not None else None
+        self.in_var_ids = list(in_var_ids)
+        self.out_var_ids = list(out_var_ids)
+        self.channels_last = channels_last
+        self.seq_len = seq_len
+        self.batch_size = batch_size
+        if precision not in ["32", "bf16"]:
+            raise ValueError(f"Precision {precision} is not supported, use 32 or bf16.")
+        self.precision = precision
+        self.super_decoder = getattr(model, "super_decoder", False)
+
+    def check_climate_model(self, climate_model: Optional[str]):
+        """
+        Raise a ValueError if the climate model is missing although the model needs one (multihead decoder, per-model
+        statistics or EOFs), or if there are no statistics or EOFs for it.
+        """
+        known = [
+            module.climate_models
+            for module in (self.normalizer, getattr(self.model, "output_projection", None))
+            if module is not None and module.climate_models is not None
+        ]
+        if climate_model is None:
+            if self.super_decoder or known:
+                raise ValueError("The model has a multihead decoder or per-model statistics, a climate model to emulate is needed.")
+            return
+        for climate_models in known:
+            if climate_model not in climate_models:
+                raise ValueError(f"Climate model {climate_model} is not known, choose one of {climate_models}.")
+
+    def num_years(self, emissions: xr.Dataset) -> int:
+        num_steps = emissions.sizes["time"]
+        if num_steps % self.seq_len != 0:
+            raise ValueError(f"The emissions have {num_steps} time steps, not a multiple of {self.seq_len} per year.")
+        return num_steps // self.seq_len
+
+    def spatial_coords(self, emissions: xr.Dataset) -> Dict[str, np.ndarray]:
+        """The two spatial coordinates of the emissions (indexes if the file has none), also used for the outputs."""
+        first_var = emissions[self.in_var_ids[0]]
+        return {
+            dim: emissions[dim].values if dim in emissions.coords else np.arange(first_var.sizes[dim])
+            for dim in first_var.dims[1:]
+        }
+
+    def read_years(self, emissions: xr.Dataset) -> torch.Tensor:
+        """Read all years of the emissions, as a (years, seq_len, vars, lon, lat) or channels last tensor."""
+        return self._read_batch(emissions, 0, self.num_years(emissions))
+
+    def _read_batch(self, emissions: xr.Dataset, first_year: int, num_years: int) -> torch.Tensor:
+        """Read the emissions of some years as a (years, seq_len, vars, lon, lat) or channels last tensor."""
+        steps = slice(first_year * self.seq_len, (first_year + num_years) * self.seq_len)
+        X = np.stack([np.asarray(emissions[var].isel(time=steps).values, dtype=np.float32) for var in self.in_var_ids])
+        # (vars, time, lon, lat) -> (years, seq_len, ...), like Input4MipsDataset.reshape_into_sequences
+        X = X.reshape(len(self.in_var_ids), num_years, self.seq_len, *X.shape[2:])
+        X = X.transpose((1, 2, 3, 4, 0)) if self.channels_last else X.transpose((1, 2, 0, 3, 4))
+        return torch.from_numpy(np.ascontiguousarray(X))
+
+    def predict(self, X: torch.Tensor, climate_model: Optional[Union[str, Sequence[str]]] = None) -> torch.Tensor:
+        """
+        Predict the (denormalized) fields of a batch of unnormalized inputs.
+
+        Args:
+            X (Tensor): Emissions of shape (years, seq_len, vars, lon, lat), or channels last.
+            climate_model (str): Climate model to emulate, needed for models with a multihead decoder and per-model
+                statistics. Either one for the whole batch or one per sample.
+
+        Returns:
+            Tensor: Of shape (years, time steps, out vars, lon, lat), always channels first.
+        """
+        if climate_model is None or isinstance(climate_model, str):
+            model_ids = [climate_model] * len(X) if climate_model is not None else None
+        else:
+            model_ids = list(climate_model)
+        with torch.inference_mode(), torch.autocast(
+            self.device.type, dtype=torch.bfloat16, enabled=self.precision == "bf16"
+        ):
+            X = X.to(self.device, non_blocking=True)
+            if self.normalizer is not None:
+                X = self.normalizer.normalize_input(X, model_ids)
+            if self.super_decoder:
+                if model_ids is None:
+                    raise ValueError("The model has a multihead decoder, a climate model to emulate is needed.")
+                preds = self.model(X, model_ids)
+            else:
+                preds = self.model(X)
+            if getattr(self.model, "output_projection", None) is not None:
+                preds = self.model.output_projection.reconstruct(preds, model_ids)
+            preds = preds.float()
+            if self.normalizer is not None:
+                preds = self.normalizer.denormalize_output(preds, model_ids)
+        if self.channels_last:
+            preds = preds.permute(0, 1, 4, 2, 3)
+        return preds
+
+    def emulate(
+        self,
+        emissions: xr.Dataset,
+        out_path: Optional[str] = None,
+        climate_model: Optional[str] = None,
+        chunk_years: int = 1,
+        compress: bool = False,
+        attrs: Optional[Dict] = None,
+    ) -> Union[xr.Dataset, Dict[str, float]]:
+        """
+        Emulate an emission scenario.
+
+        Args:
+            emissions (xr.Dataset): Unnormalized emissions, one variable per input variable of shape (time, lon, lat),
+                see load_input4mips_scenario and load_emissions_file. Time has to cover full years.
+            out_path (str): NetCDF or Zarr (*.zarr) output, if None the fields are returned as xr.Dataset.
+            climate_model (str): Climate model to emulate (see predict).
+            chunk_years (int): Years per chunk of the output.
+            compress (bool): Compress the output chunks.
+            attrs (dict): Global attributes of the output.
+
+        Returns:
+            The emulated fields as xr.Dataset if out_path is None, otherwise a summary of the run
+            (years, seconds, years_per_sec).
+        """
+        num_years = self.num_years(emissions)
+        spatial_coords = self.spatial_coords(emissions)
+        times = emissions["time"].values if "time" in emissions.coords else None
+
+        attrs = {"climate_model": climate_model or "", **(attrs or {})}
+        writer = get_writer(
+            out_path, self.out_var_ids, spatial_coords, chunk_time=chunk_years * self.seq_len, compress=compress, attrs=attrs
+        )
+        batches = [(start, min(self.batch_size, num_years - start)) for start in range(0, num_years, self.batch_size)]
+        start_time = time.perf_counter()
+        # read the next batch and write the last one while predicting
+        with ThreadPoolExecutor(max_workers=1) as reader, ThreadPoolExecutor(max_workers=1) as writing:
+            next_batch = reader.submit(self._read_batch, emissions, *batches[0]) if batches else None
+            pending_write = None
+            for i, (first_year, batch_years) in enumerate(batches):
+                X = next_batch.result()
+                if i + 1 < len(batches):
+                    next_batch = reader.submit(self._read_batch, emissions, *batches[i + 1])
+                preds = self.predict(X, climate_model).cpu().numpy()
+                # seq-to-seq models predict every month, the others only the last month of every year
+                steps_per_year = preds.shape[1]
+                preds = preds.reshape(batch_years * steps_per_year, *preds.shape[2:])
+                fields = {var: preds[:, j] for j, var in enumerate(self.out_var_ids)}
+                batch_times = self._batch_times(times, first_year, batch_years, steps_per_year)
+                if pending_write is not None:
+                    pending_write.result()
+                pending_write = writing.submit(writer.write, batch_times, fields)
+            if pending_write is not None:
+                pending_write.result()
+        writer.close()
+        seconds = time.perf_counter() - start_time
+        log.info(f"Emulated {num_years} years in {seconds:.2f}s ({num_years / seconds:.1f} years/s).")
+
+        if out_path is None:
+            return writer.dataset()
+        return {"years": num_years, "seconds": seconds, "years_per_sec": num_years / seconds}
+
+    def _batch_times(
+        self, times: Optional[np.ndarray], first_year: int, num_years: int, steps_per_year: int
+    ) -> np.ndarray:
+        """Time coordinate of the predicted steps of a batch of years, the last steps of every year."""
+        if times is None:
+            times = np.arange((first_year + num_years) * self.seq_len)
+        times = times[first_year * self.seq_len : (first_year + num_years) * self.seq_len]
+        return times.reshape(num_years, self.seq_len)[:, self.seq_len - steps_per_year :].reshape(-1)
@@ -0,0 +1,243 @@
+import copy
+import time
+from typing import Any, Dict, List, Optional, Sequence
+
+import numpy as np
+import torch
+from torch.func import functional_call, stack_module_state, vmap
+
+from emulator.src.utils.utils import get_logger
+
+log = get_logger()
+
+METRICS = ["mse", "rmse", "llrmse_wheather_bench", "llmse_climax", "llrmse_climax"]
+
+
+class StackedEnsemble:
+    """
+    Runs the members of an ensemble of models with the same architecture (e.g. the seeds of one experiment) together.
+
+    The weights of all members are stacked with ``torch.func.stack_module_state`` and a single forward pass is
+    vectorized over the members with ``vmap``, so every batch is read once and each layer runs as one batched kernel
+    for all members. Models whose forward pass cannot be vectorized (e.g. the per-sample heads of the multihead
+    decoder) fall back to running the members one after the other on the same batch.
+
+    Example:
+        models = [reload_model_from_config_and_ckpt(config, ckpt)["model"] for ckpt in ckpts]
+        ensemble = StackedEnsemble(models)
+        preds = ensemble(X)  # (members, batch_size, ...)
+    """
+
+    def __init__(
+        self,
+        models: Sequence[torch.nn.Module],
+        device: Optional[torch.device] = None,
+        vectorize: bool = True,
+        members_per_pass: Optional[int] = None,
+    ):
+        """
+        Args:
+            models (list): The members, instances of the same model class with the same hyperparameters.
+            device (torch.device): Defaults to the device of the first member.
+            vectorize (bool): If False, the members always run one after the other.
+            members_per_pass (int): Most members vectorized per forward pass, to bound the activation memory.
+                Defaults to all members.
+        """
+        if len(models) == 0:
+            raise ValueError("An ensemble needs at least one member.")
+        self.device = torch.device(device) if device is not None else next(models[0].parameters()).device
+        self.models = [model.to(self.device).eval() for model in models]
+        self.super_decoder = getattr(self.models[0], "super_decoder", False)
+        self.members_per_pass = members_per_pass
+        self.vectorized = vectorize and len(self.models) > 1
+        if self.vectorized:
+            shapes = [{k: getattr(v, "shape", None) for k, v in model.state_dict().items()} for model in self.models]
+            if any(s != shapes[0] for s in shapes[1:]):
+                raise ValueError("The members of the ensemble have different architectures.")
+            self.params, self.buffers = stack_module_state(self.models)
+            # stateless copy of the architecture, the stacked weights are passed to every call
+            self.base_model = copy.deepcopy(self.models[0]).to("meta")
+
+    def __len__(self) -> int:
+        return len(self.models)
+
+    def _forward(self, model: torch.nn.Module, X: torch.Tensor, model_ids: Optional[List[str]]) -> torch.Tensor:
+        return model(X, model_ids) if self.super_decoder else model(X)
+
+    def _vectorized_forward(self, X: torch.Tensor, model_ids: Optional[List[str]]) -> torch.Tensor:
+        def call(params, buffers, X):
+            args = (X, model_ids) if self.super_decoder else (X,)
+            return functional_call(self.base_model, (params, buffers), args)
+
+        return vmap(call, in_dims=(0, 0, None), chunk_size=self.members_per_pass)(self.params, self.buffers, X)
+
+    def __call__(self, X: torch.Tensor, model_ids: Optional[List[str]] = None) -> torch.Tensor:
+        """
+        Args:
+            X (Tensor): One batch of inputs, shared by all members.
+            model_ids (list): Climate model of every sample, for models with a multihead decoder.
+
+        Returns:
+            Tensor: The predictions of every member, of shape (members, *prediction shape).
+        """
+        preds = None
+        if self.vectorized:
+            try:
+                preds = self._vectorized_forward(X, model_ids)
+            except RuntimeError as e:
+                log.warning(f"The model cannot be vectorized over the members ({e}), running them one by one.")
+                self.vectorized = False
+                del self.params, self.buffers, self.base_model
+        if preds is None:
+            preds = torch.stack([self._forward(model, X, model_ids) for model in self.models])
+        return self._reconstruct(preds, model_ids)
+
+    def _reconstruct(self, preds: torch.Tensor, model_ids: Optional[List[str]]) -> torch.Tensor:
+        """The fields of the predictions of members predicting EOF coefficients, each with its own EOFs."""
+        if getattr(self.models[0], "output_projection", None) is None:
+            return preds
+        return torch.stack(
+            [model.output_projection.reconstruct(member_preds, model_ids) for model, member_preds in zip(self.models, preds)]
+        )
+
+
+class EnsembleMetrics:
+    """
+    Running sums of the metrics of ``evaluate_preds`` (emulator/src/core/evaluation.py) for all members of an ensemble
+    and for their mean, so that they are evaluated batch by batch without collecting the predictions.
+    """
+
+    def __init__(self, num_members: int, out_var_ids: Sequence[str], device: Optional[torch.device] = None):
+        """
+        Args:
+            num_members (int): Number of members, the ensemble mean is evaluated in addition.
+            out_var_ids (list): Names of the output variables.
+            device (torch.device): Where the sums are accumulated.
+        """
+        self.num_members = num_members
+        self.out_var_ids = list(out_var_ids)
+        shape = (num_members + 1, len(self.out_var_ids))
+        kwargs = dict(dtype=torch.float64, device=device)
+        self.squared_error = torch.zeros(shape, **kwargs)
+        self.weighted_squared_error = torch.zeros(shape, **kwargs)
+        self.field_rmse = torch.zeros(shape, **kwargs)
+        self.num_values = 0
+        self.num_fields = 0
+        self.weights = None
+
+    def lat_weights(self, lat_size: int, device: torch.device) -> torch.Tensor:
+        """Normalized cosine weights of the last axis, as in LLweighted_MSE_Climax."""
+        if self.weights is None or len(self.weights) != lat_size:
+            lats = np.linspace(-90, 90, lat_size)
+            weights = np.cos((np.pi * lats) / 180)
+            self.weights = torch.as_tensor(weights / weights.mean(), dtype=torch.float64)
+        return self.weights.to(device)
+
+    @torch.no_grad()
+    def update(self, preds: torch.Tensor, targets: torch.Tensor):
+        """
+        Args:
+            preds (Tensor): Predictions of shape (members, batch_size, time, vars, lon, lat).
+            targets (Tensor): Targets of shape (batch_size, time, vars, lon, lat).
+        """
+        preds = preds.double()
+        preds = torch.cat([preds, preds.mean(dim=0, keepdim=True)])
+        squared_error = (preds - targets.double().unsqueeze(0)) ** 2
+        device = self.squared_error.device
+        # (members + 1, batch_size, time, vars, lon, lat) -> (members + 1, vars)
+        self.squared_error += squared_error.sum(dim=(1, 2, 4, 5)).to(device)
+        weights = self.lat_weights(squared_error.shape[-1], squared_error.device)
+        self.weighted_squared_error += (squared_error * weights).sum(dim=(1, 2, 4, 5)).to(device)
+        self.field_rmse += squared_error.mean(dim=(-1, -2)).sqrt().sum(dim=(1, 2)).to(device)
+        self.num_values += squared_error[0, :, :, 0].numel()
+        self.num_fields += squared_error.shape[1] * squared_error.shape[2]
+
+    def compute(self) -> torch.Tensor:
+        """The metrics of shape (members + 1, vars, metrics), in the order of METRICS."""
+        mse = self.squared_error / self.num_values
+        llmse = self.weighted_squared_error / self.num_values
+        return torch.stack([mse, mse.sqrt(), self.field_rmse / self.num_fields, llmse, llmse.sqrt()], dim=-1).cpu()
+
+    def results(self, data_split: str, member_names: Optional[Sequence[str]] = None) -> Dict[str, Dict[str, float]]:
+        """
+        Args:
+            data_split (str): Prefix of the metrics, like in ``evaluate_per_target_variable``.
+            member_names (list): Defaults to member_0, member_1, ...
+
+        Returns:
+            dict: member name -> {data_split/var/metric: value, data_split/metric: mean over the vars}, with the
+                ensemble mean as the member "ensemble_mean".
+        """
+        member_names = list(member_names or [f"member_{i}" for i in range(self.num_members)]) + ["ensemble_mean"]
+        metrics = self.compute()
+        results = {}
+        for name, member_metrics in zip(member_names, metrics):
+            stats = {}
+            for var, var_metrics in zip(self.out_var_ids, member_metrics):
+                for metric, value in zip(METRICS, var_metrics.tolist()):
+                    stats[f"{data_split}/{var}/{metric}"] = value
+            for metric, value in zip(METRICS, member_metrics.mean(dim=0).tolist()):
+                stats[f"{data_split}/{metric}"] = value
+            results[name] = stats
+        return results
+
+
+def evaluate_ensemble(
+    ensemble: StackedEnsemble,
+    datamodule: Any,
+    out_var_ids: Sequence[str],
+    channels_last: bool = False,
+    member_names: Optional[Sequence[str]] = None,
+    precision: str = "32",
+) -> Dict[str, Dict[str, float]]:
+    """
+    Evaluate all members of an ensemble, and their mean, on the test sets of a datamodule in one pass over the data.
+
+    Like ``BaseModel.on_test_epoch_end``, the metrics are in physical units if the datamodule normalizes on the
+    device (the predictions and targets are denormalized with its normalizer) and in normalized units otherwise.
+
+    Args:
+        ensemble (StackedEnsemble): The members.
+        datamodule: A datamodule of the config the members were trained with.
+        out_var_ids (list): Output variables, in the order the members were trained with.
+        channels_last (bool): Layout of the datamodule.
+        member_names (list): Names of the members in the results, defaults to member_0, member_1, ...
+        precision (str): "32" or "bf16" (autocast).
+
+    Returns:
+        dict: member name (and "ensemble_mean") -> {test/<test set>/<var>/<metric>: value, ...}
+    """
+    if precision not in ["32", "bf16"]:
+        raise ValueError(f"Precision {precision} is not supported, use 32 or bf16.")
+    device = ensemble.device
+    datamodule.setup("test")
+    dataloaders = datamodule.test_dataloader()
+    test_set_names = getattr(datamodule, "test_set_names", None)
+    if test_set_names is None or len(test_set_names) != len(dataloaders):
+        test_set_names = [str(i) for i in range(len(dataloaders))]
+    normalizer = getattr(datamodule, "normalizer", None)
+
+    results = {}
+    for dataloader_idx, (name, dataloader) in enumerate(zip(test_set_names, dataloaders)):
+        start_time, num_samples = time.time(), 0
+        metrics = EnsembleMetrics(len(ensemble), out_var_ids, device=device)
+        for batch in dataloader:
+            batch = [b.to(device, non_blocking=True) if torch.is_tensor(b) else b for b in batch]
+            batch = datamodule.on_after_batch_transfer(batch, dataloader_idx)
+            X, Y, *rest = batch
+            model_ids = list(rest[0]) if rest else None
+            with torch.inference_mode(), torch.autocast(device.type, dtype=torch.bfloat16, enabled=precision == "bf16"):
+                preds = ensemble(X, model_ids).float()
+                if normalizer is not None:
+                    members_ids = model_ids * len(ensemble) if model_ids is not None else None
+                    preds = normalizer.denormalize_output(preds.flatten(0, 1), members_ids).unflatten(0, preds.shape[:2])
+                    Y = normalizer.denormalize_output(Y, model_ids)
+            if channels_last:
+                preds, Y = preds.permute(0, 1, 2, 5, 3, 4), Y.permute(0, 1, 4, 2, 3)
+            metrics.update(preds, Y)
+            num_samples += len(X)
+        seconds = time.time() - start_time
+        log.info(f"Evaluated {len(ensemble)} members on {num_samples} samples of {name} in {seconds:.1f}s.")
+        for member, stats in metrics.results(f"test/{name}", member_names).items():
+            results.setdefault(member, {}).update(stats)
+    return results
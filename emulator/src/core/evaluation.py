@@ -91,7 +91,7 @@ def evaluate_per_target_variable(
 
     # mean over vars
     for m in var_stats[0].keys():
-        stats[f"{data_split}/{metric_name}"] /= len(Ytrue.keys())
+        stats[f"{data_split}/{m}"] /= len(Ytrue.keys())
 
     stats = {
         **stats,
@@ -41,9 +41,15 @@ class MLL(nn.Module):
     Marginal log likelihood: loss used for the Variational Gaussian Process
     """
 
-    def __init__(self, gp_model, train_y):
+    def __init__(self, gp_model, num_data: int):
+        """
+        Args:
+            gp_model: Holding the approximate GP (.model) and its likelihood (.likelihood).
+            num_data (int): Number of training points, to scale the minibatch ELBO to the full training set.
+        """
+        super().__init__()
         self.mll = gpytorch.mlls.VariationalELBO(
-            gp_model.likelihood, gp_model.model, num_data=train_y.size(0)
+            gp_model.likelihood, gp_model.model, num_data=num_data
         )
 
     def forward(self, pred, y):
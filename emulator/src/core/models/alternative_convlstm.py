@@ -1,251 +1,173 @@
+from typing import List, Optional, Tuple, Union
+
+import torch
+import torch.nn as nn
+from omegaconf import DictConfig
+from torch import Tensor
+
+from emulator.src.core.models.basemodel import BaseModel
+from emulator.src.utils.utils import to_default_device
+
+
 class ConvLSTMCell(nn.Module):
     """
     adapted from: https://github.com/automan000/Convolutional_LSTM_PyTorch/blob/master/convolution_lstm.py
     belonging to the paper: " Convolutional LSTM Network: A Machine Learning Approach for Precipitation Nowcasting" by Shi et al.
+
+    All four gates (input, forget, cell, output) are computed by a single convolution over the concatenated input and
+    hidden state, instead of one convolution per gate for each of them. With peephole=True, the input and forget
+    gates see the previous and the output gate the new cell state through per-cell weights (Wci, Wcf, Wco) as in the
+    paper, which need the spatial shape of the inputs.
     """
 
     def __init__(
-        self, hidden_channels, kernel_size, input_channels=None, output_channels=None
+        self,
+        input_channels: int,
+        hidden_channels: int,
+        kernel_size: int = 3,
+        peephole: bool = True,
+        shape: Optional[Tuple[int, int]] = None,
     ):
-        super(ConvLSTMCell, self).__init__()
-
-        assert hidden_channels % 2 == 0
-        if input_channels is None:
-            input_channels = hidden_channels
-        if output_channels is None:
-            output_channels = hidden_channels
-
+        super().__init__()
+        assert kernel_size % 2 == 1, "The kernel size must be odd to keep the spatial shape."
         self.input_channels = input_channels
         self.hidden_channels = hidden_channels
-        self.output_channels = output_channels
         self.kernel_size = kernel_size
 
-        self.padding = int((kernel_size - 1) / 2)
-
-        self.Wxi = nn.Conv2d(
-            self.input_channels,
-            self.output_channels,
-            self.kernel_size,
-            1,
-            self.padding,
-            bias=True,
-        )
-        self.Whi = nn.Conv2d(
-            self.input_channels,
-            self.output_channels,
-            self.kernel_size,
-            1,
-            self.padding,
-            bias=False,
-        )
-        self.Wxf = nn.Conv2d(
-            self.input_channels,
-            self.output_channels,
-            self.kernel_size,
-            1,
-            self.padding,
-            bias=True,
-        )
-        self.Whf = nn.Conv2d(
-            self.input_channels,
-            self.output_channels,
-            self.kernel_size,
-            1,
-            self.padding,
-            bias=False,
-        )
-        self.Wxc = nn.Conv2d(
-            self.input_channels,
-            self.output_channels,
-            self.kernel_size,
-            1,
-            self.padding,
+        self.conv = nn.Conv2d(
+            input_channels + hidden_channels,
+            4 * hidden_channels,
+            kernel_size,
+            padding=kernel_size // 2,
             bias=True,
         )
-        self.Whc = nn.Conv2d(
-            self.input_channels,
-            self.output_channels,
-            self.kernel_size,
-            1,
-            self.padding,
-            bias=False,
-        )
-        self.Wxo = nn.Conv2d(
-            self.input_channels,
-            self.output_channels,
-            self.kernel_size,
-            1,
-            self.padding,
-            bias=True,
-        )
-        self.Who = nn.Conv2d(
-            self.input_channels,
-            self.output_channels,
-            self.kernel_size,
-            1,
-            self.padding,
-            bias=False,
-        )
-
-        self.Wci = None
-        self.Wcf = None
-        self.Wco = None
-
-    def forward(self, x, h, c):
-        print(f"x size {x.size()}, h size {h.size()}, c size {c.size()}")
-        print(self.Wxi(x).size())
-        print(self.Whi(h).size())
-        print((c * self.Wci).size())
-        ci = torch.sigmoid(self.Wxi(x) + self.Whi(h) + c * self.Wci)
-        cf = torch.sigmoid(self.Wxf(x) + self.Whf(h) + c * self.Wcf)
-        print(f"ci {ci.size} cf {cf.size}")
-        cc = cf * c + ci * torch.tanh(self.Wxc(x) + self.Whc(h))
-        co = torch.sigmoid(self.Wxo(x) + self.Who(h) + cc * self.Wco)
-        ch = co * torch.tanh(cc)
-        return ch, cc
-
-    def init_hidden(self, batch_size, shape, layer_type=None):
-        if layer_type == "first":
-            hidden = self.input_channels
-        elif layer_type == "last":
-            hidden = self.output_channels
-        else:
-            hidden = self.hidden_channels
-
-        print("init hidden:", hidden)
-
-        if self.Wci is None:
-            self.Wci = nn.Parameter(
-                torch.zeros(1, self.input_channels, shape[0], shape[1])
-            )  # .cuda()
-            self.Wcf = nn.Parameter(
-                torch.zeros(1, hidden, shape[0], shape[1])
-            )  # .cuda()
-            self.Wco = nn.Parameter(
-                torch.zeros(1, hidden, shape[0], shape[1])
-            )  # .cuda()
+        if peephole:
+            assert shape is not None, "Peephole connections need the spatial shape of the inputs."
+            self.Wci = nn.Parameter(torch.zeros(1, hidden_channels, *shape))
+            self.Wcf = nn.Parameter(torch.zeros(1, hidden_channels, *shape))
+            self.Wco = nn.Parameter(torch.zeros(1, hidden_channels, *shape))
         else:
-            assert shape[0] == self.Wci.size()[2], "Input Height Mismatched!"
-            assert shape[1] == self.Wci.size()[3], "Input Width Mismatched!"
-        return (
-            Variable(
-                torch.zeros(batch_size, self.input_channels, shape[0], shape[1])
-            ),  # .cuda()
-            Variable(torch.zeros(batch_size, self.hidden_channels, shape[0], shape[1])),
-        )  # .cuda())
+            self.Wci = self.Wcf = self.Wco = None
+
+    def forward(self, x: Tensor, h: Tensor, c: Tensor) -> Tuple[Tensor, Tensor]:
+        """
+        Args:
+            x: (batch_size, input_channels, height, width)
+            h, c: (batch_size, hidden_channels, height, width), the hidden and cell state of the previous step.
+
+        Returns:
+            The new hidden and cell state.
+        """
+        gates = self.conv(torch.cat([x, h], dim=1))
+        i, f, g, o = gates.chunk(4, dim=1)
+        if self.Wci is not None:
+            i = i + c * self.Wci
+            f = f + c * self.Wcf
+        c = torch.sigmoid(f) * c + torch.sigmoid(i) * torch.tanh(g)
+        if self.Wco is not None:
+            o = o + c * self.Wco
+        h = torch.sigmoid(o) * torch.tanh(c)
+        return h, c
+
+    def init_hidden(self, x: Tensor) -> Tuple[Tensor, Tensor]:
+        """Zero hidden and cell state for the inputs x: (batch_size, input_channels, height, width)."""
+        state = x.new_zeros(x.shape[0], self.hidden_channels, x.shape[2], x.shape[3])
+        return state, state
 
 
 class ConvLSTM(BaseModel):
     """
-    adapted from: https://github.com/automan000/Convolutional_LSTM_PyTorch/blob/master/convolution_lstm.py
-    belonging to the paper: " Convolutional LSTM Network: A Machine Learning Approach for Precipitation Nowcasting" by Shi et al.
+    Stacked ConvLSTM emulator (Shi et al.), mapping the input variables of every time step to the output variables.
 
-    in the original implementation, c and h were allowed to have different channel dimensions in a layer, do not see how this works as they have to be added at some point...
-    implementing with same channels per layer now
-    (overall a bit goofy)
-
-    #TODO: fix channel adaptation
+    The layers run over the time steps one after the other, each passing its hidden state on as the input of the next
+    layer, and a 1x1 convolution reads the output variables out of the hidden state of the last layer at every time
+    step (seq_to_seq) or at the last one only.
     """
 
-    # input_channels corresponds to the first input feature map
-    # hidden state is a list of succeeding lstm layers.
     def __init__(
         self,
-        input_channels,  # num features in
-        hidden_channels,
-        output_channels,  # num features out
-        kernel_size,
-        num_hidden_layers=2,
-        step=1,  # predictive steps
-        effective_step=[1],
+        in_var_ids: List[str],
+        out_var_ids: List[str],
+        hidden_channels: Union[int, List[int]] = 32,
+        num_layers: int = 2,
+        kernel_size: int = 3,
+        peephole: bool = True,
+        lon: int = 32,
+        lat: int = 32,
+        seq_to_seq: bool = True,
+        seq_len: int = 12,
+        channels_last: bool = True,
+        datamodule_config: DictConfig = None,
+        *args,
+        **kwargs,
     ):
-        super(ConvLSTM, self).__init__()
-
-        self.input_channels = input_channels  # [input_channels] + hidden_channels
-        self.hidden_channels = hidden_channels  # hidden_channels + [output_channels]
-        self.output_channels = output_channels  # output_channels
-        self.kernel_size = kernel_size
-        self.num_layers = num_hidden_layers + 1
-        self.step = step
-        self.effective_step = effective_step
-        self._all_layers = []
-
-        for i in range(self.num_layers):
-            name = "cell{}".format(i)
-            if i == 0:
-                cell = ConvLSTMCell(
-                    hidden_channels=self.hidden_channels,
-                    input_channels=self.input_channels,
-                    kernel_size=self.kernel_size,
-                )
-            elif i == (self.num_layers - 1):
-                cell = ConvLSTMCell(
-                    hidden_channels=self.hidden_channels,
-                    output_channels=self.output_channels,
-                    kernel_size=self.kernel_size,
+        """
+        Args:
+            hidden_channels (int or list): Hidden channels of every layer, the same for all num_layers if an int.
+            num_layers (int): Number of ConvLSTM layers, ignored if hidden_channels is a list.
+            kernel_size (int): Odd kernel size of the gate convolutions.
+            peephole (bool): If True, the gates see the cell state through learned per-cell weights.
+        """
+        super().__init__(datamodule_config=datamodule_config, *args, **kwargs)
+
+        self.channels_last = channels_last
+        self.lon = lon
+        self.lat = lat
+        self.seq_len = seq_len
+        if datamodule_config is not None:
+            if datamodule_config.get("channels_last") is not None:
+                self.channels_last = datamodule_config.get("channels_last")
+            if datamodule_config.get("lon") is not None:
+                self.lon = datamodule_config.get("lon")
+            if datamodule_config.get("lat") is not None:
+                self.lat = datamodule_config.get("lat")
+            if datamodule_config.get("seq_len") is not None:
+                self.seq_len = datamodule_config.get("seq_len")
+        self.seq_to_seq = seq_to_seq
+        self.save_hyperparameters()
+
+        self.num_input_vars = len(in_var_ids)
+        self.num_output_vars = len(out_var_ids)
+        if isinstance(hidden_channels, int):
+            hidden_channels = [hidden_channels] * num_layers
+        hidden_channels = list(hidden_channels)
+
+        self.cells = nn.ModuleList(
+            [
+                ConvLSTMCell(
+                    input_channels=in_channels,
+                    hidden_channels=out_channels,
+                    kernel_size=kernel_size,
+                    peephole=peephole,
+                    shape=(self.lon, self.lat),
                 )
-            else:
-                cell = ConvLSTMCell(self.hidden_channels, self.kernel_size)
-            setattr(self, name, cell)
-            self._all_layers.append(cell)
-
-    def forward(self, X: Tensor):  # X of size (batch_size, time, lon, lat, num_vars)
-        # first -> pass input time step per time step through the convnet
-        internal_state = []
-        bsize, in_time, height, width, num_feats = X.size()
-
-        for i, step in enumerate(range(in_time)):
-            # get new input per time step
-            x = X[:, i, :, :, :]
-            # layers expect channels to come second
-            x = torch.permute(x, (0, 3, 1, 2))
-            print(f"Feeding step {step}, size {x.size()}")
-            for i in range(self.num_layers):
-                # all cells are initialized in the first step
-                name = "cell{}".format(i)
-                if step == 0:
-                    # bsize, _, height, width, num_feats = x.size()
-                    if i == 0:
-                        layer_type = "first"
-                    elif i == (self.num_layers - 1):
-                        layer_type = "last"
-                    else:
-                        layer_type = None
-                    (h, c) = getattr(self, name).init_hidden(
-                        batch_size=bsize, layer_type=layer_type, shape=(height, width)
-                    )  # TODO: check output dimensionality!
-                    internal_state.append((h, c))
-
-                # do forward
-                (h, c) = internal_state[i]
-                print("h", h.size())
-                print("c", c.size())
-                x, new_c = getattr(self, name)(x, h, c)
-                internal_state[i] = (x, new_c)
-            # only record effective steps
-            # if step in self.effective_step:
-            #    outputs.append(x)
-
-        # second -> use last state to predict desired time steps into the future
-
-        internal_state_pred = []
+                for in_channels, out_channels in zip([self.num_input_vars] + hidden_channels[:-1], hidden_channels)
+            ]
+        )
+        self.readout = nn.Conv2d(hidden_channels[-1], self.num_output_vars, kernel_size=1)
+        to_default_device(self)
+
+    def forward(self, X: Tensor) -> Tensor:
+        # X: (batch_size, time, lon, lat, in_vars) if channels_last else (batch_size, time, in_vars, lon, lat)
+        x = X.permute((0, 1, 4, 2, 3)) if self.channels_last else X
+
+        states = [None] * len(self.cells)
         outputs = []
-        for step in range(self.step):
-            # x = X
-            for i in range(self.num_layers):
-                # all cells are initialized in the first step
-                name = "cell{}".format(i)
-
-                if step == 0:
-                    # use latest internal state
-                    internal_state_pred.append(internal_state[-1])
-
-                # do forward
-                (h, c) = internal_state_pred[i]
-                x, new_c = getattr(self, name)(x, h, c)
-                internal_state_pred[i] = (x, new_c)
-            # only record effective steps
-            if step in self.effective_step:
-                outputs.append(x)
-
-        return outputs  # only outputting states -> list with len number effective steps
+        for t in range(x.shape[1]):
+            inputs = x[:, t]
+            for i, cell in enumerate(self.cells):
+                h, c = cell.init_hidden(inputs) if states[i] is None else states[i]
+                states[i] = cell(inputs, h, c)
+                inputs = states[i][0]
+            outputs.append(inputs)
+
+        if not self.seq_to_seq:
+            outputs = outputs[-1:]
+        # the readout of all (kept) time steps at once: (batch_size * time, hidden, lon, lat)
+        y = self.readout(torch.stack(outputs, dim=1).flatten(0, 1))
+        y = y.unflatten(0, (X.shape[0], len(outputs)))
+        if self.channels_last:
+            y = y.permute((0, 1, 3, 4, 2))
+
+        # (batch_size, time/1, lon, lat, out_vars) if channels_last else (batch_size, time/1, out_vars, lon, lat)
+        return y.nan_to_num()
@@ -1,4 +1,5 @@
-from typing import Sequence, Optional, Dict, Union, List
+import time
+from typing import Any, Iterable, Sequence, Optional, Dict, Tuple, Union, List
 
 import numpy as np
 import torch
@@ -8,10 +9,14 @@ from torch import Tensor
 
 import segmentation_models_pytorch as smp
 from torch.autograd import Variable
+from torch.utils.checkpoint import checkpoint as torch_checkpoint
 import numpy as np
 import gpytorch
 
+from emulator.src.core.losses import MLL
 from emulator.src.core.models.basemodel import BaseModel
+from emulator.src.core.models.eof import EOFProjection, ReiterableBatches
+from emulator.src.utils.utils import to_default_device
 
 
 class ApproxGPModel(gpytorch.models.ApproximateGP):
@@ -39,49 +44,315 @@ class ApproxGPModel(gpytorch.models.ApproximateGP):
         )
 
         self.covar_module = gpytorch.kernels.ScaleKernel(
-            gpytorch.kernels.MaternKernel(nu=1.5, batch_shape=torch.Size([num_tasks])),
+            gpytorch.kernels.MaternKernel(
+                nu=1.5, ard_num_dims=inducing_points.size(-1), batch_shape=torch.Size([num_tasks])
+            ),
             batch_shape=torch.Size([num_tasks]),
         )
 
+    @property
+    def inducing_points(self) -> nn.Parameter:
+        return self.variational_strategy.base_variational_strategy.inducing_points
+
     def forward(self, x):
         mean_x = self.mean_module(x)
         covar_x = self.covar_module(x)
         return gpytorch.distributions.MultivariateNormal(mean_x, covar_x)
 
 
-class GaussianProcess(BaseModel):
+class EOFBaseline(BaseModel):
     """
-    Problem: needs x and y for initialization....
+    Base class of the baselines on compressed inputs and outputs, as in ClimateBench, which predict every time step
+    from a few global features.
+
+    Every time step is one sample: the global means of the input variables, optionally with the coefficients of
+    their leading EOFs (e.g. for the spatial patterns of the aerosols) and the position of the time step in the
+    sequence (the month), standardized. Each output variable is compressed to the coefficients of its num_eofs
+    leading EOFs (see EOFProjection), which the model predicts, and which are reconstructed to fields by predict.
+
+    The EOFs and the feature statistics are computed by fit_compression from the training data, which is done in
+    setup if it was not called before (or restored from a checkpoint). It then passes the features and coefficients of
+    the training data to fit_features. Subclasses implement fit_features and predict_coefficients.
     """
 
-    def __init__(self, in_var_ids: List[str], out_var_ids: List[str], *args, **kwargs):
+    def __init__(
+        self,
+        in_var_ids: List[str],
+        out_var_ids: List[str],
+        num_eofs: int = 16,
+        num_input_eofs: int = 0,
+        time_features: bool = True,
+        lon: int = 32,
+        lat: int = 32,
+        seq_to_seq: bool = True,
+        seq_len: int = 12,
+        channels_last: bool = True,
+        datamodule_config: DictConfig = None,
+        *args,
+        **kwargs,
+    ):
         """
-        train_x: a minibatch (or more) of data used for the initialization
+        Args:
+            num_eofs (int): Number of EOFs of each output variable.
+            num_input_eofs (int): Number of EOFs of each input variable used as features, besides its global mean.
+            time_features (bool): If True, the position of the time step in the sequence is a feature (sin and cos).
         """
-        # super().__init__(datamodule_config=datamodule_config, *args, **kwargs)
-        super().__init__()
-        self.num_out_var = len(out_var_ids)
-        self.first_run = True
+        super().__init__(datamodule_config=datamodule_config, *args, **kwargs)
+        if self.super_emulation:
+            raise ValueError(
+                f"{type(self).__name__} emulates a single climate model, super_emulation is not supported."
+            )
 
-    def forward(self, x: Tensor) -> Tensor:
-        if self.first_run:
-            self.model = ApproxGPModel(inducing_points=x, num_tasks=self.num_out_var)
-            self.likelihood = gpytorch.likelihoods.MultitaskGaussianLikelihood(
-                num_tasks=self.num_out_var
+        self.channels_last = channels_last
+        self.lon = lon
+        self.lat = lat
+        self.seq_len = seq_len
+        if datamodule_config is not None:
+            if datamodule_config.get("channels_last") is not None:
+                self.channels_last = datamodule_config.get("channels_last")
+            if datamodule_config.get("lon") is not None:
+                self.lon = datamodule_config.get("lon")
+            if datamodule_config.get("lat") is not None:
+                self.lat = datamodule_config.get("lat")
+            if datamodule_config.get("seq_len") is not None:
+                self.seq_len = datamodule_config.get("seq_len")
+        self.seq_to_seq = seq_to_seq
+
+        self.num_input_vars = len(in_var_ids)
+        self.num_output_vars = len(out_var_ids)
+        self.num_eofs = num_eofs
+        self.num_input_eofs = num_input_eofs
+        self.time_features = time_features
+        self.num_features = self.num_input_vars * (1 + num_input_eofs) + (2 if time_features else 0)
+
+        self.output_projection = EOFProjection(
+            self.num_output_vars, (self.lon, self.lat), num_eofs, channels_last=self.channels_last
+        )
+        if num_input_eofs > 0:
+            self.input_projection = EOFProjection(
+                self.num_input_vars, (self.lon, self.lat), num_input_eofs, channels_last=self.channels_last
             )
-            self.first_run = False
+        else:
+            self.input_projection = None
+        self.register_buffer("feature_mean", torch.zeros(self.num_features))
+        self.register_buffer("feature_std", torch.ones(self.num_features))
+        # number of training points (time steps), 0 until the compression is fit
+        self.register_buffer("num_train_points", torch.tensor(0, dtype=torch.long))
+
+    def _raw_features(self, X: Tensor) -> Tensor:
+        # (batch_size, time/1, num_features)
+        x = X.permute((0, 1, 4, 2, 3)) if self.channels_last else X
+        features = [x.flatten(-2).mean(dim=-1)]
+        if self.input_projection is not None:
+            features.append(self.input_projection.compress(X).flatten(-2))
+        if self.time_features:
+            angle = 2 * np.pi * torch.arange(x.shape[1], device=x.device, dtype=x.dtype) / self.seq_len
+            angle = angle.view(1, -1, 1).expand(x.shape[0], -1, -1)
+            features += [torch.sin(angle), torch.cos(angle)]
+        features = torch.cat(features, dim=-1)
+        return features if self.seq_to_seq else features[:, -1:]
+
+    def get_features(self, X: Tensor) -> Tensor:
+        """The standardized features (num_points, num_features) of the predicted time steps of X."""
+        return ((self._raw_features(X) - self.feature_mean) / self.feature_std).flatten(0, 1)
+
+    def compress_targets(self, Y: Tensor) -> Tensor:
+        """The standardized EOF coefficients (num_points, out_vars * num_eofs) of the targets Y."""
+        return self.output_projection.compress(Y).flatten(0, 1).flatten(1)
+
+    @torch.no_grad()
+    def fit_compression(self, batches: Iterable):
+        """
+        Fit the EOFs of the outputs (and inputs) and the feature statistics to the training data, and pass the features
+        and EOF coefficients of the training data to fit_features.
+
+        Args:
+            batches: Iterable (several times, e.g. a dataloader) of training batches (X, Y, ...).
+        """
+        self.output_projection.fit(ReiterableBatches(batches, lambda batch: (batch[1], None)))
+        if self.input_projection is not None:
+            self.input_projection.fit(ReiterableBatches(batches, lambda batch: (batch[0], None)))
+
+        device = self.feature_mean.device
+        features, coefficients = [], []
+        for batch in batches:
+            features.append(self._raw_features(batch[0].to(device)).flatten(0, 1))
+            coefficients.append(self.compress_targets(batch[1].to(device)))
+        features, coefficients = torch.cat(features), torch.cat(coefficients)
+        self.log_text.info(f"Fitting {type(self).__name__} to {features.shape[0]} training points.")
+        self.feature_mean.copy_(features.mean(dim=0))
+        self.feature_std.copy_(features.std(dim=0).nan_to_num().clamp_min(1e-6))
+        self.fit_features((features - self.feature_mean) / self.feature_std, coefficients)
+        self.num_train_points.fill_(features.shape[0])
+
+    def fit_features(self, features: Tensor, coefficients: Tensor):
+        """
+        Called by fit_compression with the standardized features (num_points, num_features) and EOF coefficients
+        (num_points, out_vars * num_eofs) of the training data.
+        """
+        raise NotImplementedError
 
-        x = x.reshape(x.size(0), -1)
-        return self.model(x)
+    def predict_coefficients(self, features: Tensor) -> Tensor:
+        """The standardized EOF coefficients (num_points, out_vars * num_eofs) of the features."""
+        raise NotImplementedError
 
+    def setup(self, stage: Optional[str] = None) -> None:
+        if stage == "fit" and self.num_train_points == 0:
+            self.fit_compression(self.train_batches())
+        super().setup(stage)
 
-class RandomForest(BaseModel):
-    def _init__(self):
-        pass
+    def forward(self, X: Tensor) -> Tensor:
+        coefficients = self.predict_coefficients(self.get_features(X))
+        # (batch_size, time/1, out_vars, num_eofs)
+        return coefficients.reshape(X.shape[0], -1, self.num_output_vars, self.num_eofs).nan_to_num()
 
-    def forward(self, x: Tensor) -> Tensor:
+
+class GaussianProcess(EOFBaseline):
+    """
+    Sparse variational Gaussian process (SVGP) emulator on compressed inputs and outputs, see EOFBaseline.
+
+    The EOF coefficients are fit by independent GPs with num_inducing inducing points each, trained on minibatches
+    with the variational ELBO. So the cost of a step does not grow with the size of the training set or the grid,
+    and the fields are predicted from the posterior mean coefficients. The inducing points are initialized to random
+    training points by fit_compression.
+    """
+
+    def __init__(self, in_var_ids: List[str], out_var_ids: List[str], num_inducing: int = 256, *args, **kwargs):
+        """
+        Args:
+            num_inducing (int): Number of inducing points of each GP.
+        """
+        super().__init__(in_var_ids, out_var_ids, *args, **kwargs)
+        self.save_hyperparameters()
+
+        num_tasks = self.num_output_vars * self.num_eofs
+        self.model = ApproxGPModel(
+            inducing_points=torch.randn(num_tasks, num_inducing, self.num_features), num_tasks=num_tasks
+        )
+        self.likelihood = gpytorch.likelihoods.MultitaskGaussianLikelihood(num_tasks=num_tasks, rank=0)
+        to_default_device(self)
+
+    def fit_features(self, features: Tensor, coefficients: Tensor):
+        # initial inducing points: random training points, shared by all GPs (with a little jitter for duplicates)
+        inducing_points = self.model.inducing_points
+        num_inducing = inducing_points.shape[-2]
+        idx = torch.randperm(features.shape[0])[:num_inducing]
+        idx = idx[torch.arange(num_inducing) % len(idx)]
+        inducing_points.copy_(features[idx.to(features.device)] + 1e-3 * torch.randn_like(inducing_points))
+
+    def predict_coefficients(self, features: Tensor) -> Tensor:
+        # the posterior mean
+        return self.model(features).mean
+
+    def training_step(self, batch: Any, batch_idx: int):
+        X, Y = batch[0], batch[1]
+        output = self.model(self.get_features(X))
+        # the ELBO is not kept as a submodule, which would register the GP and likelihood parameters twice
+        loss = MLL(self, num_data=int(self.num_train_points))(output, self.compress_targets(Y))
+        self.log_dict({"train/loss": loss, "train/noise": self.likelihood.task_noises.mean()})
+        return {"loss": loss}
+
+
+class RandomForest(EOFBaseline):
+    """
+    Tree ensemble emulator on compressed inputs and outputs, see EOFBaseline, trained in seconds.
+
+    One scikit-learn ensemble per output variable regresses the coefficients of its EOFs on the features of the
+    training data, all in fit_compression, with its trees (or gradient boosted regressors, one per coefficient)
+    built in parallel on n_jobs cores. The training epoch itself does nothing, so training stops after the first
+    epoch, and the ensembles are stored in the state dict (as its extra state).
+    """
+
+    ESTIMATORS = ["random_forest", "extra_trees", "gradient_boosting"]
+    # estimator_kwargs named differently by an estimator, so that the same config works for all of them
+    ESTIMATOR_KWARG_ALIASES = {"gradient_boosting": {"n_estimators": "max_iter"}}
+
+    def __init__(
+        self,
+        in_var_ids: List[str],
+        out_var_ids: List[str],
+        estimator: str = "random_forest",
+        estimator_kwargs: Optional[Dict[str, Any]] = None,
+        n_jobs: int = -1,
+        random_state: Optional[int] = 0,
+        *args,
+        **kwargs,
+    ):
+        """
+        Args:
+            estimator (str): "random_forest", "extra_trees" or "gradient_boosting" (histogram-based).
+            estimator_kwargs (dict): Passed on to the scikit-learn estimator, e.g. n_estimators or max_depth.
+                n_estimators is the number of boosting iterations (max_iter) for gradient boosting.
+            n_jobs (int): Number of cores to fit on, -1 for all.
+            random_state (int): Seed of the estimators.
+        """
+        super().__init__(in_var_ids, out_var_ids, *args, **kwargs)
+        if estimator not in self.ESTIMATORS:
+            raise ValueError(f"Unknown estimator {estimator}, choose one of {self.ESTIMATORS}.")
+        self.save_hyperparameters()
+        self.estimator = estimator
+        self.estimator_kwargs = dict(estimator_kwargs or {})
+        self.n_jobs = n_jobs
+        self.random_state = random_state
+        # one fitted scikit-learn estimator per output variable
+        self.estimators: List[Any] = []
+        self.automatic_optimization = False
+
+    def _make_estimator(self):
+        try:
+            from sklearn.ensemble import ExtraTreesRegressor, HistGradientBoostingRegressor, RandomForestRegressor
+            from sklearn.multioutput import MultiOutputRegressor
+        except ImportError:
+            raise ImportError("The RandomForest requires scikit-learn, install it with `pip install scikit-learn`.")
+        aliases = self.ESTIMATOR_KWARG_ALIASES.get(self.estimator, {})
+        kwargs = dict(random_state=self.random_state, **{aliases.get(k, k): v for k, v in self.estimator_kwargs.items()})
+        regressor = {
+            "random_forest": RandomForestRegressor,
+            "extra_trees": ExtraTreesRegressor,
+            "gradient_boosting": HistGradientBoostingRegressor,
+        }[self.estimator]
+        unknown = sorted(set(kwargs) - set(regressor().get_params()))
+        if unknown:
+            raise ValueError(f"Unknown estimator_kwargs {unknown} for the {self.estimator} estimator.")
+        if self.estimator == "gradient_boosting":
+            # gradient boosting fits a single output, so one regressor per EOF coefficient
+            return MultiOutputRegressor(regressor(**kwargs), n_jobs=self.n_jobs)
+        return regressor(n_jobs=self.n_jobs, **kwargs)
+
+    def fit_features(self, features: Tensor, coefficients: Tensor):
+        features = features.cpu().numpy()
+        coefficients = coefficients.reshape(-1, self.num_output_vars, self.num_eofs).cpu().numpy()
+        self.estimators = []
+        for i in range(self.num_output_vars):
+            start_time = time.time()
+            self.estimators.append(self._make_estimator().fit(features, coefficients[:, i]))
+            self.log_text.info(f"Fit the {self.estimator} of output variable {i} in {time.time() - start_time:.1f}s.")
+
+    def predict_coefficients(self, features: Tensor) -> Tensor:
+        if not self.estimators:
+            raise RuntimeError("The estimators are not fit yet, train the model or call fit_compression first.")
+        features = features.cpu().numpy()
+        coefficients = np.stack([estimator.predict(features) for estimator in self.estimators], axis=1)
+        return torch.as_tensor(coefficients, dtype=self.feature_mean.dtype, device=self.feature_mean.device)
+
+    def configure_optimizers(self):
+        # nothing to optimize, the estimators are fit in fit_compression
         return None
 
+    def training_step(self, batch: Any, batch_idx: int):
+        return None
+
+    def on_train_epoch_end(self):
+        super().on_train_epoch_end()
+        self.trainer.should_stop = True
+
+    def get_extra_state(self) -> Dict[str, Any]:
+        # part of the state dict, so that every way of reloading the weights also restores the estimators
+        return {"estimators": self.estimators}
+
+    def set_extra_state(self, state: Dict[str, Any]) -> None:
+        self.estimators = state["estimators"]
+
 
 class CNNLSTM_ClimateBench(BaseModel):
     """As converted from tf to torch, adapted from ClimateBench.
@@ -119,15 +390,28 @@ class CNNLSTM_ClimateBench(BaseModel):
         seq_len: int = 10,
         dropout: float = 0.0,
         channels_last=True,
+        time_chunk_size: Optional[int] = None,
+        checkpoint_time_chunks: bool = False,
+        num_eofs: Optional[int] = None,
         datamodule_config: DictConfig = None,
         *args,
         **kwargs,
     ):
+        """
+        time_chunk_size and checkpoint_time_chunks split the convolutional encoder, which is applied to every time
+        step, into chunks of time steps, optionally recomputing their activations in the backward pass. See
+        TimeDistributed for the memory/compute trade-off.
+
+        With num_eofs, the readout predicts the coefficients of the leading num_eofs EOFs of every output variable
+        instead of the fields (see EOFProjection), which predict reconstructs.
+        """
         super().__init__(datamodule_config=datamodule_config, *args, **kwargs)
 
         self.num_input_vars = len(in_var_ids)
         self.num_output_vars = len(out_var_ids)
         self.channels_last = channels_last
+        self.time_chunk_size = time_chunk_size
+        self.checkpoint_time_chunks = checkpoint_time_chunks
 
         if datamodule_config is not None:
             if datamodule_config.get("channels_last") is not None:
@@ -151,6 +435,19 @@ class CNNLSTM_ClimateBench(BaseModel):
 
         self.save_hyperparameters()
 
+        self.num_eofs = num_eofs
+        if num_eofs is not None:
+            self.output_projection = EOFProjection(
+                self.num_output_vars,
+                (self.lon, self.lat),
+                num_eofs,
+                climate_models=datamodule_config.get("train_models") if self.super_emulation else None,
+                channels_last=self.channels_last,
+            )
+            num_outputs_per_var = num_eofs
+        else:
+            num_outputs_per_var = lon * lat
+
         self.model = torch.nn.Sequential(
             # nn.Input(shape=(slider, width, height, num_input_vars)),
             TimeDistributed(
@@ -176,11 +473,10 @@ class CNNLSTM_ClimateBench(BaseModel):
             nn.ReLU(),
             nn.Linear(
                 in_features=lstm_hidden_size,
-                out_features=self.num_output_vars * lon * lat,
+                out_features=self.num_output_vars * num_outputs_per_var,
             ),
         )
-        device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
-        self.model.to(device)
+        to_default_device(self.model)
 
     def forward(self, X):
         x = X
@@ -189,7 +485,14 @@ class CNNLSTM_ClimateBench(BaseModel):
                 (0, 1, 4, 2, 3)
             )  # torch con2d expects channels before height and witdth
 
-        x = self.model(x)
+        # the time distributed encoder (conv, relu, pooling) in chunks of time steps, then the lstm and readout
+        x = apply_in_time_chunks(
+            self.model[:4], x, chunk_size=self.time_chunk_size, checkpoint=self.checkpoint_time_chunks
+        )
+        x = self.model[4:](x)
+        if self.num_eofs is not None:
+            # (batch_size, time/1, out_vars, num_eofs)
+            return x.reshape(X.shape[0], self.out_seq_len, self.num_output_vars, self.num_eofs).nan_to_num()
         x = torch.reshape(
             x, (X.shape[0], self.out_seq_len, self.num_output_vars, self.lon, self.lat)
         )
@@ -200,36 +503,82 @@ class CNNLSTM_ClimateBench(BaseModel):
         return x
 
 
+def apply_in_time_chunks(fn, *args, chunk_size: Optional[int] = None, checkpoint: bool = False, **kwargs):
+    """
+    Apply fn to chunks of ``chunk_size`` time steps of the inputs (bs, seq_len, ...) and concatenate the outputs
+    along time, optionally recomputing the activations of every chunk in the backward pass (see TimeDistributed).
+    fn must treat the time steps independently.
+    """
+    seq_len = args[0].shape[1]
+    chunk_size = chunk_size or seq_len
+    checkpoint = checkpoint and torch.is_grad_enabled()
+    if chunk_size >= seq_len and not checkpoint:
+        return fn(*args, **kwargs)
+    out = []
+    for start in range(0, seq_len, chunk_size):
+        chunk = [x[:, start : start + chunk_size] for x in args]
+        if checkpoint:
+            out.append(torch_checkpoint(fn, *chunk, use_reentrant=False, **kwargs))
+        else:
+            out.append(fn(*chunk, **kwargs))
+    return torch.cat(out, dim=1)
+
+
 class TimeDistributed(nn.Module):
-    "Applies a module over tdim identically for each step"
+    """
+    Applies a module over tdim identically for each step.
+
+    The time steps are folded into the batch dimension, i.e. the module runs on (bs * steps, ...) at once. To bound
+    the activation memory, the sequence can be split into chunks of ``chunk_size`` steps that run one after the other
+    (``low_mem`` is the same as ``chunk_size=1``). This only bounds the memory of inference: for training, the
+    activations of all chunks are kept for the backward pass, unless ``checkpoint`` is set. Then only the inputs of
+    every chunk are kept and its activations are recomputed in the backward pass, trading about one more forward
+    pass of the module for an activation memory of a single chunk.
 
-    def __init__(self, module, low_mem=False, tdim=1):
+    Modules with batch statistics (e.g. BatchNorm in training mode) see chunks of bs * chunk_size samples, and with
+    ``checkpoint`` their running statistics are updated again when the chunks are recomputed.
+    """
+
+    def __init__(self, module, low_mem=False, tdim=1, chunk_size: Optional[int] = None, checkpoint: bool = False):
+        """
+        Args:
+            module (nn.Module): Module applied to every time step.
+            low_mem (bool): Apply the module to one time step after the other.
+            tdim (int): Time dimension of the inputs.
+            chunk_size (int): Number of time steps per call of the module, None for all at once.
+            checkpoint (bool): Recompute the activations of every chunk in the backward pass instead of keeping them.
+        """
         super(TimeDistributed, self).__init__()
         self.module = module
         self.low_mem = low_mem
         self.tdim = tdim
+        self.chunk_size = 1 if low_mem else chunk_size
+        self.checkpoint = checkpoint
+
+    def _forward_steps(self, *args, **kwargs):
+        "inputs with shape: (bs, steps, ...), the steps are folded into the batch"
+        bs, seq_len = args[0].shape[0], args[0].shape[1]
+        out = self.module(*[x.reshape(bs * seq_len, *x.shape[2:]) for x in args], **kwargs)
+        return out.view(bs, seq_len, *out.shape[1:])
 
     def forward(self, *args, **kwargs):
         "input x with shape:(bs,seq_len,channels,width,height)"
-        if self.low_mem or self.tdim != 1:
-            return self.low_mem_forward(*args)
-        else:
-            # only support tdim=1
-            inp_shape = args[0].shape
-            bs, seq_len = inp_shape[0], inp_shape[1]
-            out = self.module(
-                *[x.view(bs * seq_len, *x.shape[2:]) for x in args], **kwargs
-            )
-            out_shape = out.shape
-            return out.view(bs, seq_len, *out_shape[1:])
+        if self.tdim != 1:
+            args = [x.movedim(self.tdim, 1) for x in args]
+        out = apply_in_time_chunks(
+            self._forward_steps, *args, chunk_size=self.chunk_size, checkpoint=self.checkpoint, **kwargs
+        )
+        if self.tdim != 1:
+            out = out.movedim(1, self.tdim)
+        return out
 
     def low_mem_forward(self, *args, **kwargs):
-        "input x with shape:(bs,seq_len,channels,width,height)"
+        "input x with shape:(bs,seq_len,channels,width,height), one time step after the other"
         tlen = args[0].shape[self.tdim]
         args_split = [torch.unbind(x, dim=self.tdim) for x in args]
         out = []
         for i in range(tlen):
-            out.append(self.module(*[args[i] for args in args_split]), **kwargs)
+            out.append(self.module(*[x_split[i] for x_split in args_split], **kwargs))
         return torch.stack(out, dim=self.tdim)
 
     def __repr__(self):
@@ -251,6 +600,31 @@ class extract_tensor(nn.Module):
         return tensor
 
 
+class SeparableReadout(nn.Module):
+    """
+    Learned linear remap of (batch, time, vars, lon_in, lat_in) to (batch, time, vars, lon, lat) at linear memory cost,
+    factorized into a lon projection (lon x lon_in), a lat projection (lat x lat_in) and a mixing of the time steps and
+    variables (time*vars x time*vars), plus a bias for every output.
+
+    This is a dense linear layer whose weight is the Kronecker product of the three factors, i.e. the "linear" readout
+    restricted to separable remaps. The projections are initialized to crop the last lon and lat rows (the UNet pads
+    at the start) and the mixing to the identity, so the readout starts as a crop.
+    """
+
+    def __init__(self, seq_len: int, num_vars: int, lon_in: int, lat_in: int, lon: int, lat: int):
+        super().__init__()
+        self.lon_proj = nn.Parameter(torch.eye(lon_in)[lon_in - lon :])
+        self.lat_proj = nn.Parameter(torch.eye(lat_in)[lat_in - lat :])
+        self.mixing = nn.Parameter(torch.eye(seq_len * num_vars))
+        self.bias = nn.Parameter(torch.zeros(seq_len, num_vars, lon, lat))
+
+    def forward(self, x: Tensor) -> Tensor:
+        b, t, c = x.shape[:3]
+        x = self.lon_proj @ x @ self.lat_proj.T  # b, t, c, lon, lat
+        x = torch.einsum("kl,blij->bkij", self.mixing, x.flatten(1, 2)).unflatten(1, (t, c))
+        return x + self.bias
+
+
 class UNet(BaseModel):
     """
     https://github.com/elena-orlova/SSF-project
@@ -271,9 +645,20 @@ class UNet(BaseModel):
         seq_to_seq: bool = True,
         seq_len: int = 1,
         readout: str = "pooling",
+        time_chunk_size: Optional[int] = None,
+        checkpoint_time_chunks: bool = False,
         *args,
         **kwargs,
     ):
+        """
+        readout maps the UNet outputs on the padded grid back to the original grid:
+            "pooling": adaptive average pooling.
+            "separable": a learned linear remap factorized into lon, lat and time/variable projections
+                (SeparableReadout), with linear memory cost.
+            "linear": a dense linear layer over all outputs, quadratic in their number, only for small grids.
+        time_chunk_size and checkpoint_time_chunks run the UNet on chunks of time steps, optionally recomputing their
+        activations in the backward pass. See TimeDistributed for the memory/compute trade-off.
+        """
         super().__init__(datamodule_config=datamodule_config, *args, **kwargs)
 
         if datamodule_config is not None:
@@ -313,7 +698,9 @@ class UNet(BaseModel):
                         in_channels=self.num_input_vars,
                         classes=self.num_output_vars,
                         activation=activation_function,
-                    )
+                    ),
+                    chunk_size=time_chunk_size,
+                    checkpoint=checkpoint_time_chunks,
                 ),
                 torch.nn.Flatten(),
                 torch.nn.Linear(
@@ -329,6 +716,32 @@ class UNet(BaseModel):
                 ),  # map back to original size
             )
 
+        elif readout == "separable":
+            self.model = torch.nn.Sequential(
+                torch.nn.ConstantPad2d(
+                    (pad_lat, 0, pad_lon, 0), 0
+                ),  # zero padding along lon and lat
+                TimeDistributed(
+                    smp.Unet(
+                        encoder_name=encoder_name,
+                        encoder_weights=None,
+                        in_channels=self.num_input_vars,
+                        classes=self.num_output_vars,
+                        activation=activation_function,
+                    ),
+                    chunk_size=time_chunk_size,
+                    checkpoint=checkpoint_time_chunks,
+                ),
+                SeparableReadout(
+                    self.seq_len,
+                    self.num_output_vars,
+                    self.lon + pad_lon,
+                    self.lat + pad_lat,
+                    self.lon,
+                    self.lat,
+                ),  # map back to original size
+            )
+
         elif readout == "pooling":
             self.model = torch.nn.Sequential(
                 torch.nn.ConstantPad2d(
@@ -341,7 +754,9 @@ class UNet(BaseModel):
                         in_channels=self.num_input_vars,
                         classes=self.num_output_vars,
                         activation=activation_function,
-                    )
+                    ),
+                    chunk_size=time_chunk_size,
+                    checkpoint=checkpoint_time_chunks,
                 ),
                 torch.nn.AdaptiveAvgPool3d(
                     output_size=(self.num_output_vars, self.lon, self.lat)
@@ -350,12 +765,11 @@ class UNet(BaseModel):
 
         else:
             self.log_text.warn(
-                f"Readout {readout} is not supported. Pls choose either 'linear' or 'pooling'"
+                f"Readout {readout} is not supported. Pls choose either 'pooling', 'separable' or 'linear'"
             )
             raise NotImplementedError
 
-        device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
-        self.model.to(device)
+        to_default_device(self.model)
 
     def forward(self, x: Tensor) -> Tensor:
         # x: (batch_size, sequence_length, lon, lat, in_vars) if channels_last else (batch_size, sequence_lenght, in_vars, lon, lat)
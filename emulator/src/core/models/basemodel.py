@@ -13,6 +13,7 @@ from pytorch_lightning import LightningModule
 import torch
 
 from emulator.src.core.evaluation import evaluate_preds, evaluate_per_target_variable
+from emulator.src.core.models.eof import EOFProjection, ReiterableBatches
 from emulator.src.utils.utils import get_loss_function, get_logger, to_DictConfig
 
 # from emulator.src.utils.interface import reload_model_from_id
@@ -64,6 +65,10 @@ class BaseModel(LightningModule):
         self.log_text.info(f"Super Emulation: {self.super_emulation}")
         self.super_decoder = super_decoder
         self.log_text.info(f"Super Decoder: {self.super_decoder}")
+        # set from the datamodule if it normalizes on the device, used to denormalize predictions for evaluation
+        self.output_normalizer = None
+        # set by models predicting EOF coefficients instead of fields, used to reconstruct the fields of predictions
+        self.output_projection = None
 
         if datamodule_config is not None:
             # get information from data config
@@ -84,11 +89,36 @@ class BaseModel(LightningModule):
         return sum(p.numel() for p in self.parameters() if p.requires_grad)
 
     def _apply(self, fn):
+        # the output normalizer is a submodule (without persistent buffers), so it is moved along
         super(BaseModel, self)._apply(fn)
-        # if self.output_normalizer is not None:
-        #    self.output_normalizer.apply_torch_func(fn)
         return self
 
+    def setup(self, stage: Optional[str] = None) -> None:
+        datamodule = getattr(self.trainer, "datamodule", None)
+        normalizer = getattr(datamodule, "normalizer", None)
+        if normalizer is not None:
+            self.log_text.info("Using the normalizer of the datamodule to denormalize predictions for evaluation.")
+            self.output_normalizer = normalizer
+        if stage == "fit":
+            # EOFs of the outputs (also of wrapped models) not fit or restored from a checkpoint yet
+            for module in self.modules():
+                projection = getattr(module, "output_projection", None)
+                if isinstance(projection, EOFProjection) and not projection.is_fitted:
+                    self.log_text.info(f"Fitting the EOFs of the outputs of {type(module).__name__} to the training data.")
+                    batches = ReiterableBatches(
+                        self.train_batches(), lambda batch: (batch[1], batch[2] if len(batch) > 2 else None)
+                    )
+                    projection.fit(batches)
+
+    def train_batches(self) -> ReiterableBatches:
+        """The training batches of the datamodule, transformed on the device as in training (e.g. normalized)."""
+        datamodule = getattr(self.trainer, "datamodule", None)
+        if datamodule is None:
+            raise ValueError(f"{type(self).__name__} is fit to the training data of a datamodule, none was given.")
+        return ReiterableBatches(
+            datamodule.train_dataloader(), lambda batch: datamodule.on_after_batch_transfer(batch, 0)
+        )
+
     def forward(self, X):
         """
         Downstream model forward pass, input X will be the (batched) output from self.input_transform
@@ -108,7 +138,7 @@ class BaseModel(LightningModule):
         #     self.tracker.start()
         self._start_epoch_time = time.time()
 
-    def predict(self, X, idx, *args, **kwargs):
+    def predict(self, X, idx, *args, denormalize: bool = False, **kwargs):
         # x (batch_size, time, lon, lat, num_features)
         # TODO if we want to apply any input normalization or other stuff we should do it here
         # if idx is None or if we do not have a decoder
@@ -119,8 +149,13 @@ class BaseModel(LightningModule):
         else:
             preds = self(X)
 
-        # TODO if we want to apply any output normalization we should do it here
-        # else we will just return raw predictions
+        # the fields of the EOF coefficients, if the model predicts them
+        if self.output_projection is not None:
+            preds = self.output_projection.reconstruct(preds, idx)
+
+        # back to physical units if the data is normalized on the device
+        if denormalize and self.output_normalizer is not None:
+            preds = self.output_normalizer.denormalize_output(preds, idx)
 
         # splitting predictions to get dict accessible via target var id
         preds_dict = self.output_postprocesser.split_vector_by_variable(preds)
@@ -195,11 +230,12 @@ class BaseModel(LightningModule):
             X, Y = batch
             idx = None
 
-        preds = self.predict(X, idx)
+        # evaluate in physical units
+        preds = self.predict(X, idx, denormalize=True)
+        if self.output_normalizer is not None:
+            Y = self.output_normalizer.denormalize_output(Y, idx)
         ret = {"targets": Y, "preds": preds}
 
-        self.val_step_outputs.append(ret)
-
         return ret
 
     def _evaluation_get_preds(
@@ -233,7 +269,9 @@ class BaseModel(LightningModule):
         self._start_validation_epoch_time = time.time()
 
     def validation_step(self, batch: Any, batch_idx: int, dataloader_idx: int = None):
-        return self._evaluation_step(batch, batch_idx)
+        ret = self._evaluation_step(batch, batch_idx)
+        self.val_step_outputs.append(ret)  # collect for evaluation
+        return ret
 
     def on_validation_epoch_end(self) -> dict:
         val_time = time.time() - self._start_validation_epoch_time
@@ -298,41 +336,31 @@ class BaseModel(LightningModule):
 
     def aggregate_predictions(
         self, results: List[Any]
-    ) -> Dict[int, Dict[str, Dict[str, np.ndarray]]]:
+    ) -> Dict[str, Dict[str, Dict[str, np.ndarray]]]:
         """
         Args:
          results: The list that pl.Trainer() returns when predicting, i.e.
                         results = trainer.predict(model, datamodule)
         Returns:
             A dict mapping prediction_set_name_i -> {'targets': t_i, 'preds': p_i}
-                for each prediction subset i .
-                E.g.: To access the shortwave heating rate predictions for year 2012:
+                for each prediction subset i, named as the test sets of the datamodule (scenario_climate-model).
+                E.g.: To access the surface temperature predictions for SSP2-4.5 of NorESM2-LM:
                     model, datamodule, trainer = ...
-                    datamodule.predict_years = "2012"
                     results = trainer.predict(model, datamodule)
                     results = model.aggregate_predictions(results)
-                    sw_hr_preds_2012 = results[2012]['preds']['hrsc']
+                    tas_preds = results['ssp245_NorESM2-LM']['preds']['tas']
         """
         if not isinstance(results[0], list):
             results = [results]  # when only a single predict dataloader is passed
+        pred_set_names = getattr(self.trainer.datamodule, "test_set_names", None)
+        if pred_set_names is None or len(pred_set_names) != len(results):
+            pred_set_names = [str(i) for i in range(len(results))]
         per_subset_outputs = dict()
-        for pred_set_name, predict_subset_outputs in zip(
-            self.trainer.datamodule.predict_years, results
-        ):
-            Y, preds = self._evaluation_get_preds(predict_subset_outputs)
-            per_subset_outputs[pred_set_name]["preds"] = preds
-            per_subset_outputs[pred_set_name]["targets"] = Y
+        for pred_set_name, predict_subset_outputs in zip(pred_set_names, results):
+            per_subset_outputs[pred_set_name] = self._evaluation_get_preds(predict_subset_outputs)
         return per_subset_outputs
 
-    def predict_step(self, batch: Any, batch_idx: int, dataloader_idx: int = None):
-        return self._evaluation_step(batch, batch_idx)
-
-    def on_predict_epoch_end(
-        self, results: List[Any]
-    ) -> Dict[int, Dict[str, Dict[str, np.ndarray]]]:
-        return self.aggregate_predictions(results)
-
-    def predict_step(self, batch: Any, batch_idx: int, dataloader_idx: int = None):
+    def predict_step(self, batch: Any, batch_idx: int, dataloader_idx: int = 0):
         return self._evaluation_step(batch, batch_idx)
 
     def configure_optimizers(self):
@@ -1,4 +1,4 @@
-from typing import Any, Dict, List, Union
+from typing import Any, Dict, List, Optional, Union
 
 import numpy as np
 import torch
@@ -7,12 +7,13 @@ from emulator.src.core.models.climax.tokenized_vit_continuous import (
     TokenizedViTContinuous,
 )
 from emulator.src.core.models.basemodel import BaseModel
+from emulator.src.core.models.eof import EOFProjection
 
 from emulator.src.utils.pos_embed import (
     interpolate_channel_embed,
     interpolate_pos_embed,
 )
-from emulator.src.utils.utils import get_logger
+from emulator.src.utils.utils import get_logger, load_checkpoint, load_state_dict_assign, to_default_device
 
 from torchvision.transforms import transforms
 
@@ -20,44 +21,43 @@ from omegaconf import DictConfig
 
 
 def get_region_info(lat_range, lon_range, lat, lon, patch_size):
-    lat = lat[::-1]  # -90 to 90 from south (bottom) to north (top)
-    h, w = len(lat), len(lon)
-    lat_matrix = np.expand_dims(lat, axis=1).repeat(w, axis=1)
-    lon_matrix = np.expand_dims(lon, axis=0).repeat(h, axis=0)
-    valid_cells = (
-        (lat_matrix >= lat_range[0])
-        & (lat_matrix <= lat_range[1])
-        & (lon_matrix >= lon_range[0])
-        & (lon_matrix <= lon_range[1])
-    )
-    h_ids, w_ids = np.nonzero(valid_cells)
-    h_from, h_to = h_ids[0], h_ids[-1]
-    w_from, w_to = w_ids[0], w_ids[-1]
-    patch_idx = -1
+    """
+    The patches of the grid that lie entirely within the bounding box of the grid cells of a region.
+
+    Args:
+        lat_range (tuple): (min, max) latitude of the region.
+        lon_range (tuple): (min, max) longitude of the region.
+        lat (array): The latitudes of the grid rows, in the order of the rows (north to south or south to north).
+        lon (array): The longitudes of the grid columns, in the order of the columns.
+        patch_size (int): The patch size of the model.
+
+    Returns:
+        dict: patch_ids, the ids of the patches (a rectangle of patches, in row-major order), and min_h, max_h, min_w,
+            max_w, the first and last grid row and column they cover.
+    """
+    # indexes of the grid rows and columns themselves, the coordinates only have to be monotonic
+    lat = np.asarray(lat)
+    lon = np.asarray(lon)
+    h_ids = np.nonzero((lat >= lat_range[0]) & (lat <= lat_range[1]))[0]
+    w_ids = np.nonzero((lon >= lon_range[0]) & (lon <= lon_range[1]))[0]
+    if len(h_ids) == 0 or len(w_ids) == 0:
+        raise ValueError(f"No grid cells within the latitudes {lat_range} and longitudes {lon_range}.")
     p = patch_size
-    valid_patch_ids = []
-    min_h, max_h = 1e5, -1e5
-    min_w, max_w = 1e5, -1e5
-    for i in range(0, h, p):
-        for j in range(0, w, p):
-            patch_idx += 1
-            if (
-                (i >= h_from)
-                & (i + p - 1 <= h_to)
-                & (j >= w_from)
-                & (j + p - 1 <= w_to)
-            ):
-                valid_patch_ids.append(patch_idx)
-                min_h = min(min_h, i)
-                max_h = max(max_h, i + p - 1)
-                min_w = min(min_w, j)
-                max_w = max(max_w, j + p - 1)
+    # first grid row and column of every patch, the valid patches are a rectangle of valid rows and columns
+    patch_h, patch_w = np.arange(0, len(lat), p), np.arange(0, len(lon), p)
+    valid_h = np.nonzero((patch_h >= h_ids[0]) & (patch_h + p - 1 <= h_ids[-1]))[0]
+    valid_w = np.nonzero((patch_w >= w_ids[0]) & (patch_w + p - 1 <= w_ids[-1]))[0]
+    if len(valid_h) == 0 or len(valid_w) == 0:
+        raise ValueError(
+            f"The region of latitudes {lat_range} and longitudes {lon_range} contains no full patch of {p}x{p} cells."
+        )
+    patch_ids = (valid_h[:, None] * len(patch_w) + valid_w[None, :]).flatten()
     return {
-        "patch_ids": valid_patch_ids,
-        "min_h": min_h,
-        "max_h": max_h,
-        "min_w": min_w,
-        "max_w": max_w,
+        "patch_ids": patch_ids,
+        "min_h": int(patch_h[valid_h[0]]),
+        "max_h": int(patch_h[valid_h[-1]] + p - 1),
+        "min_w": int(patch_w[valid_w[0]]),
+        "max_w": int(patch_w[valid_w[-1]] + p - 1),
     }
 
 
@@ -87,6 +87,8 @@ class ClimaX(BaseModel):
         pretrained_path: str = None,
         region_info=None,  # TODO: maybe later we could actually include that
         channels_last: bool = False,
+        checkpoint_every_k_blocks: int = 0,
+        num_eofs: Optional[int] = None,
         *args,
         **kwargs,
     ):
@@ -140,18 +142,32 @@ class ClimaX(BaseModel):
             init_mode=init_mode,
             freeze_encoder=freeze_encoder,
             time_aggregation=not (no_time_aggregation),
+            checkpoint_every_k_blocks=checkpoint_every_k_blocks,
+            num_eofs=num_eofs,
         )
+        if num_eofs is not None:
+            # the head predicts the coefficients of the EOFs of the outputs, reconstructed to fields by predict
+            self.output_projection = EOFProjection(
+                len(self.out_vars),
+                (self.lon, self.lat),
+                num_eofs,
+                climate_models=datamodule_config.get("train_models") if self.super_emulation else None,
+                channels_last=self.channels_last,
+            )
 
         if pretrained_path is not None:
             if len(pretrained_path) > 0:
                 self.load_mae_weights(pretrained_path)
 
-        device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
-        self.model.to(device)
+        to_default_device(self.model)
 
     def load_mae_weights(self, pretrained_path):
+        if any(p.is_meta for p in self.parameters()):
+            # built on the meta device to reload a trained checkpoint, which overwrites the pretrained weights anyway
+            return
         self.log_text.info("Loading pre-trained checkpoint from: %s" % pretrained_path)
-        checkpoint = torch.load(pretrained_path, map_location=torch.device("cpu"))
+        # memory-mapped, the kept tensors are assigned instead of copied into the initialized weights
+        checkpoint = load_checkpoint(pretrained_path, map_location=torch.device("cpu"))
 
         checkpoint_model = checkpoint["state_dict"]
         # interpolate positional embedding
@@ -177,17 +193,40 @@ class ClimaX(BaseModel):
                 del checkpoint_model[k]
 
         # load pre-trained model
-        msg = self.load_state_dict(checkpoint_model, strict=False)
+        msg = load_state_dict_assign(self, checkpoint_model, strict=False)
         self.log_text.info(msg)
 
-    def forward(self, x):
+    def get_region_info(self, lat_range, lon_range, lat, lon) -> Dict[str, Any]:
+        """
+        The patches of a region (see get_region_info) for regional inference with ``forward(x, region_info)``, with
+        the patch ids on the device of the model.
+
+        Args:
+            lat_range (tuple): (min, max) latitude of the region.
+            lon_range (tuple): (min, max) longitude of the region.
+            lat (array): The latitudes of the grid rows, of length datamodule.lon (the first spatial dim).
+            lon (array): The longitudes of the grid columns, of length datamodule.lat (the second spatial dim).
+        """
+        region_info = get_region_info(lat_range, lon_range, lat, lon, self.get_patch_size())
+        region_info["patch_ids"] = torch.as_tensor(region_info["patch_ids"], device=self.model.channel_ids.device)
+        return region_info
+
+    def forward(self, x, region_info: Optional[Dict[str, Any]] = None):
+        """
+        Args:
+            x (Tensor): The inputs, of the whole grid.
+            region_info (dict): If given (see ``get_region_info``), only the patches of the region are embedded, run
+                through the transformer and decoded, and the predictions are of the region, i.e. the grid rows
+                min_h to max_h and columns min_w to max_w.
+        """
         if self.channels_last:
             x = x.permute((0, 1, 4, 2, 3))
 
-        lead_times = torch.zeros(x.shape[0]).to(
-            x.device
-        )  #  zero leadtimes for climate modelling task #TODO: remove?
-        x = self.model.forward(x, lead_times)
+        # zero lead times for the climate modelling task
+        x = self.model.forward(x, lead_times=None, region_info=region_info)
+        if self.output_projection is not None:
+            # B, 1, C, num_eofs
+            return x.nan_to_num()
         if self.channels_last:
             x = x.permute((0, 1, 3, 4, 2))
         x = x.nan_to_num()
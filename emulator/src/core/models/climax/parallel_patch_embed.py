@@ -0,0 +1,78 @@
+""" Patch embedding of all input variables in a single batched matmul.
+Following the ParallelVarPatchEmbed of the ClimaX repository.
+https://github.com/microsoft/ClimaX/blob/main/src/climax/parallelpatchembed.py
+"""
+import math
+import re
+from typing import Optional
+
+import torch
+import torch.nn as nn
+
+# keys of the former per variable embeddings, an nn.ModuleList of timm PatchEmbeds: token_embeds.<var id>.proj.<param>
+PER_VARIABLE_KEY = re.compile(r"^(?P<var_id>\d+)\.proj\.(?P<param>weight|bias)$")
+
+
+class ParallelVarPatchEmbed(nn.Module):
+    """
+    Embeds each input variable (a 1 x H x W channel) into patch tokens with its own linear layer, for all variables at
+    once: x: (N, C, H, W) is unfolded into its p x p patches, which are embedded by one batched matmul over the
+    variables into (N, C, L, D), where L = (H / p) * (W / p). Measured on CPU, this is faster than a Conv2d with
+    groups=C, and than one Conv2d per variable.
+
+    Equivalent to one timm PatchEmbed(img_size, patch_size, 1, embed_dim) per variable, whose checkpoints
+    (token_embeds.<var id>.proj.weight/bias) are converted on load.
+    """
+
+    def __init__(self, num_vars: int, img_size=[128, 256], patch_size: int = 16, embed_dim: int = 1024):
+        super().__init__()
+        self.num_vars = num_vars
+        self.img_size = img_size
+        self.patch_size = patch_size
+        self.embed_dim = embed_dim
+        self.grid_size = (img_size[0] // patch_size, img_size[1] // patch_size)
+        self.num_patches = self.grid_size[0] * self.grid_size[1]
+
+        self.proj_weights = nn.Parameter(torch.empty(num_vars, embed_dim, 1, patch_size, patch_size))
+        self.proj_biases = nn.Parameter(torch.empty(num_vars, embed_dim))
+        self.reset_parameters()
+        self._register_load_state_dict_pre_hook(self._convert_per_variable_state_dict)
+
+    def reset_parameters(self):
+        # as nn.Conv2d, per variable
+        for i in range(self.num_vars):
+            nn.init.kaiming_uniform_(self.proj_weights[i], a=math.sqrt(5))
+        bound = 1 / math.sqrt(self.patch_size**2)
+        nn.init.uniform_(self.proj_biases, -bound, bound)
+
+    def _convert_per_variable_state_dict(self, state_dict, prefix, *args):
+        """Stack the weights and biases of per variable PatchEmbeds (prefix<var id>.proj.*) into the fused ones."""
+        per_variable = {"weight": {}, "bias": {}}
+        for key in list(state_dict.keys()):
+            if not key.startswith(prefix):
+                continue
+            match = PER_VARIABLE_KEY.match(key[len(prefix) :])
+            if match is not None:
+                per_variable[match.group("param")][int(match.group("var_id"))] = state_dict.pop(key)
+        for param, name in [("weight", "proj_weights"), ("bias", "proj_biases")]:
+            if per_variable[param]:
+                tensors = per_variable[param]
+                state_dict[prefix + name] = torch.stack([tensors[i] for i in sorted(tensors)])
+
+    def forward(self, x: torch.Tensor, var_ids: Optional[torch.Tensor] = None) -> torch.Tensor:
+        """
+        Args:
+            x (Tensor): (N, C, H, W)
+            var_ids (Tensor): The variable of each of the C channels, defaults to all variables in order.
+
+        Returns:
+            Tensor: (N, C, L, D)
+        """
+        weights, biases = self.proj_weights, self.proj_biases
+        if var_ids is not None:
+            weights, biases = weights[var_ids], biases[var_ids]
+        n, c, h, w = x.shape
+        p = self.patch_size
+        # N, C, H, W -> N, C, L, pxp, with the patches in row-major order as the outputs of a strided conv
+        patches = x.reshape(n, c, h // p, p, w // p, p).permute(0, 1, 2, 4, 3, 5).reshape(n, c, -1, p * p)
+        return torch.einsum("nclk,cdk->ncld", patches, weights.flatten(2)) + biases.unsqueeze(1)
@@ -10,11 +10,13 @@
 import numpy as np
 import torch
 import torch.nn as nn
+from torch.utils.checkpoint import checkpoint
+from emulator.src.core.models.climax.parallel_patch_embed import ParallelVarPatchEmbed
 from emulator.src.utils.pos_embed import (
     get_1d_sincos_pos_embed_from_grid,
     get_2d_sincos_pos_embed,
 )
-from timm.models.vision_transformer import Block, PatchEmbed, trunc_normal_
+from timm.models.vision_transformer import Block, trunc_normal_
 
 
 class TokenizedBase(nn.Module):
@@ -34,6 +36,7 @@ class TokenizedBase(nn.Module):
         init_mode="xavier",  # xavier or small
         in_vars=["pr", "tas"],
         channel_agg="mean",
+        checkpoint_every_k_blocks=0,  # 0 keeps the activations of all blocks
     ):
         super().__init__()
 
@@ -41,15 +44,11 @@ class TokenizedBase(nn.Module):
         self.patch_size = patch_size
         self.init_mode = init_mode
         self.in_vars = in_vars
+        self.checkpoint_every_k_blocks = checkpoint_every_k_blocks
 
-        # separate linear layers to embed each token, which is 1xpxp
-        self.token_embeds = nn.ModuleList(
-            [
-                PatchEmbed(img_size, patch_size, 1, embed_dim)
-                for i in range(len(in_vars))
-            ]
-        )
-        self.num_patches = self.token_embeds[0].num_patches
+        # separate linear layers to embed each token, which is 1xpxp, applied to all variables in one batched matmul
+        self.token_embeds = ParallelVarPatchEmbed(len(in_vars), img_size, patch_size, embed_dim)
+        self.num_patches = self.token_embeds.num_patches
 
         # positional embedding and channel embedding
         self.pos_embed = nn.Parameter(
@@ -58,6 +57,10 @@ class TokenizedBase(nn.Module):
         self.channel_embed, self.channel_map = self.create_channel_embedding(
             learn_pos_emb, embed_dim
         )
+        # ids of the input variables in order, on the device of the model
+        self.register_buffer(
+            "channel_ids", torch.arange(len(in_vars)), persistent=False
+        )
 
         self.pos_drop = nn.Dropout(p=drop_rate)
 
@@ -73,9 +76,8 @@ class TokenizedBase(nn.Module):
         else:
             raise NotImplementedError
 
-        dpr = [
-            x.item() for x in torch.linspace(0, drop_path, depth)
-        ]  # stochastic depth decay rule
+        # stochastic depth decay rule, on the cpu also when the model is built on the meta device
+        dpr = torch.linspace(0, drop_path, depth, device="cpu").tolist()
         self.blocks = nn.ModuleList(
             [
                 Block(
@@ -105,8 +107,10 @@ class TokenizedBase(nn.Module):
         return channel_embed, channel_map
 
     def get_channel_ids(self, vars):
-        ids = np.array([self.channel_map[var] for var in vars])
-        return torch.from_numpy(ids)
+        if list(vars) == list(self.in_vars):
+            return self.channel_ids
+        ids = [self.channel_map[var] for var in vars]
+        return torch.tensor(ids, device=self.channel_ids.device)
 
     def get_channel_emb(self, channel_emb, vars):
         ids = self.get_channel_ids(vars)
@@ -129,8 +133,8 @@ class TokenizedBase(nn.Module):
             torch.from_numpy(channel_embed).float().unsqueeze(0)
         )
 
-        for i in range(len(self.token_embeds)):
-            w = self.token_embeds[i].proj.weight.data
+        for i in range(self.token_embeds.num_vars):
+            w = self.token_embeds.proj_weights.data[i]
             if self.init_mode == "xavier":
                 torch.nn.init.xavier_uniform_(w.view([w.shape[0], -1]))
             else:
@@ -180,6 +184,23 @@ class TokenizedBase(nn.Module):
 
         return x_masked, mask, ids_restore
 
+    def forward_blocks(self, x):
+        """
+        Apply the transformer blocks to x: [N, L, D].
+
+        With checkpoint_every_k_blocks = k > 0, the activations of every k-th block (starting with the first) are not
+        kept for the backward pass but recomputed from the block's input, trading about 1/k of an extra forward pass
+        through the blocks for their activation memory (k = 1 checkpoints all blocks). Only applies when gradients
+        are computed, the random state is restored on recompute so that dropout and drop path are the same.
+        """
+        k = self.checkpoint_every_k_blocks
+        for i, blk in enumerate(self.blocks):
+            if k > 0 and i % k == 0 and torch.is_grad_enabled():
+                x = checkpoint(blk, x, use_reentrant=False)
+            else:
+                x = blk(x)
+        return x
+
     def forward_encoder(self, x):
         pass
 
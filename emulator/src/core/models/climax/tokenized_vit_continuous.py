@@ -18,6 +18,10 @@ from emulator.src.utils.pos_embed import (
 )
 
 
+def _update_embed_cache_hook(module, incompatible_keys):
+    module.update_embed_cache()
+
+
 class TokenizedViTContinuous(TokenizedBase):
     def __init__(
         self,
@@ -43,6 +47,8 @@ class TokenizedViTContinuous(TokenizedBase):
         freeze_encoder: bool = False,
         time_aggregation: bool = False,
         nonlinear_head: bool = False,  # linear or nonlinear readout
+        checkpoint_every_k_blocks: int = 0,
+        num_eofs: Optional[int] = None,  # with time aggregation, predict EOF coefficients instead of the fields
     ):
         super().__init__(
             img_size,
@@ -57,14 +63,17 @@ class TokenizedViTContinuous(TokenizedBase):
             init_mode,
             in_vars,
             channel_agg,
+            checkpoint_every_k_blocks,
         )
 
         self.climate_modeling = climate_modeling
+        self.learn_pos_emb = learn_pos_emb
         self.freeze_encoder = freeze_encoder
         self.time_history = time_history
         self.img_size = img_size
         self.in_vars = in_vars
         self.out_vars = out_vars
+        self.num_eofs = num_eofs
 
         self.time_pos_embed = nn.Parameter(
             torch.zeros(1, time_history, embed_dim), requires_grad=learn_pos_emb
@@ -81,10 +90,10 @@ class TokenizedViTContinuous(TokenizedBase):
             self.time_agg = nn.MultiheadAttention(
                 embed_dim, num_heads, batch_first=True
             )
-            self.head = nn.Linear(
-                embed_dim, len(self.out_vars) * img_size[0] * img_size[1]
-            )
+            num_outputs_per_var = num_eofs if num_eofs is not None else img_size[0] * img_size[1]
+            self.head = nn.Linear(embed_dim, len(self.out_vars) * num_outputs_per_var)
         else:
+            assert num_eofs is None, "EOF coefficients are only predicted with time aggregation."
             self.time_agg = None
             self.head = nn.ModuleList()
             if nonlinear_head:
@@ -99,6 +108,16 @@ class TokenizedViTContinuous(TokenizedBase):
         self.lead_time_embed = nn.Linear(1, embed_dim)
 
         self.initialize_weights()
+        if climate_modeling:
+            # lead times are always zero, so the embedding is its bias and the weight cannot affect the outputs,
+            # frozen so that it is not an unused parameter under DDP (and not decayed by the optimizer)
+            self.lead_time_embed.weight.requires_grad_(False)
+
+        # the fixed embeddings of the input variables, updated whenever weights are loaded
+        self.register_buffer("cached_channel_embed", None, persistent=False)
+        self.register_buffer("cached_pos_time_embed", None, persistent=False)
+        self.update_embed_cache()
+        self.register_load_state_dict_post_hook(_update_embed_cache_hook)
 
         if freeze_encoder:
             for name, p in self.blocks.named_parameters():
@@ -120,6 +139,32 @@ class TokenizedViTContinuous(TokenizedBase):
             torch.from_numpy(time_pos_embed).float().unsqueeze(0)
         )
 
+    def get_pos_time_embed(self, channel_embed: torch.Tensor) -> torch.Tensor:
+        """
+        The embeddings added after the channel aggregation, pos_embed + time_pos_embed: 1, T, L, D.
+        With mean aggregation, this includes the channel embedding (channel_embed: 1, C, D), since the mean over
+        the channels of x + channel_embed is the mean of x plus the mean of channel_embed.
+        """
+        embed = self.pos_embed.unsqueeze(1) + self.time_pos_embed.unsqueeze(2)
+        if self.channel_agg is None:
+            embed = embed + channel_embed.mean(1)[:, None, None]
+        return embed
+
+    def update_embed_cache(self):
+        """
+        Precompute the channel embeddings of the input variables and their sum with the positional and time
+        embeddings, if these are not learned (learn_pos_emb=False), so that every step adds a single tensor.
+        Called on init and after loading weights, which also materializes the buffers of models built on the meta
+        device, since they are not saved.
+        """
+        self.channel_ids = torch.arange(len(self.in_vars), device=self.channel_embed.device)
+        if self.learn_pos_emb:
+            return
+        with torch.no_grad():
+            channel_embed = self.get_channel_emb(self.channel_embed, self.in_vars)
+            self.cached_channel_embed = channel_embed.unsqueeze(2)  # 1, C, 1, D
+            self.cached_pos_time_embed = self.get_pos_time_embed(channel_embed)  # 1, T, L, D
+
     def unpatchify(self, x, h=None, w=None):
         """
         x: (B, L, patch_size**2 *3)
@@ -145,9 +190,9 @@ class TokenizedViTContinuous(TokenizedBase):
         x = x.flatten(0, 1)  # BxL, C, D
 
         if self.channel_agg is not None:
-            channel_query = self.channel_query.repeat_interleave(x.shape[0], dim=0)
-            x, _ = self.channel_agg(channel_query, x, x)  # BxL, D
-            x = x.squeeze()
+            channel_query = self.channel_query.expand(x.shape[0], -1, -1)
+            x, _ = self.channel_agg(channel_query, x, x)  # BxL, 1, D
+            x = x.squeeze(1)
         else:
             x = torch.mean(x, dim=1)  # BxL, D
 
@@ -164,61 +209,68 @@ class TokenizedViTContinuous(TokenizedBase):
     def forward_encoder(self, x, lead_times, variables, region_info):
         """
         x: B, T, C, H, W
+        lead_times: B, or None for zero lead times (climate modeling)
+        region_info: None, or the patches of a region (see get_region_info in climax_module.py), to embed, encode and
+            decode only these, returning B, T, C, max_h - min_h + 1, max_w - min_w + 1
         """
         b, t, _, _, _ = x.shape
+        if region_info is not None:
+            if self.time_agg is not None:
+                raise NotImplementedError("Regional inference needs a model without time aggregation.")
+            # the patches of a region are a rectangle, in the same row-major order as the patches of the grid
+            h = region_info["max_h"] - region_info["min_h"] + 1
+            w = region_info["max_w"] - region_info["min_w"] + 1
+            x = x[..., region_info["min_h"] : region_info["max_h"] + 1, region_info["min_w"] : region_info["max_w"] + 1]
+        else:
+            h, w = self.img_size
         x = x.flatten(0, 1)  # BxT, C, H, W
 
         # embed tokens
-        embeds = []
         var_ids = self.get_channel_ids(variables)
-        for i in range(len(var_ids)):
-            id = var_ids[i]
-            embeds.append(self.token_embeds[id](x[:, i : i + 1]))
-        x = torch.stack(embeds, dim=1)  # BxT, C, L, D
+        x = self.token_embeds(x, var_ids)  # BxT, C, L, D
 
-        # add channel embedding, channel_embed: 1, C, D
-        channel_embed = self.get_channel_emb(self.channel_embed, variables)
+        # channel_embed: 1, C, D, included in pos_time_embed with mean aggregation
+        if self.cached_pos_time_embed is not None and var_ids is self.channel_ids:
+            channel_embed = self.cached_channel_embed.squeeze(2)
+            pos_time_embed = self.cached_pos_time_embed
+        else:
+            channel_embed = self.get_channel_emb(self.channel_embed, variables)
+            pos_time_embed = self.get_pos_time_embed(channel_embed)
 
-        x = x + channel_embed.unsqueeze(2)  # BxT, C, L, D
+        if self.channel_agg is not None:
+            x = x + channel_embed.unsqueeze(2)  # BxT, C, L, D
 
         if region_info is not None:
-            valid_patch_ids = region_info["patch_ids"]
-            x = x[:, :, valid_patch_ids, :]
+            pos_time_embed = pos_time_embed[:, :, region_info["patch_ids"], :]
 
         x = self.aggregate_channel(x)  # BxT, L, D
 
         x = x.unflatten(0, sizes=(b, t))  # B, T, L, D
 
-        # add time and pos embed
-        # pos emb: 1, L, D
-
-        if region_info is not None:
-            x = x + self.pos_embed[:, valid_patch_ids, :].unsqueeze(1)
+        # add pos emb (1, 1, L, D), time emb (1, T, 1, D) and lead time embedding (B, 1, 1, D) at once
+        if lead_times is None:
+            # the embedding of zero lead times is the bias of the linear layer
+            lead_time_emb = self.lead_time_embed.bias
         else:
-            x = x + self.pos_embed.unsqueeze(1)
-        # time emb: 1, T, D
-        x = x + self.time_pos_embed.unsqueeze(2)
-
-        # add lead time embedding
-        lead_time_emb = self.lead_time_embed(lead_times.unsqueeze(-1))  # B, D
-
-        lead_time_emb = lead_time_emb.unsqueeze(1).unsqueeze(2)  # B, 1, 1, D
-        x = x + lead_time_emb
+            lead_time_emb = self.lead_time_embed(lead_times.unsqueeze(-1))  # B, D
+            lead_time_emb = lead_time_emb.unsqueeze(1).unsqueeze(2)  # B, 1, 1, D
+        x = x + (pos_time_embed + lead_time_emb)
         x = x.flatten(0, 1)  # BxT, L, D
         x = self.pos_drop(x)
 
         # apply Transformer blocks
-        for blk in self.blocks:
-            x = blk(x)
+        x = self.forward_blocks(x)
         x = self.norm(x)  # BxT, L, D
 
         if self.time_agg is not None:
             x = x.unflatten(0, sizes=(b, t))  # B, T, L, D
             x = x.mean(-2)  # B, T, D TODO Why would they mean over l??
-            time_query = self.time_query.repeat_interleave(x.shape[0], dim=0)
+            time_query = self.time_query.expand(x.shape[0], -1, -1)
             x, _ = self.time_agg(time_query, x, x)  # B, 1, D
             x = self.head(x)
-            x = self.unpatchify(x)
+            if self.num_eofs is not None:
+                return x.reshape(-1, 1, len(self.out_vars), self.num_eofs)  # B, 1, C, num_eofs
+            # the head maps to the whole grid (not to patches), C x H x W
             x = x.reshape(
                 -1, 1, len(self.out_vars), self.img_size[0], self.img_size[1]
             )  # B, 1, H, W
@@ -226,11 +278,9 @@ class TokenizedViTContinuous(TokenizedBase):
         else:
             x = self.head(x)
             x = self.unpatchify(
-                x
+                x, h, w
             )  # TODO not supported for grid sizes not divisible by patch size
-            x = x.reshape(
-                b, t, len(self.out_vars), self.img_size[0], self.img_size[1]
-            )  # B T C H W
+            x = x.reshape(b, t, len(self.out_vars), h, w)  # B T C H W
 
         return x
 
@@ -243,17 +293,8 @@ class TokenizedViTContinuous(TokenizedBase):
         return preds
 
     def predict(self, x, lead_times, region_info: Optional[Union[Dict, None]] = None):
-        if region_info is not None:
-            min_h, max_h = region_info["min_h"], region_info["max_h"]
-            min_w, max_w = region_info["min_w"], region_info["max_w"]
         with torch.no_grad():
-            pred = self.forward_encoder(x, lead_times, self.in_vars, region_info)
-            # pred = self.head(embeddings)[:, -len(region_info['patch_ids']) :]
-        return pred
-        # return self.unpatchify(pred, max_h - min_h + 1, max_w - min_w + 1)
-        # pred = pred.unflatten(dim=1, sizes=(-1, self.num_patches))  # [B, C, L, p*p]
-        # pred = pred.flatten(0, 1)  # [BxC, L, p*p]
-        # return self.unpatchify(pred, variables)
+            return self.forward_encoder(x, lead_times, self.in_vars, region_info)
 
     def rollout(
         self,
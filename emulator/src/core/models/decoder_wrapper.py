@@ -24,6 +24,9 @@ class DecoderWrapper(BaseModel):
     def forward(self, x, model_num):
         # model num: (batch_size) (can be different for each batch item)
         out = self.model(x)
+        if self.model.output_projection is not None:
+            # the decoder maps fields, of the EOF coefficients of the model
+            out = self.model.output_projection.reconstruct(out, model_num)
 
         if self.channels_last:
             out = out.permute((0, 1, 4, 2, 3))
@@ -0,0 +1,223 @@
+""" Compression of the output fields to the coefficients of their leading EOFs (empirical orthogonal functions, the
+principal components of the fields over time), so that emulators predict a few coefficients per time step and variable
+instead of the full grid.
+"""
+from typing import Callable, Iterable, List, Optional, Sequence, Tuple
+
+import torch
+import torch.distributed as dist
+import torch.nn as nn
+from torch import Tensor
+
+
+def _sum_over_ranks(*tensors: Tensor) -> Tuple[Tensor, ...]:
+    """Sum the tensors over all ranks of the process group (if distributed), e.g. the EOF fit accumulators of shards."""
+    if not (dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1):
+        return tensors
+    # nccl can only reduce device tensors
+    device = torch.device("cuda", torch.cuda.current_device()) if dist.get_backend() == "nccl" else torch.device("cpu")
+    reduced = []
+    for tensor in tensors:
+        summed = tensor.to(device)
+        dist.all_reduce(summed, op=dist.ReduceOp.SUM)
+        reduced.append(summed.to(tensor.device))
+    return tuple(reduced)
+
+
+class ReiterableBatches:
+    """Batches that can be iterated over several times, e.g. of a dataloader, optionally mapped by fn."""
+
+    def __init__(self, batches: Iterable, fn: Optional[Callable] = None):
+        self.batches = batches
+        self.fn = fn
+
+    def __iter__(self):
+        for batch in self.batches:
+            yield self.fn(batch) if self.fn is not None else batch
+
+
+class EOFProjection(nn.Module):
+    """
+    Truncated EOF basis of each output variable, per climate model, to compress fields to EOF coefficients and
+    reconstruct them. The coefficients are standardized (divided by their standard deviation over the training data).
+
+    The basis is fit by a streaming randomized SVD over batches of training targets (see fit), which keeps a sketch of
+    (num_eofs + oversampling) x grid cells per climate model and variable instead of the targets, so any number of
+    climate models, members and years fits in memory.
+
+    Args:
+        num_vars (int): Number of variables.
+        shape (tuple): The grid (lon, lat).
+        num_eofs (int): Number of EOFs of every variable.
+        climate_models (list): Names of the climate models with a basis each, as the model ids of the batches. Defaults
+            to one basis for all data.
+        channels_last (bool): Whether the variables are the last dimension of the fields, else the third last.
+        oversampling (int): Additional directions of the random sketch, which make the leading EOFs more accurate.
+        niter (int): Power iterations of the randomized SVD, one more pass over the data each.
+        seed (int): Seed of the random sketch.
+    """
+
+    def __init__(
+        self,
+        num_vars: int,
+        shape: Tuple[int, int],
+        num_eofs: int,
+        climate_models: Optional[Sequence[str]] = None,
+        channels_last: bool = False,
+        oversampling: int = 16,
+        niter: int = 1,
+        seed: int = 0,
+    ):
+        super().__init__()
+        self.num_vars = num_vars
+        self.shape = tuple(shape)
+        self.num_eofs = num_eofs
+        self.climate_models = list(climate_models) if climate_models is not None else None
+        self.channels_last = channels_last
+        self.oversampling = oversampling
+        self.niter = niter
+        self.seed = seed
+        num_models = len(self.climate_models) if self.climate_models is not None else 1
+        num_cells = self.shape[0] * self.shape[1]
+
+        self.register_buffer("mean", torch.zeros(num_models, num_vars, num_cells))
+        self.register_buffer("eofs", torch.zeros(num_models, num_vars, num_eofs, num_cells))
+        self.register_buffer("std", torch.ones(num_models, num_vars, num_eofs))
+        # number of fields every basis was fit to, 0 until fit
+        self.register_buffer("num_samples", torch.zeros(num_models, dtype=torch.long))
+
+    @property
+    def is_fitted(self) -> bool:
+        return bool((self.num_samples > 0).any())
+
+    def _model_index(self, model_ids, batch_size: int) -> Tensor:
+        """Map the climate model names of a batch to the rows of the bases."""
+        if self.climate_models is None:
+            return torch.zeros(batch_size, dtype=torch.long, device=self.mean.device)
+        if model_ids is None:
+            raise ValueError(f"The EOFs are per climate model ({self.climate_models}), the model ids are needed.")
+        if isinstance(model_ids, str):
+            model_ids = [model_ids] * batch_size
+        try:
+            index = [self.climate_models.index(model_id) for model_id in model_ids]
+        except ValueError:
+            raise ValueError(f"No EOFs for climate models {model_ids}, only for {self.climate_models}.")
+        return torch.tensor(index, device=self.mean.device)
+
+    def _flatten(self, fields: Tensor) -> Tensor:
+        # (batch_size, time, vars, lon * lat)
+        if self.channels_last:
+            fields = fields.permute((0, 1, 4, 2, 3))
+        return fields.flatten(-2)
+
+    def compress(self, fields: Tensor, model_ids=None) -> Tensor:
+        """
+        Args:
+            fields (Tensor): (batch_size, time, lon, lat, vars) if channels_last else (batch_size, time, vars, lon, lat)
+            model_ids: The climate model of every sample (or the batch), for bases per climate model.
+
+        Returns:
+            Tensor: The standardized EOF coefficients, (batch_size, time, vars, num_eofs).
+        """
+        idx = self._model_index(model_ids, fields.shape[0])
+        y = self._flatten(fields) - self.mean[idx].unsqueeze(1)
+        coefficients = torch.einsum("btvl,bvkl->btvk", y, self.eofs[idx].to(y.dtype))
+        return coefficients / self.std[idx].unsqueeze(1).clamp_min(1e-12)
+
+    def reconstruct(self, coefficients: Tensor, model_ids=None) -> Tensor:
+        """
+        Args:
+            coefficients (Tensor): Standardized EOF coefficients, (batch_size, time, vars, num_eofs).
+            model_ids: The climate model of every sample (or the batch), for bases per climate model.
+
+        Returns:
+            Tensor: The fields, (batch_size, time, lon, lat, vars) if channels_last else (batch_size, time, vars, lon,
+                lat).
+        """
+        idx = self._model_index(model_ids, coefficients.shape[0])
+        coefficients = coefficients * self.std[idx].unsqueeze(1).to(coefficients.dtype)
+        y = torch.einsum("btvk,bvkl->btvl", coefficients, self.eofs[idx].to(coefficients.dtype))
+        y = (y + self.mean[idx].unsqueeze(1)).unflatten(-1, self.shape)
+        if self.channels_last:
+            y = y.permute((0, 1, 3, 4, 2))
+        return y
+
+    def _rows(self, fields: Tensor, model_ids) -> Tuple[Tensor, Tensor]:
+        """The fields (num_fields, vars, lon * lat) of every time step and the basis (num_fields) they belong to."""
+        idx = self._model_index(model_ids, fields.shape[0])
+        y = self._flatten(fields.to(self.mean.device))
+        return y.flatten(0, 1).float(), idx.repeat_interleave(y.shape[1])
+
+    @torch.no_grad()
+    def fit(self, batches: Iterable[Tuple[Tensor, Optional[List[str]]]]):
+        """
+        Fit the EOFs of every climate model and variable to the fields of all time steps of the batches, by a
+        randomized SVD (Halko et al., 2011) in 2 + niter passes over them:
+        the means and a random sketch of the row space of the fields, niter power iterations refining it, and the
+        Gram matrix of the fields projected onto it, whose eigenvectors give the EOFs.
+        Under DDP every rank passes over its own shard, and the sums of each pass are reduced over all ranks, so that
+        all ranks fit the same EOFs to the fields of all shards. All ranks must call this.
+
+        Args:
+            batches: Iterable (several times) of (fields, model_ids), with the fields shaped as the targets.
+        """
+        num_models, num_cells = self.mean.shape[0], self.mean.shape[-1]
+        rank = min(self.num_eofs + self.oversampling, num_cells)
+        device = self.mean.device
+        # independent gaussians on every rank, the sketches of the shards are summed
+        rank_offset = dist.get_rank() if dist.is_available() and dist.is_initialized() else 0
+        generator = torch.Generator(device="cpu").manual_seed(self.seed + rank_offset)
+        shape = (num_models, self.num_vars)
+
+        # first pass: the means, and a sketch of the row space: sum_i psi_i (y_i - mean) with gaussian psi_i
+        count = torch.zeros(num_models, dtype=torch.long, device=device)
+        total = torch.zeros(*shape, num_cells, dtype=torch.float64, device=device)
+        sketch = torch.zeros(*shape, rank, num_cells, device=device)
+        psi_total = torch.zeros(*shape, rank, device=device)
+        for fields, model_ids in batches:
+            y, idx = self._rows(fields, model_ids)
+            for m in idx.unique():
+                y_m = y[idx == m]
+                psi = torch.randn(y_m.shape[0], self.num_vars, rank, generator=generator).to(device)
+                count[m] += y_m.shape[0]
+                total[m] += y_m.sum(dim=0, dtype=torch.float64)
+                sketch[m] += torch.einsum("nvr,nvl->vrl", psi, y_m)
+                psi_total[m] += psi.sum(dim=0)
+        count, total, sketch, psi_total = _sum_over_ranks(count, total, sketch, psi_total)
+        if (count == 0).any():
+            missing = [self.climate_models[m] for m in torch.nonzero(count == 0).flatten()] if self.climate_models else []
+            raise ValueError(f"No training fields to fit the EOFs of climate models {missing}.")
+        mean = (total / count.view(-1, 1, 1)).float()
+        sketch -= psi_total.unsqueeze(-1) * mean.unsqueeze(-2)
+        basis = torch.linalg.qr(sketch.transpose(-1, -2)).Q  # models, vars, cells, rank
+
+        # power iterations: basis <- orth((Y - mean)^T (Y - mean) basis)
+        for _ in range(self.niter):
+            power = torch.zeros_like(basis)
+            for fields, model_ids in batches:
+                y, idx = self._rows(fields, model_ids)
+                for m in idx.unique():
+                    y_m = y[idx == m] - mean[m]
+                    power[m] += torch.einsum("nvl,nvr->vlr", y_m, torch.einsum("nvl,vlr->nvr", y_m, basis[m]))
+            (power,) = _sum_over_ranks(power)
+            basis = torch.linalg.qr(power).Q
+
+        # last pass: the gram matrix of the projected fields, its leading eigenvectors are the EOFs in the basis
+        gram = torch.zeros(*shape, rank, rank, dtype=torch.float64, device=device)
+        for fields, model_ids in batches:
+            y, idx = self._rows(fields, model_ids)
+            for m in idx.unique():
+                projected = torch.einsum("nvl,vlr->nvr", y[idx == m] - mean[m], basis[m]).double()
+                gram[m] += torch.einsum("nvr,nvs->vrs", projected, projected)
+        (gram,) = _sum_over_ranks(gram)
+        eigenvalues, eigenvectors = torch.linalg.eigh(gram)  # ascending
+        k = min(self.num_eofs, rank)
+        eigenvalues = eigenvalues.flip(-1)[..., :k].clamp_min(0)
+        eigenvectors = eigenvectors.flip(-1)[..., :k].float()
+
+        self.mean.copy_(mean)
+        self.eofs.zero_()
+        self.eofs[:, :, :k] = torch.einsum("mvlr,mvrk->mvkl", basis, eigenvectors)
+        self.std.zero_()
+        self.std[:, :, :k] = (eigenvalues / (count.view(-1, 1, 1) - 1).clamp_min(1)).sqrt().float()
+        self.num_samples.copy_(count)
@@ -1,6 +1,8 @@
 import torch
 import torch.nn as nn
 
+from emulator.src.utils.utils import to_default_device
+
 
 class MultiHeadDecoder(nn.Module):
     def __init__(
@@ -45,7 +47,7 @@ class MultiHeadDecoder(nn.Module):
 
             self.heads.append(head)
 
-        self.heads.to(self.device)
+        to_default_device(self.heads)
 
     def forward(self, x, model_ids):
         # model ids (str) may be multiple (batch_size, 1)
@@ -54,17 +56,12 @@ class MultiHeadDecoder(nn.Module):
         head_nums = torch.tensor([self.model_name_to_head_num[id] for id in model_ids])
 
         # head_nums (batch_size, 1)
-        unique_heads = torch.unique(head_nums)
-        self.set_active_heads(unique_heads)
-
-        # creaty empty tensor of output shape
-        y = torch.empty(
-            x.shape[0], x.shape[1], self.num_output_vars, x.shape[-2], x.shape[-1]
-        ).to(self.device)
+        if torch.is_grad_enabled():
+            unique_heads = torch.unique(head_nums)
+            self.set_active_heads(unique_heads)
 
-        # fill in values by uniqe head
-        for i, h in enumerate(head_nums):
-            y[i, :] = self.heads[h](x[i, :])
+        # apply the head of every batch item, stacked out of place so that the decoder can be vmapped over ensembles
+        y = torch.stack([self.heads[h](x[i, :]) for i, h in enumerate(head_nums)])
 
         return y
 
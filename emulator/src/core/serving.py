@@ -0,0 +1,394 @@
+import asyncio
+import base64
+import io
+import json
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+import torch
+
+from emulator.src.core.emulation import ScenarioEmulator, load_input4mips_scenario
+from emulator.src.core.sweep import OnlineReducer
+from emulator.src.data.constants import AVAILABLE_MODELS_FIRETYPE, OPENBURNING_MODEL_MAPPING
+from emulator.src.utils.utils import get_logger
+
+log = get_logger()
+
+HTTP_STATUS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 500: "Internal Server Error"}
+
+
+def encode_array(array: np.ndarray) -> Dict[str, str]:
+    """Encode an array for JSON as base64 of its .npy bytes."""
+    buffer = io.BytesIO()
+    np.save(buffer, array, allow_pickle=False)
+    return {"npy": base64.b64encode(buffer.getvalue()).decode("ascii")}
+
+
+def decode_array(encoded: Dict[str, str]) -> np.ndarray:
+    return np.load(io.BytesIO(base64.b64decode(encoded["npy"])), allow_pickle=False)
+
+
+class DynamicBatcher:
+    """
+    Coalesces the samples of concurrent requests for one model into batches.
+
+    A batch is run as soon as it holds ``max_batch_size`` samples or the oldest waiting request has waited
+    ``max_latency_ms``. The model runs in a worker thread, so the event loop keeps accepting requests meanwhile.
+    """
+
+    def __init__(self, emulator: ScenarioEmulator, max_batch_size: int = 64, max_latency_ms: float = 10.0, window: int = 1000):
+        """
+        Args:
+            emulator (ScenarioEmulator): Model, normalization and layout.
+            max_batch_size (int): Most samples (years) per forward pass, requests are never split.
+            max_latency_ms (float): Longest time a request waits for other requests to join its batch.
+            window (int): Number of most recent requests and batches the latency percentiles are computed over.
+        """
+        self.emulator = emulator
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency_ms / 1e3
+        self.queue: Optional[asyncio.Queue] = None
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self._task: Optional[asyncio.Task] = None
+        # requests taken from the queue that did not fit into the last batch
+        self._pending = deque()
+        # metrics
+        self.queued_samples = 0
+        self.num_requests = 0
+        self.num_batches = 0
+        self.num_samples = 0
+        self.request_latencies = deque(maxlen=window)
+        self.batch_latencies = deque(maxlen=window)
+        self.batch_sizes = deque(maxlen=window)
+
+    def start(self):
+        self.queue = asyncio.Queue()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self.executor.shutdown(wait=True)
+
+    async def submit(self, X: torch.Tensor, climate_model: Optional[str] = None) -> torch.Tensor:
+        """Predict the samples of one request, batched with the other waiting requests."""
+        future = asyncio.get_running_loop().create_future()
+        self.queued_samples += len(X)
+        await self.queue.put((time.perf_counter(), X, climate_model, future))
+        return await future
+
+    async def _next_batch(self) -> List[Tuple]:
+        """Wait for the requests of the next batch, in order of arrival."""
+        if not self._pending:
+            self._pending.append(await self.queue.get())
+        deadline = self._pending[0][0] + self.max_latency
+        while True:
+            while not self.queue.empty():
+                self._pending.append(self.queue.get_nowait())
+            if sum(len(request[1]) for request in self._pending) >= self.max_batch_size:
+                break
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                self._pending.append(await asyncio.wait_for(self.queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        # requests are never split, the first one that does not fit anymore opens the next batch
+        requests, size = [], 0
+        while self._pending and (not requests or size + len(self._pending[0][1]) <= self.max_batch_size):
+            request = self._pending.popleft()
+            requests.append(request)
+            size += len(request[1])
+        return requests
+
+    def _predict(self, X: torch.Tensor, model_ids: Optional[List[str]]) -> torch.Tensor:
+        return self.emulator.predict(X, model_ids).cpu()
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            requests = await self._next_batch()
+            X = torch.cat([request[1] for request in requests])
+            model_ids = [request[2] for request in requests for _ in range(len(request[1]))]
+            self.queued_samples -= len(X)
+            start = time.perf_counter()
+            try:
+                preds = await loop.run_in_executor(
+                    self.executor, self._predict, X, None if all(m is None for m in model_ids) else model_ids
+                )
+            except Exception as e:
+                for _, _, _, future in requests:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            end = time.perf_counter()
+            self.num_batches += 1
+            self.num_samples += len(X)
+            self.batch_sizes.append(len(X))
+            self.batch_latencies.append(end - start)
+            offset = 0
+            for arrival, X_request, _, future in requests:
+                if not future.done():
+                    future.set_result(preds[offset : offset + len(X_request)])
+                offset += len(X_request)
+                self.num_requests += 1
+                self.request_latencies.append(end - arrival)
+
+    def metrics(self) -> Dict[str, Any]:
+        def percentiles(seconds):
+            ms = np.asarray(seconds) * 1e3
+            if len(ms) == 0:
+                return {}
+            return {f"p{q}_ms": float(np.percentile(ms, q)) for q in (50, 90, 99)}
+
+        return {
+            "queue_depth": (self.queue.qsize() if self.queue is not None else 0) + len(self._pending),
+            "queued_samples": self.queued_samples,
+            "requests": self.num_requests,
+            "batches": self.num_batches,
+            "samples": self.num_samples,
+            "mean_batch_size": float(np.mean(self.batch_sizes)) if self.batch_sizes else 0.0,
+            "request_latency": percentiles(self.request_latencies),
+            "batch_latency": percentiles(self.batch_latencies),
+        }
+
+
+class EmulationService:
+    """
+    Local HTTP service emulating emission trajectories with one or more models, on top of asyncio only.
+
+    Endpoints:
+        GET /health: the served models.
+        GET /metrics: queue depth, request and batch counts, batch sizes and latency percentiles per model.
+        POST /emulate: emulate one trajectory, with a JSON body of the form
+            {
+                "model": "unet",                 # optional if only one model is served
+                "climate_model": "NorESM2-LM",   # for multihead decoders and per-model statistics
+                "scenario": "ssp245",            # Input4MIPs base scenario, or instead
+                "emissions": {"npy": ...},       # base64 .npy of shape (years, seq_len, vars, lon, lat), unnormalized
+                "dims": ["lat", "lon"], "lat": [...], "lon": [...],  # optional grid of the emissions
+                "years": [2015, 2100],           # years of the scenario
+                "factors": {"BC_sum": 1.5},      # scaling of the input variables
+                "ramp": false,                   # ramp the factors linearly from 1 in the first year
+                "output": "global",              # "global", "regional" or "fields"
+                "regions": {"europe": [35, 70, -10, 40]}  # lat_min, lat_max, lon_min, lon_max, for "regional"
+            }
+            It returns the annual global (and regional) means per output variable, or the fields as base64 .npy of
+            shape (years * time steps, lon, lat) per output variable.
+    """
+
+    def __init__(
+        self,
+        emulators: Dict[str, ScenarioEmulator],
+        data_dir: Optional[str] = None,
+        max_batch_size: int = 64,
+        max_latency_ms: float = 10.0,
+        default_years: Tuple[int, int] = (2015, 2100),
+    ):
+        """
+        Args:
+            emulators (dict): Name -> ScenarioEmulator of every served model.
+            data_dir (str): Root of the ClimateSet data, needed for requests with a scenario.
+            max_batch_size (int): See DynamicBatcher.
+            max_latency_ms (float): See DynamicBatcher.
+            default_years (tuple): Years of scenario requests without years.
+        """
+        self.emulators = emulators
+        self.batchers = {name: DynamicBatcher(emulator, max_batch_size, max_latency_ms) for name, emulator in emulators.items()}
+        self.data_dir = data_dir
+        self.default_years = default_years
+        # (model, scenario, openburning specs, years) -> (emissions, spatial coords)
+        self._scenarios: Dict[Tuple, Tuple[torch.Tensor, Dict[str, np.ndarray]]] = {}
+        self._scenario_locks: Dict[Tuple, asyncio.Lock] = {}
+        self._io_executor = ThreadPoolExecutor(max_workers=1)
+        self.server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self, host: str = "127.0.0.1", port: int = 8080) -> int:
+        """Start serving, returns the port (useful with port 0)."""
+        for batcher in self.batchers.values():
+            batcher.start()
+        self.server = await asyncio.start_server(self._handle_connection, host, port)
+        port = self.server.sockets[0].getsockname()[1]
+        log.info(f"Serving {list(self.emulators)} on http://{host}:{port}")
+        return port
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        for batcher in self.batchers.values():
+            await batcher.stop()
+        self._io_executor.shutdown(wait=True)
+
+    async def serve_forever(self, host: str = "127.0.0.1", port: int = 8080):
+        await self.start(host, port)
+        try:
+            await self.server.serve_forever()
+        finally:
+            await self.stop()
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    key, _, value = line.decode("latin-1").partition(":")
+                    headers[key.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                status, response = await self._dispatch(method, path, body)
+                payload = json.dumps(response).encode()
+                keep_alive = headers.get("connection", "keep-alive").lower() != "close"
+                writer.write(
+                    f"HTTP/1.1 {status} {HTTP_STATUS[status]}\r\nContent-Type: application/json\r\n"
+                    f"Content-Length: {len(payload)}\r\nConnection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode()
+                    + payload
+                )
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionResetError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def _dispatch(self, method: str, path: str, body: bytes) -> Tuple[int, Dict]:
+        path = path.split("?")[0]
+        try:
+            if path == "/health":
+                return 200, {"status": "ok", "models": list(self.emulators)}
+            if path == "/metrics":
+                return 200, {name: batcher.metrics() for name, batcher in self.batchers.items()}
+            if path == "/emulate":
+                if method != "POST":
+                    return 405, {"error": "Use POST for /emulate."}
+                return 200, await self.emulate(json.loads(body))
+            return 404, {"error": f"Unknown path {path}."}
+        except (ValueError, KeyError, FileNotFoundError) as e:
+            return 400, {"error": f"{type(e).__name__}: {e}"}
+        except Exception as e:
+            log.exception("Request failed.")
+            return 500, {"error": f"{type(e).__name__}: {e}"}
+
+    def _get_emulator(self, request: Dict) -> Tuple[str, ScenarioEmulator]:
+        name = request.get("model")
+        if name is None:
+            if len(self.emulators) > 1:
+                raise ValueError(f"Several models are served, choose one of {list(self.emulators)}.")
+            name = next(iter(self.emulators))
+        if name not in self.emulators:
+            raise ValueError(f"Model {name} is not served, choose one of {list(self.emulators)}.")
+        return name, self.emulators[name]
+
+    async def _get_scenario(self, name: str, emulator: ScenarioEmulator, scenario: str, climate_model: Optional[str], years):
+        """Read a base scenario once per model and years, in a worker thread."""
+        if self.data_dir is None:
+            raise ValueError("The service has no data directory, send the emissions instead of a scenario.")
+        openburning_specs = OPENBURNING_MODEL_MAPPING[climate_model if climate_model in AVAILABLE_MODELS_FIRETYPE else "other"]
+        key = (name, scenario, openburning_specs, tuple(years))
+        lock = self._scenario_locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            if key not in self._scenarios:
+
+                def read():
+                    emissions = load_input4mips_scenario(
+                        self.data_dir, scenario, range(years[0], years[1] + 1), emulator.in_var_ids, openburning_specs
+                    )
+                    return emulator.read_years(emissions), emulator.spatial_coords(emissions)
+
+                self._scenarios[key] = await asyncio.get_running_loop().run_in_executor(self._io_executor, read)
+        return self._scenarios[key]
+
+    async def emulate(self, request: Dict) -> Dict:
+        name, emulator = self._get_emulator(request)
+        climate_model = request.get("climate_model")
+        # before batching, an invalid request would fail the whole batch it joins
+        emulator.check_climate_model(climate_model)
+        output = request.get("output", "global")
+        if output not in ["global", "regional", "fields"]:
+            raise ValueError(f"Unknown output {output}, use global, regional or fields.")
+
+        if "emissions" in request:
+            X = torch.from_numpy(decode_array(request["emissions"]).astype(np.float32))
+            shape = X.shape[:2] if X.dim() == 5 else None
+            if shape is None or shape[1] != emulator.seq_len:
+                raise ValueError(f"The emissions need the shape (years, {emulator.seq_len}, ...), got {tuple(X.shape)}.")
+            spatial_shape = X.shape[2:4] if emulator.channels_last else X.shape[3:5]
+            # coordinates of the grid (in degrees) are optional, they are needed for area weights and regions
+            spatial_dims = request.get("dims", ["lon", "lat"])
+            spatial_coords = {
+                dim: np.asarray(request[dim], dtype=np.float64) if dim in request else np.arange(size)
+                for dim, size in zip(spatial_dims, spatial_shape)
+            }
+            years = list(range(len(X)))
+        else:
+            first_year, last_year = request.get("years", self.default_years)
+            X, spatial_coords = await self._get_scenario(name, emulator, request["scenario"], climate_model, (first_year, last_year))
+            years = list(range(first_year, last_year + 1))
+
+        factors = request.get("factors")
+        if factors:
+            unknown = [var for var in factors if var not in emulator.in_var_ids]
+            if unknown:
+                raise ValueError(f"Unknown input variables {unknown}, the model uses {emulator.in_var_ids}.")
+            scale = torch.tensor([float(factors.get(var, 1.0)) for var in emulator.in_var_ids])
+            if request.get("ramp", False):
+                weight = torch.linspace(0, 1, len(X)).unsqueeze(1) if len(X) > 1 else torch.ones(1, 1)
+                scale = 1 + weight * (scale - 1)
+            else:
+                scale = scale.expand(len(X), -1)
+            shape = (len(X), 1, 1, 1, -1) if emulator.channels_last else (len(X), 1, -1, 1, 1)
+            X = X * scale.reshape(shape)
+
+        preds = await self.batchers[name].submit(X, climate_model)
+
+        response = {"model": name, "climate_model": climate_model, "years": years}
+        if output == "fields":
+            fields = preds.reshape(-1, *preds.shape[2:]).numpy()
+            response["fields"] = {var: encode_array(fields[:, j]) for j, var in enumerate(emulator.out_var_ids)}
+            return response
+        regions = {region: tuple(box) for region, box in request.get("regions", {}).items()} if output == "regional" else None
+        reducer = OnlineReducer(1, len(preds), emulator.out_var_ids, spatial_coords, regions=regions)
+        reducer.update(preds, torch.zeros(len(preds), dtype=torch.long), torch.arange(len(preds)))
+        means = reducer.region_means[:, 0].numpy()  # (regions, years, vars)
+        response["global"] = {var: means[0, :, j].tolist() for j, var in enumerate(emulator.out_var_ids)}
+        if output == "regional":
+            response["regional"] = {
+                region: {var: means[i, :, j].tolist() for j, var in enumerate(emulator.out_var_ids)}
+                for i, region in enumerate(reducer.region_names)
+                if i > 0
+            }
+        return response
+
+
+def request_json(host: str, port: int, path: str, payload: Optional[Dict] = None, timeout: float = 60.0) -> Dict:
+    """Blocking client for the service, e.g. request_json("127.0.0.1", 8080, "/emulate", {"scenario": "ssp245"})."""
+    import http.client
+
+    connection = http.client.HTTPConnection(host, port, timeout=timeout)
+    try:
+        if payload is None:
+            connection.request("GET", path)
+        else:
+            connection.request("POST", path, body=json.dumps(payload), headers={"Content-Type": "application/json"})
+        response = connection.getresponse()
+        result = json.loads(response.read())
+        if response.status != 200:
+            raise RuntimeError(f"{response.status}: {result.get('error')}")
+        return result
+    finally:
+        connection.close()
@@ -0,0 +1,319 @@
+import itertools
+import time
+from typing import Dict, Optional, Sequence, Tuple
+
+import numpy as np
+import torch
+import xarray as xr
+
+from emulator.src.core.emulation import ScenarioEmulator
+from emulator.src.utils.utils import get_logger
+
+log = get_logger()
+
+LAT_NAMES = ("lat", "latitude")
+LON_NAMES = ("lon", "longitude")
+
+
+class ScalingSweep:
+    """
+    Emission pathways generated on the fly from base scenarios and per-variable scaling factors.
+
+    Every member of the sweep is a base scenario with each input variable scaled by a factor, either constant over
+    time or ramped linearly from 1 in the first year to the factor in the last year. Only the base scenarios are held
+    (unnormalized, in the layout of Input4MipsDataset samples), the inputs of a batch of (member, year) pairs are
+    generated when needed.
+    """
+
+    def __init__(
+        self,
+        bases: Dict[str, torch.Tensor],
+        in_var_ids: Sequence[str],
+        base_names: Sequence[str],
+        factors: np.ndarray,
+        channels_last: bool = False,
+        ramp: bool = False,
+    ):
+        """
+        Args:
+            bases (dict): Base scenario name -> emissions of shape (years, seq_len, vars, lon, lat), or channels last.
+                All bases need the same number of years.
+            in_var_ids (list): Input variables, in the order of the variable axis of the bases.
+            base_names (list): Base scenario of every member.
+            factors (np.ndarray): Scaling factors of shape (members, vars).
+            channels_last (bool): Layout of the bases.
+            ramp (bool): Ramp the factors linearly from 1 in the first year to their value in the last year.
+        """
+        self.base_list = list(bases)
+        self.bases = torch.stack([bases[name] for name in self.base_list])
+        self.in_var_ids = list(in_var_ids)
+        self.base_index = torch.tensor([self.base_list.index(name) for name in base_names])
+        self.factors = torch.as_tensor(np.asarray(factors, dtype=np.float32).reshape(len(base_names), len(self.in_var_ids)))
+        self.channels_last = channels_last
+        self.ramp = ramp
+        self.num_members = len(base_names)
+        self.num_years = self.bases.shape[1]
+
+    @staticmethod
+    def grid(base_names: Sequence[str], factors: Dict[str, Sequence[float]], in_var_ids: Sequence[str]):
+        """
+        Members for every combination of base scenario and factors.
+
+        Args:
+            base_names (list): Base scenarios.
+            factors (dict): Factors per variable, variables without factors are not scaled.
+            in_var_ids (list): Input variables.
+
+        Returns:
+            list: Base scenario of every member.
+            np.ndarray: Factors of shape (members, vars).
+        """
+        values = [factors.get(var, [1.0]) for var in in_var_ids]
+        combinations = list(itertools.product(base_names, *values))
+        return [c[0] for c in combinations], np.array([c[1:] for c in combinations], dtype=np.float32)
+
+    @staticmethod
+    def random(
+        base_names: Sequence[str],
+        num_members: int,
+        in_var_ids: Sequence[str],
+        low: float = 0.0,
+        high: float = 2.0,
+        scaled_vars: Optional[Sequence[str]] = None,
+        seed: int = 0,
+    ):
+        """
+        Members with factors drawn uniformly from [low, high] and base scenarios drawn uniformly.
+
+        Args:
+            base_names (list): Base scenarios.
+            num_members (int): Number of members.
+            in_var_ids (list): Input variables.
+            low (float): Lowest factor.
+            high (float): Highest factor.
+            scaled_vars (list): Variables to scale, defaults to all.
+            seed (int): Seed of the draws.
+
+        Returns:
+            list: Base scenario of every member.
+            np.ndarray: Factors of shape (members, vars).
+        """
+        rng = np.random.default_rng(seed)
+        factors = rng.uniform(low, high, size=(num_members, len(in_var_ids))).astype(np.float32)
+        if scaled_vars is not None:
+            factors[:, [var not in scaled_vars for var in in_var_ids]] = 1.0
+        return list(rng.choice(list(base_names), size=num_members)), factors
+
+    def __len__(self) -> int:
+        """Number of (member, year) samples."""
+        return self.num_members * self.num_years
+
+    def to(self, device: torch.device) -> "ScalingSweep":
+        self.bases = self.bases.to(device)
+        self.base_index = self.base_index.to(device)
+        self.factors = self.factors.to(device)
+        return self
+
+    def inputs(self, indexes: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """
+        Generate the inputs of a batch of samples.
+
+        Args:
+            indexes (Tensor): Sample indexes, member * num_years + year.
+
+        Returns:
+            Tensor: Inputs of shape (batch, seq_len, vars, lon, lat), or channels last.
+            Tensor: Member of every sample.
+            Tensor: Year (index) of every sample.
+        """
+        indexes = indexes.to(self.bases.device)
+        members, years = indexes // self.num_years, indexes % self.num_years
+        factors = self.factors[members]
+        if self.ramp:
+            weight = (years.float() / max(self.num_years - 1, 1)).unsqueeze(1)
+            factors = 1 + weight * (factors - 1)
+        # (batch, vars) -> broadcastable against (batch, seq_len, vars, lon, lat) or (batch, seq_len, lon, lat, vars)
+        shape = (len(indexes), 1, 1, 1, -1) if self.channels_last else (len(indexes), 1, -1, 1, 1)
+        X = self.bases[self.base_index[members], years] * factors.reshape(shape)
+        return X, members, years
+
+    def members(self) -> Dict[str, np.ndarray]:
+        """Base scenario and factors of every member."""
+        return {
+            "base": np.array([self.base_list[i] for i in self.base_index.tolist()]),
+            "factors": self.factors.cpu().numpy(),
+        }
+
+
+class OnlineReducer:
+    """
+    Reduces the predicted fields of a sweep as they come in, without storing them.
+
+    Per member and year the annual means are reduced to area-weighted (cos latitude) global and regional means.
+    Optionally, the mean and standard deviation fields across members are accumulated per year. Percentiles across
+    members are computed from the stored global and regional means.
+    """
+
+    def __init__(
+        self,
+        num_members: int,
+        num_years: int,
+        out_var_ids: Sequence[str],
+        spatial_coords: Dict[str, np.ndarray],
+        regions: Optional[Dict[str, Tuple[float, float, float, float]]] = None,
+        field_stats: bool = False,
+        device: Optional[torch.device] = None,
+    ):
+        """
+        Args:
+            num_members (int): Number of members of the sweep.
+            num_years (int): Number of years per member.
+            out_var_ids (list): Output variables.
+            spatial_coords (dict): The two spatial coordinates of the fields, e.g. {"lat": ..., "lon": ...}.
+            regions (dict): Region name -> (lat_min, lat_max, lon_min, lon_max) boxes.
+            field_stats (bool): Accumulate the mean and std fields across members per year.
+            device (torch.device): Device the reductions run on, the one of the predictions.
+        """
+        self.out_var_ids = list(out_var_ids)
+        self.spatial_coords = spatial_coords
+        self.region_names = ["global"] + list(regions or {})
+        self.num_years = num_years
+        self.device = device or torch.device("cpu")
+
+        weights = self.area_weights(spatial_coords)
+        masks = [np.ones_like(weights)] + [self.region_mask(spatial_coords, box) for box in (regions or {}).values()]
+        region_weights = np.stack([weights * mask for mask in masks])
+        if np.any(region_weights.sum(axis=(1, 2)) == 0):
+            empty = [name for name, w in zip(self.region_names, region_weights) if w.sum() == 0]
+            raise ValueError(f"The regions {empty} do not contain any grid cell.")
+        region_weights /= region_weights.sum(axis=(1, 2), keepdims=True)
+        self.region_weights = torch.as_tensor(region_weights, dtype=torch.float32, device=self.device)
+
+        # (regions, members, years, vars)
+        self.region_means = torch.full(
+            (len(self.region_names), num_members, num_years, len(self.out_var_ids)), float("nan"), device=self.device
+        )
+        self.field_stats = field_stats
+        if field_stats:
+            shape = (num_years, len(self.out_var_ids), *weights.shape)
+            self.count = torch.zeros(num_years, dtype=torch.float64, device=self.device)
+            self.field_sum = torch.zeros(shape, dtype=torch.float64, device=self.device)
+            self.field_sq_sum = torch.zeros(shape, dtype=torch.float64, device=self.device)
+
+    @staticmethod
+    def _find_coord(spatial_coords: Dict[str, np.ndarray], names: Sequence[str]) -> Optional[int]:
+        for i, dim in enumerate(spatial_coords):
+            if dim.lower() in names:
+                return i
+        return None
+
+    @classmethod
+    def area_weights(cls, spatial_coords: Dict[str, np.ndarray]) -> np.ndarray:
+        """Grid cell weights proportional to cos(latitude), uniform without a latitude coordinate."""
+        shape = tuple(len(values) for values in spatial_coords.values())
+        lat_axis = cls._find_coord(spatial_coords, LAT_NAMES)
+        if lat_axis is None:
+            return np.ones(shape)
+        lat = np.asarray(list(spatial_coords.values())[lat_axis])
+        if not np.issubdtype(lat.dtype, np.floating) or np.abs(lat).max() > 90:
+            # grid indexes of files without a latitude coordinate
+            log.warning("The latitude coordinate does not hold degrees, using uniform area weights.")
+            return np.ones(shape)
+        weights = np.cos(np.deg2rad(lat))
+        return np.broadcast_to(weights.reshape([-1 if i == lat_axis else 1 for i in range(2)]), shape).copy()
+
+    @classmethod
+    def region_mask(cls, spatial_coords: Dict[str, np.ndarray], box: Tuple[float, float, float, float]) -> np.ndarray:
+        """Mask of the grid cells in a (lat_min, lat_max, lon_min, lon_max) box, lon_min > lon_max wraps around."""
+        lat_axis, lon_axis = cls._find_coord(spatial_coords, LAT_NAMES), cls._find_coord(spatial_coords, LON_NAMES)
+        if lat_axis is None or lon_axis is None:
+            raise ValueError(f"Regions need lat and lon coordinates, the fields have {list(spatial_coords)}.")
+        coords = list(spatial_coords.values())
+        lat, lon = np.asarray(coords[lat_axis]), np.asarray(coords[lon_axis]) % 360
+        lat_min, lat_max, lon_min, lon_max = box
+        lon_min, lon_max = lon_min % 360, lon_max % 360
+        in_lat = (lat >= lat_min) & (lat <= lat_max)
+        in_lon = (lon >= lon_min) & (lon <= lon_max) if lon_min <= lon_max else (lon >= lon_min) | (lon <= lon_max)
+        mask = np.outer(in_lat, in_lon) if lat_axis == 0 else np.outer(in_lon, in_lat)
+        return mask.astype(np.float64)
+
+    def update(self, preds: torch.Tensor, members: torch.Tensor, years: torch.Tensor):
+        """
+        Args:
+            preds (Tensor): Predictions of shape (batch, time steps, vars, lon, lat).
+            members (Tensor): Member of every sample.
+            years (Tensor): Year (index) of every sample.
+        """
+        annual = preds.float().mean(dim=1)  # (batch, vars, lon, lat)
+        means = torch.einsum("bvij,rij->rbv", annual, self.region_weights)
+        self.region_means[:, members, years] = means
+        if self.field_stats:
+            annual = annual.double()
+            self.count.index_add_(0, years, torch.ones_like(years, dtype=torch.float64))
+            self.field_sum.index_add_(0, years, annual)
+            self.field_sq_sum.index_add_(0, years, annual**2)
+
+    def percentiles(self, q: Sequence[float] = (5, 50, 95)) -> np.ndarray:
+        """Percentiles across members of the global and regional means, of shape (quantiles, regions, years, vars)."""
+        return np.nanpercentile(self.region_means.cpu().numpy(), q, axis=1)
+
+    def results(self, q: Sequence[float] = (5, 50, 95), years: Optional[Sequence] = None) -> xr.Dataset:
+        """The reductions as a dataset, with one variable per output variable and reduction."""
+        years = np.arange(self.num_years) if years is None else np.asarray(years)
+        region_means = self.region_means.cpu().numpy()
+        percentiles = self.percentiles(q)
+        data_vars = {}
+        for j, var in enumerate(self.out_var_ids):
+            data_vars[f"{var}_mean"] = (("region", "member", "year"), region_means[..., j])
+            data_vars[f"{var}_percentile"] = (("percentile", "region", "year"), percentiles[..., j])
+        coords = {"region": self.region_names, "member": np.arange(region_means.shape[1]), "year": years,
+                  "percentile": np.asarray(q, dtype=np.float64)}
+        if self.field_stats:
+            count = self.count.reshape(-1, 1, 1, 1)
+            mean = self.field_sum / count
+            std = (self.field_sq_sum / count - mean**2).clamp(min=0).sqrt()
+            dims = ("year", *self.spatial_coords)
+            for j, var in enumerate(self.out_var_ids):
+                data_vars[f"{var}_field_mean"] = (dims, mean[:, j].float().cpu().numpy())
+                data_vars[f"{var}_field_std"] = (dims, std[:, j].float().cpu().numpy())
+            coords.update(self.spatial_coords)
+        return xr.Dataset(data_vars, coords=coords)
+
+
+def run_sweep(
+    emulator: ScenarioEmulator,
+    sweep: ScalingSweep,
+    reducer: OnlineReducer,
+    climate_model: Optional[str] = None,
+    batch_size: Optional[int] = None,
+) -> Dict[str, float]:
+    """
+    Emulate all (member, year) samples of a sweep in batches and reduce the predictions online.
+
+    Args:
+        emulator (ScenarioEmulator): Model, normalization and layout.
+        sweep (ScalingSweep): The emission pathways.
+        reducer (OnlineReducer): Receives the denormalized predictions.
+        climate_model (str): Climate model to emulate (see ScenarioEmulator.predict).
+        batch_size (int): (member, year) samples per forward pass, defaults to the batch size of the emulator.
+
+    Returns:
+        dict: members, years, seconds and members_per_sec of the sweep.
+    """
+    batch_size = batch_size or emulator.batch_size
+    sweep.to(emulator.device)
+    start_time = time.perf_counter()
+    for start in range(0, len(sweep), batch_size):
+        indexes = torch.arange(start, min(start + batch_size, len(sweep)), device=emulator.device)
+        X, members, years = sweep.inputs(indexes)
+        reducer.update(emulator.predict(X, climate_model), members, years)
+    if emulator.device.type == "cuda":
+        torch.cuda.synchronize(emulator.device)
+    seconds = time.perf_counter() - start_time
+    log.info(f"Emulated {sweep.num_members} pathways of {sweep.num_years} years in {seconds:.2f}s.")
+    return {
+        "members": sweep.num_members,
+        "years": sweep.num_years,
+        "seconds": seconds,
+        "members_per_sec": sweep.num_members / seconds,
+    }
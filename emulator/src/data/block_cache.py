@@ -0,0 +1,222 @@
+import fcntl
+import glob
+import os
+import re
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import xarray as xr
+
+from emulator.src.utils.utils import get_logger
+
+log = get_logger()
+
+# one cache per directory and process, so all datasets of a process share the memory-mapped blocks
+_BLOCK_CACHES: Dict[str, "BlockCache"] = {}
+
+
+def get_block_cache(cache_dir: str) -> "BlockCache":
+    """Get the block cache of this process for the given directory."""
+    cache_dir = os.path.abspath(cache_dir)
+    if cache_dir not in _BLOCK_CACHES:
+        _BLOCK_CACHES[cache_dir] = BlockCache(cache_dir)
+    return _BLOCK_CACHES[cache_dir]
+
+
+class BlockCache:
+    """
+    Cache of raw data blocks, one per (mip, climate model, member, scenario, variable) and interval of years.
+    Requests for years within a cached interval are served from that block.
+
+    Blocks are stored as .npy files of shape (num_years * steps_per_year, lon, lat) and memory-mapped, so they are
+    read from the NetCDF files only once and independently of the experiment config (scenario list, year ranges,
+    splits) they were first requested by. Every block is opened once per process and shared by all datasets.
+    Data spanning several blocks (e.g. several variables or scenarios of a dataset) is served as a StackedBlockView of
+    the block slices, so only the blocks exist on disk.
+    Writing a block is guarded by a file lock, so parallel runs on the same node wait for each other instead of
+    reading the same files twice.
+    """
+
+    def __init__(self, cache_dir: str):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+        self._arrays: Dict[str, np.ndarray] = {}
+
+    @staticmethod
+    def block_name(key: Tuple[str, ...]) -> str:
+        name = "_".join(str(k) for k in key if k != "")
+        return re.sub(r"[^\w\-+.]", "-", name)
+
+    def cached_intervals(self, key: Tuple[str, ...]) -> List[Tuple[int, int, str]]:
+        """Get the (first year, last year, path) of all cached blocks of a key."""
+        name = self.block_name(key)
+        intervals = []
+        for path in glob.glob(os.path.join(glob.escape(self.cache_dir), f"{glob.escape(name)}_*-*.npy")):
+            match = re.fullmatch(re.escape(name) + r"_(\d+)-(\d+)\.npy", os.path.basename(path))
+            if match is not None:
+                intervals.append((int(match.group(1)), int(match.group(2)), path))
+        return intervals
+
+    def find(self, key: Tuple[str, ...], first: int, last: int) -> Optional[Tuple[int, int, str]]:
+        """Get the smallest cached block of a key containing the years first to last, None if there is none."""
+        containing = [(y0, y1, path) for y0, y1, path in self.cached_intervals(key) if y0 <= first and last <= y1]
+        if len(containing) == 0:
+            return None
+        return min(containing, key=lambda interval: interval[1] - interval[0])
+
+    def _open(self, path: str) -> np.ndarray:
+        if path not in self._arrays:
+            self._arrays[path] = np.load(path, mmap_mode="r")
+        return self._arrays[path]
+
+    def _build(self, key: Tuple[str, ...], first: int, last: int, files_for_year: Callable[[int], List[str]]) -> Tuple[int, int, str]:
+        name = self.block_name(key)
+        with open(os.path.join(self.cache_dir, f"{name}.lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                # another process might have written the block while we were waiting for the lock
+                interval = self.find(key, first, last)
+                if interval is not None:
+                    return interval
+
+                files = [f for year in range(first, last + 1) for f in files_for_year(year)]
+                if len(files) == 0:
+                    raise FileNotFoundError(f"No files for block {name} and years {first}-{last}.")
+                log.info(f"Reading {len(files)} files into block {name}_{first}-{last}.")
+                data = xr.open_mfdataset(files, concat_dim="time", combine="nested").compute()
+                data = data.to_array().to_numpy()[0]
+
+                path = os.path.join(self.cache_dir, f"{name}_{first}-{last}.npy")
+                tmp_path = f"{path}.{os.getpid()}.tmp"
+                with open(tmp_path, "wb") as f:
+                    np.save(f, data)
+                # readers only ever see complete blocks
+                os.replace(tmp_path, path)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+        return first, last, path
+
+    def get(self, key: Tuple[str, ...], years: Sequence[int], files_for_year: Callable[[int], List[str]]) -> np.ndarray:
+        """
+        Get the raw data of a key for the given years.
+
+        If a cached block covers the years, e.g. the test years 2090-2100 within cached train years 2015-2100, they
+        are served as a slice view of the memory-mapped block without reading any NetCDF file.
+
+        Args:
+            key (tuple): (mip, climate model, member, scenario, variable) or similar, identifying the block.
+            years (list): Years to get.
+            files_for_year (callable): Gives the NetCDF files of a year, only called if the block is not cached yet.
+
+        Returns:
+            np.ndarray: Read-only array of shape (num_years * steps_per_year, lon, lat).
+        """
+        years = np.atleast_1d(years)
+        first, last = int(years.min()), int(years.max())
+        if len(years) != last - first + 1:
+            # gaps in the years, get every contiguous run on its own
+            runs = np.split(np.sort(years), np.where(np.diff(np.sort(years)) != 1)[0] + 1)
+            return np.concatenate([self.get(key, run, files_for_year) for run in runs], axis=0)
+
+        interval = self.find(key, first, last)
+        if interval is None:
+            interval = self._build(key, first, last, files_for_year)
+        y0, y1, path = interval
+
+        block = self._open(path)
+        steps_per_year = block.shape[0] // (y1 - y0 + 1)
+        return block[(first - y0) * steps_per_year : (last - y0 + 1) * steps_per_year]
+
+
+class StackedBlockView:
+    """
+    Read-only view of the sequences of a dataset stacked from block slices, without copying them.
+
+    The parts of every variable (e.g. one block slice per scenario) are concatenated in time and split into sequences
+    of seq_len time steps, like ABC_Climate_Dataset.reshape_into_sequences, but a sample is only assembled from the
+    memory-mapped blocks when it is indexed. ``np.asarray(view)`` assembles all samples, e.g. to compute statistics.
+    """
+
+    def __init__(
+        self,
+        parts: Sequence[Sequence[np.ndarray]],
+        num_sequences: int,
+        seq_len: int,
+        seq_to_seq: bool = True,
+        channels_last: bool = True,
+    ):
+        """
+        Args:
+            parts (list): For every variable, its arrays of shape (time, lon, lat), concatenated in time.
+            num_sequences (int): Number of samples, the time steps beyond num_sequences * seq_len are not used.
+            seq_len (int): Number of time steps per sample.
+            seq_to_seq (bool): If False, a sample is only the last time step of its sequence.
+            channels_last (bool): If True, samples are (time, lon, lat, vars), else (time, vars, lon, lat).
+        """
+        self.parts = [list(var_parts) for var_parts in parts]
+        lengths = [sum(len(part) for part in var_parts) for var_parts in self.parts]
+        if num_sequences * seq_len > min(lengths):
+            raise ValueError(f"{num_sequences} sequences of {seq_len} time steps need more than the {min(lengths)} available.")
+        # first time step of every part of a variable
+        self._starts = [np.cumsum([0] + [len(part) for part in var_parts]) for var_parts in self.parts]
+        self.num_sequences = num_sequences
+        self.seq_len = seq_len
+        self.seq_to_seq = seq_to_seq
+        self.channels_last = channels_last
+        self.dtype = self.parts[0][0].dtype
+        spatial_shape = self.parts[0][0].shape[1:]
+        num_vars, out_len = len(self.parts), seq_len if seq_to_seq else 1
+        sample_shape = (out_len, *spatial_shape, num_vars) if channels_last else (out_len, num_vars, *spatial_shape)
+        self.shape = (num_sequences, *sample_shape)
+
+    @property
+    def ndim(self) -> int:
+        return len(self.shape)
+
+    @property
+    def size(self) -> int:
+        return int(np.prod(self.shape))
+
+    @property
+    def nbytes(self) -> int:
+        return self.size * self.dtype.itemsize
+
+    def __len__(self) -> int:
+        return self.num_sequences
+
+    def _steps(self, var: int, start: int, stop: int) -> np.ndarray:
+        """Time steps start to stop of a variable, a view if they lie within one part."""
+        starts = self._starts[var]
+        first = int(np.searchsorted(starts, start, side="right")) - 1
+        chunks = []
+        while start < stop:
+            part = self.parts[var][first]
+            end = min(stop, starts[first] + len(part))
+            chunks.append(part[start - starts[first] : end - starts[first]])
+            start, first = end, first + 1
+        return chunks[0] if len(chunks) == 1 else np.concatenate(chunks, axis=0)
+
+    def _sample(self, index: int) -> np.ndarray:
+        if index < 0:
+            index += self.num_sequences
+        if not 0 <= index < self.num_sequences:
+            raise IndexError(f"Index {index} is out of range for {self.num_sequences} sequences.")
+        start = index * self.seq_len if self.seq_to_seq else (index + 1) * self.seq_len - 1
+        stop = (index + 1) * self.seq_len
+        return np.stack([self._steps(var, start, stop) for var in range(len(self.parts))], axis=-1 if self.channels_last else 1)
+
+    def __getitem__(self, index) -> np.ndarray:
+        if isinstance(index, (int, np.integer)):
+            return self._sample(int(index))
+        indices = np.arange(self.num_sequences)[index]
+        if len(indices) == 0:
+            return np.empty((0, *self.shape[1:]), dtype=self.dtype)
+        return np.stack([self._sample(int(i)) for i in indices])
+
+    def __array__(self, dtype=None) -> np.ndarray:
+        array = self[:]
+        return array.astype(dtype, copy=False) if dtype is not None else array
+
+    def __deepcopy__(self, memo):
+        # the blocks are read-only, copies of a dataset can share them
+        return self
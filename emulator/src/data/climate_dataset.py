@@ -63,6 +63,7 @@ class ClimateDataset(torch.utils.data.Dataset):
         input_normalization="z-norm",  # TODO: implement
         output_transform=None,
         output_normalization="z-norm",
+        normalize: bool = True,  # if False the raw data is kept and normalized on the device
         *args,
         **kwargs,
     ):
@@ -128,6 +129,7 @@ class ClimateDataset(torch.utils.data.Dataset):
             output_save_dir=output_save_dir,
             seq_to_seq=seq_to_seq,
             seq_len=seq_len,
+            normalize=normalize,
         )
         # creates on cmip and on input4mip dataset
         print("Creating input4mips...")
@@ -424,6 +426,7 @@ class CMIP6Dataset(ClimateDataset):
         channels_last: bool = True,
         seq_to_seq: bool = True,
         seq_len: int = 12,
+        normalize: bool = True,
         *args,
         **kwargs,
     ):
@@ -496,7 +499,7 @@ class CMIP6Dataset(ClimateDataset):
                 mode=self.mode,
                 mips="cmip6",
             )
-            self.Data = self.normalize_data(self.Data, stats)
+            self.Data = self.normalize_data(self.Data, stats) if normalize else self.Data
 
         else:
             # Getting list of file names per variable for open and merging
@@ -541,19 +544,20 @@ class CMIP6Dataset(ClimateDataset):
                 if os.path.isfile(stats_fname):
                     print("Stats file already exists! Loading from memory.")
                     stats = self.load_statistics_data(stats_fname)
-                    self.norm_data = self.normalize_data(self.raw_data, stats)
+                    self.norm_data = self.normalize_data(self.raw_data, stats) if normalize else self.raw_data
 
                 else:
                     stat1, stat2 = self.get_dataset_statistics(
                         self.raw_data, self.mode, mips="cmip6"
                     )
-                    stats = {"mean": stat1, "std": stat2}
-                    self.norm_data = self.normalize_data(self.raw_data, stats)
+                    # min and max are stored too, for normalizing on the device with the training statistics
+                    stats = {"mean": stat1, "std": stat2, **dict(zip(("min", "max"), self.get_min_max(self.raw_data)))}
+                    self.norm_data = self.normalize_data(self.raw_data, stats) if normalize else self.raw_data
 
                     save_file_name = self.write_dataset_statistics(stats_fname, stats)
                     print("WROTE STATISTICS", save_file_name)
 
-                self.norm_data = self.normalize_data(self.raw_data, stats)
+                self.norm_data = self.normalize_data(self.raw_data, stats) if normalize else self.raw_data
 
             elif self.mode == "test":
                 stats_fname = self.get_save_name_from_kwargs(
@@ -563,7 +567,7 @@ class CMIP6Dataset(ClimateDataset):
                 stats = self.load_dataset_statistics(
                     stats_fname, mode=self.mode, mips="cmip6"
                 )
-                self.norm_data = self.normalize_data(self.raw_data, stats)
+                self.norm_data = self.normalize_data(self.raw_data, stats) if normalize else self.raw_data
 
             self.data_path = self.save_data_into_disk(
                 self.raw_data, fname, output_save_dir
@@ -572,6 +576,15 @@ class CMIP6Dataset(ClimateDataset):
             self.copy_to_slurm(self.data_path)
 
             self.Data = self.norm_data  # ready for getitem
+        self.stats = stats
+        if not normalize and "min" not in stats:
+            # the raw data is kept and normalized on the device (see Normalizer), which also needs min and max
+            if self.mode == "test":
+                raise ValueError(
+                    "The training statistics have no min and max (written by an older version), "
+                    "set up the training data again to rewrite them."
+                )
+            self.stats = {**stats, **dict(zip(("min", "max"), self.get_min_max(self.Data)))}
         self.length = self.Data.shape[0]
 
     def __getitem__(self, index):
@@ -596,6 +609,7 @@ class Input4MipsDataset(ClimateDataset):
         output_save_dir: str = "",
         seq_to_seq: bool = True,
         seq_len: int = 12,
+        normalize: bool = True,
         *args,
         **kwargs,
     ):
@@ -642,7 +656,7 @@ class Input4MipsDataset(ClimateDataset):
                 mode=self.mode,
                 mips="input4mips",
             )
-            self.Data = self.normalize_data(self.Data, stats)
+            self.Data = self.normalize_data(self.Data, stats) if normalize else self.Data
 
         else:
             files_per_var = []
@@ -706,17 +720,18 @@ class Input4MipsDataset(ClimateDataset):
                 if os.path.isfile(stats_fname):
                     print("Stats file already exists! Loading from mempory.")
                     stats = self.load_statistics_data(stats_fname)
-                    self.norm_data = self.normalize_data(self.raw_data, stats)
+                    self.norm_data = self.normalize_data(self.raw_data, stats) if normalize else self.raw_data
 
                 else:
                     stat1, stat2 = self.get_dataset_statistics(
                         self.raw_data, self.mode, mips="cmip6"
                     )
-                    stats = {"mean": stat1, "std": stat2}
-                    self.norm_data = self.normalize_data(self.raw_data, stats)
+                    # min and max are stored too, for normalizing on the device with the training statistics
+                    stats = {"mean": stat1, "std": stat2, **dict(zip(("min", "max"), self.get_min_max(self.raw_data)))}
+                    self.norm_data = self.normalize_data(self.raw_data, stats) if normalize else self.raw_data
                     save_file_name = self.write_dataset_statistics(stats_fname, stats)
 
-                self.norm_data = self.normalize_data(self.raw_data, stats)
+                self.norm_data = self.normalize_data(self.raw_data, stats) if normalize else self.raw_data
 
             elif self.mode == "test":
                 stats_fname = self.get_save_name_from_kwargs(
@@ -725,7 +740,7 @@ class Input4MipsDataset(ClimateDataset):
                 stats = self.load_dataset_statistics(
                     stats_fname, mode=self.mode, mips="input4mips"
                 )
-                self.norm_data = self.normalize_data(self.raw_data, stats)
+                self.norm_data = self.normalize_data(self.raw_data, stats) if normalize else self.raw_data
 
             self.data_path = self.save_data_into_disk(
                 self.raw_data, fname, output_save_dir
@@ -734,6 +749,15 @@ class Input4MipsDataset(ClimateDataset):
             self.copy_to_slurm(self.data_path)
 
             self.Data = self.norm_data
+        self.stats = stats
+        if not normalize and "min" not in stats:
+            # the raw data is kept and normalized on the device (see Normalizer), which also needs min and max
+            if self.mode == "test":
+                raise ValueError(
+                    "The training statistics have no min and max (written by an older version), "
+                    "set up the training data again to rewrite them."
+                )
+            self.stats = {**stats, **dict(zip(("min", "max"), self.get_min_max(self.Data)))}
         self.length = self.Data.shape[0]
 
     def __getitem__(self, index):
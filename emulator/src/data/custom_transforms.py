@@ -1,52 +1,136 @@
+from typing import Dict, List, Optional
+
 import numpy as np
 import torch
 
 
-class Normalize_z:
-    """Normalize a tensor image with mean and standard deviation.
-
-    Args:
-        mean (tuple): means for each variable.
-        std (tuple): standard deviations for each variable.
-    """
-
-    def __init__(self, stats_path):
-        self.mean_in = np.expand_dims(mean_in, axis=(1, 1, 1))
-        self.std_in = np.expand_dims(std_in, axis=(1, 1, 1))
-        self.eps = 1e-9
-
-    def __call__(self, X, y):
-        X_norm = (X - self.mean_in) / (self.std_in + self.eps)
-        y_norm = (y - self.mean_out) / (self.std_out + self.eps)
-
-        return X_norm, y_norm
+class Normalizer(torch.nn.Module):
+    """Normalize inputs and targets per variable on the device, and denormalize predictions.
 
-
-class Normalize_minmax:
-    """Normalize a tensor image with mean and standard deviation.
+    The statistics are kept as (non-persistent) buffers, so they move with the module to the device
+    of the batch and the datasets can keep the raw data.
 
     Args:
-        mean (tuple): means for each variable.
-        std (tuple): standard deviations for each variable.
+        input_stats (dict): statistics of the inputs, "mean" and "std" (z-norm) or "min" and "max" (minmax),
+            each of shape (num_vars,) or (num_climate_models, num_vars).
+        output_stats (dict): statistics of the targets, same format as input_stats.
+        norm_type (str): "z-norm" or "minmax".
+        channels_last (bool): whether the variables are the last dimension, else they are the third last.
+        climate_models (list): names of the climate models indexing the first dimension of the statistics.
+            Only needed for per-model statistics (super emulation).
     """
 
-    def __init__(self, min_pr=0.0, max_pr=0.0, min_t=0.0, max_t=0.0):
-        self.min_pr = min_pr
-        self.max_pr = max_pr
-        self.min_t = min_t
-        self.max_t = max_t
-
-    def __call__(self, X, y):
-        img = sample["image"]
-        mask = sample["label"]
-        img = np.array(img).astype(np.float32)
-        mask = np.array(mask).astype(np.float32)
-        # Image norm
-        img /= 255.0
-        img -= self.mean
-        img /= self.std
-
-        return {"image": img, "label": mask}
+    def __init__(
+        self,
+        input_stats: Dict[str, np.ndarray],
+        output_stats: Dict[str, np.ndarray],
+        norm_type: str = "z-norm",
+        channels_last: bool = False,
+        climate_models: Optional[List[str]] = None,
+        eps: float = 1e-9,
+    ):
+        super().__init__()
+        if norm_type == "z-norm":
+            keys = ("mean", "std")
+        elif norm_type == "minmax":
+            keys = ("min", "max")
+        else:
+            raise ValueError(f"Normalization of type {norm_type} has not been implemented!")
+
+        self.norm_type = norm_type
+        self.channels_last = channels_last
+        self.climate_models = list(climate_models) if climate_models is not None else None
+        self.eps = eps
+
+        # x_norm = (x - shift) / scale
+        for name, stats in (("input", input_stats), ("output", output_stats)):
+            low, high = (np.asarray(stats[key], dtype=np.float32) for key in keys)
+            low, high = low.reshape(-1, low.shape[-1]), high.reshape(-1, high.shape[-1])
+            scale = high if norm_type == "z-norm" else high - low
+            self.register_buffer(f"{name}_shift", torch.from_numpy(low), persistent=False)
+            self.register_buffer(f"{name}_scale", torch.from_numpy(scale), persistent=False)
+
+    def _model_index(self, model_ids) -> Optional[torch.Tensor]:
+        """Map the climate model names of a batch to the rows of the statistics."""
+        if model_ids is None or self.climate_models is None:
+            return None
+        if isinstance(model_ids, str):
+            model_ids = [model_ids]
+        try:
+            index = [self.climate_models.index(model_id) for model_id in model_ids]
+        except ValueError:
+            raise ValueError(f"No normalization statistics for climate models {model_ids}, only for {self.climate_models}.")
+        return torch.tensor(index, device=self.input_shift.device)
+
+    def _broadcast(self, stat: torch.Tensor, x: torch.Tensor, model_index: Optional[torch.Tensor]) -> torch.Tensor:
+        """Bring a (num_models, num_vars) statistic into a shape broadcastable against x."""
+        stat = stat[model_index] if model_index is not None else stat[0].unsqueeze(0)
+        # (batch, vars) -> (batch, 1, ..., vars) or (batch, 1, ..., vars, 1, 1)
+        trailing = 0 if self.channels_last else 2
+        shape = [stat.shape[0]] + [1] * (x.dim() - 2 - trailing) + [stat.shape[1]] + [1] * trailing
+        return stat.to(x.dtype).reshape(shape)
+
+    def normalize_input(self, X: torch.Tensor, model_ids=None) -> torch.Tensor:
+        idx = self._model_index(model_ids)
+        return (X - self._broadcast(self.input_shift, X, idx)) / (self._broadcast(self.input_scale, X, idx) + self.eps)
+
+    def normalize_output(self, Y: torch.Tensor, model_ids=None) -> torch.Tensor:
+        idx = self._model_index(model_ids)
+        return (Y - self._broadcast(self.output_shift, Y, idx)) / (self._broadcast(self.output_scale, Y, idx) + self.eps)
+
+    def denormalize_output(self, Y: torch.Tensor, model_ids=None) -> torch.Tensor:
+        idx = self._model_index(model_ids)
+        return Y * (self._broadcast(self.output_scale, Y, idx) + self.eps) + self._broadcast(self.output_shift, Y, idx)
+
+    def forward(self, batch):
+        """Normalize a batch (X, Y) or (X, Y, model_ids)."""
+        X, Y, *rest = batch
+        model_ids = rest[0] if rest else None
+        return (self.normalize_input(X, model_ids), self.normalize_output(Y, model_ids), *rest)
+
+    def get_stats(self) -> Dict[str, Dict[str, np.ndarray]]:
+        """The input and output statistics in the format of the constructor, of shape (num_climate_models, num_vars)."""
+        stats = {}
+        for name in ("input", "output"):
+            shift = getattr(self, f"{name}_shift").cpu().numpy()
+            scale = getattr(self, f"{name}_scale").cpu().numpy()
+            if self.norm_type == "z-norm":
+                stats[name] = {"mean": shift, "std": scale}
+            else:
+                stats[name] = {"min": shift, "max": shift + scale}
+        return stats
+
+    def save(self, path: str):
+        """Save the statistics to a .npz file, e.g. to emulate without loading the training data (see Normalizer.load)."""
+        stats = self.get_stats()
+        np.savez(
+            path,
+            norm_type=self.norm_type,
+            channels_last=self.channels_last,
+            climate_models=np.array(self.climate_models if self.climate_models is not None else [], dtype=str),
+            **{f"{name}_{key}": value for name in stats for key, value in stats[name].items()},
+        )
+
+    @classmethod
+    def load(cls, path: str, channels_last: Optional[bool] = None) -> "Normalizer":
+        """
+        Load a Normalizer saved with Normalizer.save.
+
+        Args:
+            path (str): The .npz file.
+            channels_last (bool): Overrides the layout the statistics were saved with.
+        """
+        data = np.load(path)
+        norm_type = str(data["norm_type"])
+        keys = ("mean", "std") if norm_type == "z-norm" else ("min", "max")
+        climate_models = [str(m) for m in data["climate_models"]]
+        return cls(
+            input_stats={key: data[f"input_{key}"] for key in keys},
+            output_stats={key: data[f"output_{key}"] for key in keys},
+            norm_type=norm_type,
+            channels_last=bool(data["channels_last"]) if channels_last is None else channels_last,
+            climate_models=climate_models if len(climate_models) > 0 else None,
+        )
 
 
 class ToTensor(object):
@@ -0,0 +1,158 @@
+import mmap
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+
+def is_memory_mapped(array: np.ndarray) -> bool:
+    """True if the array (or any array it is a view of) is backed by a memory-mapped file."""
+    base = array
+    while base is not None:
+        if isinstance(base, (np.memmap, mmap.mmap)):
+            return True
+        base = getattr(base, "base", None)
+    return False
+
+
+def _merged_size(bounds: List[Tuple[int, int]]) -> int:
+    """Number of bytes covered by a list of (low, high) address ranges, counting overlaps once."""
+    size = 0
+    end = -1
+    for low, high in sorted(bounds):
+        if high <= end:
+            continue
+        size += high - max(low, end)
+        end = high
+    return size
+
+
+def _fingerprint(array: np.ndarray, num_samples: int = 1024) -> int:
+    """Cheap fingerprint of the content of an array from a strided sample, without copying the array."""
+    if array.size == 0:
+        return 0
+    indices = np.linspace(0, array.size - 1, min(num_samples, array.size)).astype(np.int64)
+    return hash(array.flat[indices].tobytes())
+
+
+class MemoryReport:
+    """
+    Accounting of the numpy arrays held by the datasets, grouped into blocks (e.g. one per (model, member)).
+
+    Arrays that are views of the same buffer (e.g. ``Data`` and ``norm_data``) are counted once. Arrays backed by a
+    memory-mapped file (e.g. the block cache) are counted separately, as they are paged in and out by the OS.
+    Separate buffers with equal content (e.g. the arrays of a deepcopied dataset) are reported as duplicates.
+    """
+
+    def __init__(self):
+        # (block, attribute name, array)
+        self.arrays: List[Tuple[str, str, np.ndarray]] = []
+
+    def add(self, block: str, name: str, array: np.ndarray):
+        self.arrays.append((block, name, array))
+
+    def add_dataset(self, block: str, dataset):
+        """Add the arrays of a dataset (see ABC_Climate_Dataset.array_attributes)."""
+        for name, array in dataset.array_attributes().items():
+            self.add(block, name, array)
+
+    def blocks(self) -> Dict[str, Dict]:
+        """Resident and mapped bytes and attribute names per block."""
+        blocks = {}
+        for block, name, array in self.arrays:
+            entry = blocks.setdefault(block, {"names": [], "resident": [], "mapped": []})
+            entry["names"].append(name)
+            entry["mapped" if is_memory_mapped(array) else "resident"].append(np.byte_bounds(array))
+        return {
+            block: {
+                "arrays": ", ".join(entry["names"]),
+                "resident_bytes": _merged_size(entry["resident"]),
+                "mapped_bytes": _merged_size(entry["mapped"]),
+            }
+            for block, entry in blocks.items()
+        }
+
+    def total_bytes(self) -> Tuple[int, int]:
+        """Resident and mapped bytes of all arrays, shared buffers counted once."""
+        resident = [np.byte_bounds(a) for _, _, a in self.arrays if not is_memory_mapped(a)]
+        mapped = [np.byte_bounds(a) for _, _, a in self.arrays if is_memory_mapped(a)]
+        return _merged_size(resident), _merged_size(mapped)
+
+    def duplicates(self) -> List[Tuple[str, str, int]]:
+        """
+        Find separate resident buffers holding the same data.
+
+        Returns:
+            list: (first "block/name", duplicate "block/name", bytes) for every duplicated buffer.
+        """
+        candidates: Dict[Tuple, List[Tuple[str, np.ndarray]]] = {}
+        seen_bounds = set()
+        for block, name, array in self.arrays:
+            bounds = np.byte_bounds(array)
+            if is_memory_mapped(array) or bounds in seen_bounds or array.size == 0:
+                # views of the same buffer are not duplicates
+                continue
+            seen_bounds.add(bounds)
+            key = (array.shape, array.dtype.str, _fingerprint(array))
+            candidates.setdefault(key, []).append((f"{block}/{name}", array))
+
+        duplicates = []
+        for group in candidates.values():
+            originals: List[Tuple[str, np.ndarray]] = []
+            for label, array in group:
+                original = next((o for o, a in originals if np.array_equal(a, array)), None)
+                if original is None:
+                    originals.append((label, array))
+                else:
+                    duplicates.append((original, label, array.nbytes))
+        return duplicates
+
+    def redundant_raw_copies(self) -> List[Tuple[str, int]]:
+        """Blocks holding raw_data in a separate resident buffer next to the normalized data."""
+        by_block: Dict[str, Dict[str, np.ndarray]] = {}
+        for block, name, array in self.arrays:
+            by_block.setdefault(block, {})[name] = array
+        redundant = []
+        for block, arrays in by_block.items():
+            raw, norm = arrays.get("raw_data"), arrays.get("norm_data")
+            if raw is None or norm is None or is_memory_mapped(raw) or np.shares_memory(raw, norm):
+                continue
+            redundant.append((block, raw.nbytes))
+        return redundant
+
+    def summary(self) -> Dict:
+        resident, mapped = self.total_bytes()
+        duplicates = self.duplicates()
+        redundant = self.redundant_raw_copies()
+        return {
+            "resident_bytes": resident,
+            "mapped_bytes": mapped,
+            "blocks": self.blocks(),
+            "duplicates": duplicates,
+            "duplicate_bytes": sum(nbytes for _, _, nbytes in duplicates),
+            "redundant_raw_copies": redundant,
+            "redundant_raw_bytes": sum(nbytes for _, nbytes in redundant),
+        }
+
+    def format(self, summary: Optional[Dict] = None) -> str:
+        summary = summary if summary is not None else self.summary()
+        lines = [
+            f"Data memory: {_mb(summary['resident_bytes'])} resident, {_mb(summary['mapped_bytes'])} memory-mapped."
+        ]
+        width = max([len(block) for block in summary["blocks"]] + [5])
+        lines.append(f"  {'block':<{width}} {'resident':>12} {'mapped':>12}  arrays")
+        for block, entry in summary["blocks"].items():
+            lines.append(
+                f"  {block:<{width}} {_mb(entry['resident_bytes']):>12} {_mb(entry['mapped_bytes']):>12}  {entry['arrays']}"
+            )
+        for original, duplicate, nbytes in summary["duplicates"]:
+            lines.append(f"  Duplicated buffer: {duplicate} holds the same data as {original} ({_mb(nbytes)}).")
+        if summary["redundant_raw_copies"]:
+            lines.append(
+                f"  {len(summary['redundant_raw_copies'])} blocks keep raw_data next to the normalized data "
+                f"({_mb(summary['redundant_raw_bytes'])}), which can be dropped with drop_raw_data=True."
+            )
+        return "\n".join(lines)
+
+
+def _mb(nbytes: int) -> str:
+    return f"{nbytes / 1024**2:.1f} MB"
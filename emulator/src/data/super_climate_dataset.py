@@ -15,6 +15,8 @@ import threading
 
 
 from emulator.src.utils.utils import get_logger, all_equal, map_variables_targetmip
+from emulator.src.data.block_cache import StackedBlockView, get_block_cache
+from emulator.src.data.memory_accounting import is_memory_mapped
 from emulator.src.data.constants import (
     LON,
     LAT,
@@ -162,6 +164,72 @@ class ABC_Climate_Dataset(ABC, torch.utils.data.Dataset):
 
         return norm_data
 
+    def renormalize_data(self, stats: dict):
+        """
+        Renormalizes the already normalized data with new statistics, e.g. statistics combined across ranks.
+
+        Args:
+            stats (dict): New statistics for normalization, mean and std per variable.
+        """
+        num_vars = self.stats["mean"].size
+        old_mean, old_std = self.stats["mean"].reshape(num_vars), self.stats["std"].reshape(num_vars)
+        new_mean, new_std = np.reshape(stats["mean"], num_vars), np.reshape(stats["std"], num_vars)
+
+        # variables are the last axis for channels last, the third axis otherwise
+        shape = (num_vars,) if self.channels_last else (num_vars, 1, 1)
+        scale = (old_std / new_std).reshape(shape)
+        shift = ((old_mean - new_mean) / new_std).reshape(shape)
+        if self.Data.flags.writeable:
+            # in place, so that no second copy of the block is allocated and norm_data stays the data
+            self.Data *= scale.astype(self.Data.dtype)
+            self.Data += shift.astype(self.Data.dtype)
+        else:
+            self.Data = (self.Data * scale + shift).astype(self.Data.dtype)
+        if hasattr(self, "norm_data"):
+            self.norm_data = self.Data
+        self.stats = {"mean": np.reshape(new_mean, self.stats["mean"].shape), "std": np.reshape(new_std, self.stats["std"].shape)}
+
+    def array_attributes(self) -> Dict[str, np.ndarray]:
+        """
+        Gets the data arrays held by the dataset, for memory accounting.
+
+        Returns:
+            Dict[str, np.ndarray]: Maps attribute name (raw_data, norm_data, Data) to the array.
+        """
+        arrays = {}
+        for name in ["raw_data", "norm_data", "Data"]:
+            array = getattr(self, name, None)
+            if isinstance(array, np.ndarray):
+                arrays[name] = array
+            elif isinstance(array, StackedBlockView):
+                # the block slices the view is assembled from
+                for i, var_parts in enumerate(array.parts):
+                    for j, part in enumerate(var_parts):
+                        arrays[f"{name}[{i}][{j}]"] = part
+        return arrays
+
+    def drop_raw_data(self) -> int:
+        """
+        Drops the raw data if it is held next to the normalized data, it is not needed after normalization.
+
+        Returns:
+            int: Number of bytes freed.
+        """
+        raw_data, norm_data = getattr(self, "raw_data", None), getattr(self, "norm_data", None)
+        if isinstance(raw_data, StackedBlockView) and isinstance(norm_data, np.ndarray):
+            # a view of the memory-mapped block cache, dropping the reference frees no memory
+            del self.raw_data
+            return 0
+        if not isinstance(raw_data, np.ndarray) or not isinstance(norm_data, np.ndarray):
+            return 0
+        if np.shares_memory(raw_data, norm_data):
+            # not normalized (e.g. normalized on the device), the raw data is the data
+            return 0
+        # memory-mapped raw data (block cache) is not resident, dropping the reference frees no memory
+        freed = 0 if is_memory_mapped(raw_data) else raw_data.nbytes
+        del self.raw_data
+        return freed
+
     def load_into_mem(
         self, paths: List[List[str]], num_vars: int, channels_last: bool = True, 
         seq_to_seq: bool = True, seq_len: int = 12
@@ -186,15 +254,80 @@ class ABC_Climate_Dataset(ABC, torch.utils.data.Dataset):
             array_list.append(temp_data)
         temp_data = np.concatenate(array_list, axis=0)
 
+        return self.reshape_into_sequences(temp_data, num_vars, channels_last, seq_to_seq, seq_len)
+
+    def load_blocks_into_mem(
+        self, block_cache_dir: str, variables: List[str], years, historical_years, channels_last: bool = True,
+        seq_to_seq: bool = True, seq_len: int = 12
+    ) -> np.ndarray:
+        """
+        Loads the dataset as a view of the memory-mapped blocks of the block cache, reading only blocks that are not
+        cached yet.
+
+        Args:
+            block_cache_dir (str): Directory of the block cache.
+            variables (List[str]): Variables to load.
+            years: Years of the SSP scenarios.
+            historical_years: Years of the historical scenario.
+            channels_last (bool): If True, channels are last. Default is True.
+            seq_to_seq (bool): If True, uses sequence-to-sequence format. Default is True.
+            seq_len (int): Length of the sequence. Default is 12.
+
+        Returns:
+            StackedBlockView: The sequences, indexed like the array of load_into_mem.
+        """
+        block_cache = get_block_cache(block_cache_dir)
+        parts = [
+            [
+                block_cache.get(
+                    self.block_key(exp, var),
+                    historical_years if exp == "historical" else years,
+                    lambda y, exp=exp, var=var: self.get_nc_files(exp, var, y),
+                )
+                for exp in self.scenarios
+            ]
+            for var in variables
+        ]
+        num_steps = sum(len(part) for part in parts[0])
+        # the samples are assembled from the memory-mapped blocks when indexed, only the blocks exist on disk
+        return StackedBlockView(parts, self.num_sequences(num_steps, seq_len), seq_len, seq_to_seq, channels_last)
+
+    def block_key(self, exp: str, var: str) -> Tuple[str, ...]:
+        """Key of the block cache for a scenario and variable."""
+        raise NotImplementedError
+
+    def get_nc_files(self, exp: str, var: str, year: int) -> List[str]:
+        """NetCDF files of a scenario, variable and year."""
+        raise NotImplementedError
+
+    def num_sequences(self, num_steps: int, seq_len: int) -> int:
+        """Number of sequences of seq_len time steps in num_steps time steps of all scenarios."""
+        if seq_len != SEQ_LEN:
+            return int(np.floor(num_steps / seq_len / len(self.scenarios))) * len(self.scenarios)
+        return int(num_steps / seq_len)
+
+    def reshape_into_sequences(
+        self, temp_data: np.ndarray, num_vars: int, channels_last: bool = True, seq_to_seq: bool = True, seq_len: int = 12
+    ) -> np.ndarray:
+        """
+        Reshapes data of shape (num_vars, time, lon, lat) into sequences.
+
+        Args:
+            temp_data (np.ndarray): Data to reshape.
+            num_vars (int): Number of variables.
+            channels_last (bool): If True, channels are last. Default is True.
+            seq_to_seq (bool): If True, uses sequence-to-sequence format. Default is True.
+            seq_len (int): Length of the sequence. Default is 12.
+
+        Returns:
+            np.ndarray: Reshaped data.
+        """
+        new_shape_one = self.num_sequences(temp_data.shape[1], seq_len)
         if seq_len != SEQ_LEN:
-            new_num_years = int(np.floor(temp_data.shape[1] / seq_len / len(self.scenarios)))
-            new_shape_one = new_num_years * len(self.scenarios)
             assert new_shape_one * seq_len > temp_data.shape[1], (
                 f"New sequence length {seq_len} greater than available years {temp_data.shape[1]}!"
             )
             temp_data = temp_data[:, : (new_shape_one * seq_len), :]
-        else:
-            new_shape_one = int(temp_data.shape[1] / seq_len)
 
         temp_data = temp_data.reshape(num_vars, new_shape_one, seq_len, LON, LAT)
 
@@ -555,11 +688,16 @@ class CMIP6Dataset(ABC_Climate_Dataset):
         channels_last: bool = True,
         seq_to_seq: bool = True,
         seq_len: int = 12,
+        normalize: bool = True,
+        block_cache_dir: Optional[str] = None,
+        write_statistics: bool = True,
         *args,
         **kwargs,
     ):
         self.mode = mode
         self.output_save_dir = output_save_dir
+        self.data_dir = data_dir
+        self.climate_model = climate_model
 
         self.input_nc_files = []
         self.output_nc_files = []
@@ -584,7 +722,7 @@ class CMIP6Dataset(ABC_Climate_Dataset):
         fname = self.get_save_name_from_kwargs(
             mode=mode, file="target", kwargs=fname_kwargs
         )
-        if os.path.isfile(
+        if block_cache_dir is None and os.path.isfile(
             os.path.join(output_save_dir, fname)
         ):  # we first need to get the name here to test that...
             self.data_path = os.path.join(output_save_dir, fname)
@@ -601,47 +739,43 @@ class CMIP6Dataset(ABC_Climate_Dataset):
                 mode=self.mode,
                 mips="cmip6",
             )
-            self.Data = self.normalize_data(self.Data, stats)
+            self.Data = self.normalize_data(self.Data, stats) if normalize else self.Data
 
         else:
-            # List of output files
-            files_per_var = []
-            for var in variables:
-                output_nc_files = []
-
-                for exp in scenarios:
-                    if exp == "historical":
-                        get_years = historical_years
-                    else:
-                        get_years = years
-                    for y in get_years:
-                        # we only have one ensemble here
-                        var_dir = os.path.join(
-                            data_dir, exp, var, f"{CMIP6_NOM_RES}/{CMIP6_TEMP_RES}/{y}"
-                        )
-                        files = glob.glob(var_dir + f"/*.nc", recursive=True)
-                        if len(files) == 0:
-                            print(
-                                "No files for this climate model, ensemble member, var, year ,scenario:",
-                                climate_model,
-                                data_dir.split("/")[-1],
-                                var,
-                                y,
-                                exp,
-                            )
-                            print("Exiting! Please fix the data issue.")
-                            exit(0)
-                        # loads all years! implement splitting
-                        output_nc_files += files
-                files_per_var.append(output_nc_files)
-
-            self.raw_data = self.load_into_mem(
-                files_per_var,
-                num_vars=len(variables),
-                channels_last=channels_last,
-                seq_to_seq=seq_to_seq,
-                seq_len=seq_len,
-            )
+            if block_cache_dir is not None:
+                self.raw_data = self.load_blocks_into_mem(
+                    block_cache_dir,
+                    variables,
+                    years,
+                    historical_years,
+                    channels_last=channels_last,
+                    seq_to_seq=seq_to_seq,
+                    seq_len=seq_len,
+                )
+            else:
+                # List of output files
+                files_per_var = []
+                for var in variables:
+                    output_nc_files = []
+
+                    for exp in scenarios:
+                        if exp == "historical":
+                            get_years = historical_years
+                        else:
+                            get_years = years
+                        for y in get_years:
+                            # loads all years! implement splitting
+                            output_nc_files += self.get_nc_files(exp, var, y)
+                    files_per_var.append(output_nc_files)
+
+                self.raw_data = self.load_into_mem(
+                    files_per_var,
+                    num_vars=len(variables),
+                    channels_last=channels_last,
+                    seq_to_seq=seq_to_seq,
+                    seq_len=seq_len,
+                )
+
             if self.mode == "train" or self.mode == "train+val":
                 stats_fname = self.get_save_name_from_kwargs(
                     mode=mode, file="statistics", kwargs=fname_kwargs
@@ -650,18 +784,20 @@ class CMIP6Dataset(ABC_Climate_Dataset):
                 if os.path.isfile(fname):
                     print("Stats file already exists! Loading from memory.")
                     stats = self.load_statistics_data(stats_fname)
-                    self.norm_data = self.normalize_data(self.raw_data, stats)
+                    self.norm_data = self.normalize_data(self.raw_data, stats) if normalize else self.raw_data
 
                 else:
                     stat1, stat2 = self.get_dataset_statistics(
                         self.raw_data, self.mode, mips="cmip6"
                     )
-                    stats = {"mean": stat1, "std": stat2}
-                    self.norm_data = self.normalize_data(self.raw_data, stats)
-                    save_file_name = self.write_dataset_statistics(stats_fname, stats)
-                    print("WROTE STATISTICS", save_file_name)
+                    # min and max are stored too, for normalizing on the device with the training statistics
+                    stats = {"mean": stat1, "std": stat2, **dict(zip(("min", "max"), self.get_min_max(self.raw_data)))}
+                    self.norm_data = self.normalize_data(self.raw_data, stats) if normalize else self.raw_data
+                    if write_statistics:
+                        save_file_name = self.write_dataset_statistics(stats_fname, stats)
+                        print("WROTE STATISTICS", save_file_name)
 
-                self.norm_data = self.normalize_data(self.raw_data, stats)
+                self.norm_data = self.normalize_data(self.raw_data, stats) if normalize else self.raw_data
 
             elif self.mode == "test":
                 stats_fname = self.get_save_name_from_kwargs(
@@ -671,17 +807,50 @@ class CMIP6Dataset(ABC_Climate_Dataset):
                 stats = self.load_dataset_statistics(
                     stats_fname, mode=self.mode, mips="cmip6"
                 )
-                self.norm_data = self.normalize_data(self.raw_data, stats)
+                self.norm_data = self.normalize_data(self.raw_data, stats) if normalize else self.raw_data
 
-            self.data_path = self.save_data_into_disk(
-                self.raw_data, fname, output_save_dir
-            )
+            if block_cache_dir is None:
+                # the block cache already holds the raw data
+                self.data_path = self.save_data_into_disk(
+                    self.raw_data, fname, output_save_dir
+                )
 
-            self.copy_to_slurm(self.data_path)
+                self.copy_to_slurm(self.data_path)
 
             self.Data = self.norm_data
+        self.stats = stats
+        if not normalize and "min" not in stats:
+            # the raw data is kept and normalized on the device (see Normalizer), which also needs min and max
+            if self.mode == "test":
+                raise ValueError(
+                    "The training statistics have no min and max (written by an older version), "
+                    "set up the training data again to rewrite them."
+                )
+            self.stats = {**stats, **dict(zip(("min", "max"), self.get_min_max(self.Data)))}
         self.length = self.Data.shape[0]
 
+    def block_key(self, exp: str, var: str) -> Tuple[str, ...]:
+        return ("cmip6", self.climate_model, self.data_dir.split("/")[-1], exp, var)
+
+    def get_nc_files(self, exp: str, var: str, year: int) -> List[str]:
+        # we only have one ensemble here
+        var_dir = os.path.join(
+            self.data_dir, exp, var, f"{CMIP6_NOM_RES}/{CMIP6_TEMP_RES}/{year}"
+        )
+        files = glob.glob(var_dir + f"/*.nc", recursive=True)
+        if len(files) == 0:
+            print(
+                "No files for this climate model, ensemble member, var, year ,scenario:",
+                self.climate_model,
+                self.data_dir.split("/")[-1],
+                var,
+                year,
+                exp,
+            )
+            print("Exiting! Please fix the data issue.")
+            exit(0)
+        return files
+
     def __getitem__(self, index):
         return self.Data[index]
 
@@ -707,10 +876,14 @@ class Input4MipsDataset(ABC_Climate_Dataset):
         output_save_dir: str = "",
         seq_to_seq: bool = True,
         seq_len: int = 12,
+        normalize: bool = True,
+        block_cache_dir: Optional[str] = None,
+        write_statistics: bool = True,
         *args,
         **kwargs,
     ):
         self.channels_last = channels_last
+        self.openburning_specs = openburning_specs
 
         self.mode = mode
         self.root_dir = os.path.join(data_dir, "inputs/input4mips")
@@ -730,15 +903,13 @@ class Input4MipsDataset(ABC_Climate_Dataset):
             seq_len=seq_len,
         )
 
-        historical_openburning, ssp_openburning = openburning_specs
-
         fname = self.get_save_name_from_kwargs(
             mode=mode, file="input", kwargs=fname_kwargs
         )
 
         # Check here if os.path.isfile($SCRATCH/data.npz) exists #TODO: check if exists on slurm
         # if it does, use self._reload data(path)
-        if os.path.isfile(
+        if block_cache_dir is None and os.path.isfile(
             os.path.join(output_save_dir, fname)
         ):  # we first need to get the name here to test that...
             self.data_path = os.path.join(output_save_dir, fname)
@@ -754,58 +925,36 @@ class Input4MipsDataset(ABC_Climate_Dataset):
                 mode=self.mode,
                 mips="input4mips",
             )
-            self.Data = self.normalize_data(self.Data, stats)
+            self.Data = self.normalize_data(self.Data, stats) if normalize else self.Data
 
         else:
-            files_per_var = []
-            for var in variables:
-                output_nc_files = []
-
-                for exp in scenarios:
-                    if exp == "historical":
-                        get_years = historical_years
-                    else:
-                        get_years = years
-                    for y in get_years:
-                        var_dir = os.path.join(
-                            self.root_dir,
-                            exp,
-                            var,
-                            f"{CMIP6_NOM_RES}/{CMIP6_TEMP_RES}/{y}",
-                        )
-
-                output_nc_files = []
-                for exp in scenarios:
-                    if var in NO_OPENBURNING_VARS:
-                        filter_path_by = ""
-
-                    elif exp == "historical":
-                        filter_path_by = historical_openburning
-                        get_years = historical_years
-                    else:
-                        filter_path_by = ssp_openburning
-                        get_years = years
-
-                    for y in get_years:
-                        var_dir = os.path.join(
-                            self.root_dir,
-                            exp,
-                            var,
-                            f"{CMIP6_NOM_RES}/{CMIP6_TEMP_RES}/{y}",
-                        )
-                        files = glob.glob(
-                            var_dir + f"/**/*{filter_path_by}*.nc", recursive=True
-                        )
-                        output_nc_files += files
-                files_per_var.append(output_nc_files)
-
-            self.raw_data = self.load_into_mem(
-                files_per_var,
-                num_vars=len(variables),
-                channels_last=self.channels_last,
-                seq_to_seq=True,
-                seq_len=seq_len,
-            )  # we always want the full sequence for input4mips
+            if block_cache_dir is not None:
+                self.raw_data = self.load_blocks_into_mem(
+                    block_cache_dir,
+                    variables,
+                    years,
+                    historical_years,
+                    channels_last=self.channels_last,
+                    seq_to_seq=True,
+                    seq_len=seq_len,
+                )  # we always want the full sequence for input4mips
+            else:
+                files_per_var = []
+                for var in variables:
+                    output_nc_files = []
+                    for exp in scenarios:
+                        get_years = historical_years if exp == "historical" else years
+                        for y in get_years:
+                            output_nc_files += self.get_nc_files(exp, var, y)
+                    files_per_var.append(output_nc_files)
+
+                self.raw_data = self.load_into_mem(
+                    files_per_var,
+                    num_vars=len(variables),
+                    channels_last=self.channels_last,
+                    seq_to_seq=True,
+                    seq_len=seq_len,
+                )  # we always want the full sequence for input4mips
 
             if self.mode == "train" or self.mode == "train+val":
                 stats_fname = self.get_save_name_from_kwargs(
@@ -815,17 +964,19 @@ class Input4MipsDataset(ABC_Climate_Dataset):
                 if os.path.isfile(stats_fname):
                     print("Stats file already exists! Loading from mempory.")
                     stats = self.load_statistics_data(stats_fname)
-                    self.norm_data = self.normalize_data(self.raw_data, stats)
+                    self.norm_data = self.normalize_data(self.raw_data, stats) if normalize else self.raw_data
 
                 else:
                     stat1, stat2 = self.get_dataset_statistics(
                         self.raw_data, self.mode, mips="cmip6"
                     )
-                    stats = {"mean": stat1, "std": stat2}
-                    self.norm_data = self.normalize_data(self.raw_data, stats)
-                    save_file_name = self.write_dataset_statistics(stats_fname, stats)
+                    # min and max are stored too, for normalizing on the device with the training statistics
+                    stats = {"mean": stat1, "std": stat2, **dict(zip(("min", "max"), self.get_min_max(self.raw_data)))}
+                    self.norm_data = self.normalize_data(self.raw_data, stats) if normalize else self.raw_data
+                    if write_statistics:
+                        save_file_name = self.write_dataset_statistics(stats_fname, stats)
 
-                self.norm_data = self.normalize_data(self.raw_data, stats)
+                self.norm_data = self.normalize_data(self.raw_data, stats) if normalize else self.raw_data
 
             elif self.mode == "test":
                 stats_fname = self.get_save_name_from_kwargs(
@@ -834,18 +985,48 @@ class Input4MipsDataset(ABC_Climate_Dataset):
                 stats = self.load_dataset_statistics(
                     stats_fname, mode=self.mode, mips="input4mips"
                 )
-                self.norm_data = self.normalize_data(self.raw_data, stats)
+                self.norm_data = self.normalize_data(self.raw_data, stats) if normalize else self.raw_data
 
-            self.data_path = self.save_data_into_disk(
-                self.raw_data, fname, output_save_dir
-            )
+            if block_cache_dir is None:
+                # the block cache already holds the raw data
+                self.data_path = self.save_data_into_disk(
+                    self.raw_data, fname, output_save_dir
+                )
 
-            self.copy_to_slurm(self.data_path)
+                self.copy_to_slurm(self.data_path)
 
             self.Data = self.norm_data
-
+        self.stats = stats
+        if not normalize and "min" not in stats:
+            # the raw data is kept and normalized on the device (see Normalizer), which also needs min and max
+            if self.mode == "test":
+                raise ValueError(
+                    "The training statistics have no min and max (written by an older version), "
+                    "set up the training data again to rewrite them."
+                )
+            self.stats = {**stats, **dict(zip(("min", "max"), self.get_min_max(self.Data)))}
         self.length = self.Data.shape[0]
 
+    def openburning_filter(self, exp: str, var: str) -> str:
+        if var in NO_OPENBURNING_VARS:
+            return ""
+        historical_openburning, ssp_openburning = self.openburning_specs
+        return historical_openburning if exp == "historical" else ssp_openburning
+
+    def block_key(self, exp: str, var: str) -> Tuple[str, ...]:
+        return ("input4mips", self.openburning_filter(exp, var), exp, var)
+
+    def get_nc_files(self, exp: str, var: str, year: int) -> List[str]:
+        var_dir = os.path.join(
+            self.root_dir,
+            exp,
+            var,
+            f"{CMIP6_NOM_RES}/{CMIP6_TEMP_RES}/{year}",
+        )
+        return glob.glob(
+            var_dir + f"/**/*{self.openburning_filter(exp, var)}*.nc", recursive=True
+        )
+
     def __getitem__(self, index):
         return self.Data[index]
 
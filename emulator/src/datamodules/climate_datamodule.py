@@ -6,6 +6,8 @@ from pytorch_lightning.utilities.types import EVAL_DATALOADERS
 from torch.utils.data import DataLoader
 
 from emulator.src.data.climate_dataset import ClimateDataset
+from emulator.src.datamodules.prefetch_loader import prefetch_dataloader
+from emulator.src.data.custom_transforms import Normalizer
 import torch
 from emulator.src.data.constants import (
     TEMP_RES,
@@ -55,11 +57,13 @@ class ClimateDataModule(LightningDataModule):
         test_models: Union[List[str], None] = None,
         batch_size: int = 16,
         eval_batch_size: int = 64,
+        effective_batch_size: Optional[int] = None,
         emissions_tracker:bool = False,
         num_workers: int = 0,
         shuffle:bool = False,
         persistent_workers:bool = False,
         pin_memory: bool = False,
+        prefetch_batches: int = 0,
         load_train_into_mem: bool = True,
         load_test_into_mem: bool = True,
         verbose: bool = True,
@@ -70,6 +74,7 @@ class ClimateDataModule(LightningDataModule):
         lon: int = LON,
         lat: int = LAT,
         num_levels: int = NUM_LEVELS,
+        normalize_on_device: Optional[str] = None,
         name: str = "climate",
         # input_transform: Optional[AbstractTransform] = None,
         # normalizer: Optional[Normalizer] = None,
@@ -78,9 +83,15 @@ class ClimateDataModule(LightningDataModule):
         Args:
             batch_size (int): Batch size for the training dataloader
             eval_batch_size (int): Batch size for the test and validation dataloader's
+            effective_batch_size (int): Samples per optimizer step, if larger than batch_size the gradients of
+                effective_batch_size / batch_size batches are accumulated (sets trainer.accumulate_grad_batches).
             num_workers (int): Dataloader arg for higher efficiency
             pin_memory (bool): Dataloader arg for higher efficiency
+            prefetch_batches (int): If > 0, keep this many batches staged on the device, copying them asynchronously
+                from reused pinned buffers (see PrefetchLoader).
             seed (int): Used to seed the validation-test set split, such that the split will always be the same.
+            normalize_on_device (str): If set ("z-norm" or "minmax"), the datasets keep the raw data and batches are
+                normalized on the device in on_after_batch_transfer by a Normalizer
         """
         super().__init__()
 
@@ -110,6 +121,7 @@ class ClimateDataModule(LightningDataModule):
         self._data_val = None
         self._data_test = None
         self._data_predict = None
+        self.normalizer: Optional[Normalizer] = None
         self.log_text = get_logger()
 
     def prepare_data(self):
@@ -129,6 +141,7 @@ class ClimateDataModule(LightningDataModule):
             channels_last=self.hparams.channels_last,
             seq_to_seq=self.hparams.seq_to_seq,
             seq_len=self.hparams.seq_len,
+            normalize=self.hparams.normalize_on_device is None,
             # input_transform = None, # TODO: implement
             # input_normalization = None, #TODO: implement
             # output_transform = None,
@@ -159,6 +172,8 @@ class ClimateDataModule(LightningDataModule):
             train_ds, val_ds = ds_list
             self._data_train = train_ds
             self._data_val = val_ds
+            if self.hparams.normalize_on_device is not None:
+                self.normalizer = self.create_normalizer(full_ds)
 
         # Test sets:
         if stage == "test" or stage is None:
@@ -175,15 +190,39 @@ class ClimateDataModule(LightningDataModule):
                 for test_model in self.test_models
             ]
 
+            if self.hparams.normalize_on_device is not None and self.normalizer is None:
+                # test datasets are loaded with the training statistics
+                self.normalizer = self.create_normalizer(self._data_test[0])
+
         # Prediction set:
         if stage == "predict":
             print("Prediction Set not yet implemented. Using Test Set.")
             self._data_predict = self._data_test
 
+    def create_normalizer(self, ds: Optional[ClimateDataset] = None, norm_type: Optional[str] = None) -> Normalizer:
+        """
+        Create the Normalizer from the training statistics of a dataset, by default of the training dataset.
+        norm_type defaults to normalize_on_device, the datasets normalized on the host use "z-norm".
+        """
+        if ds is None:
+            if self._data_train is None:
+                raise ValueError("The training data is not set up, call setup('fit') first.")
+            ds = self._data_train.dataset
+        return Normalizer(
+            input_stats={key: stat.reshape(1, -1) for key, stat in ds.input4mips_ds.stats.items()},
+            output_stats={key: stat.reshape(1, -1) for key, stat in ds.cmip6_ds.stats.items()},
+            norm_type=norm_type or self.hparams.normalize_on_device or "z-norm",
+            channels_last=self.hparams.channels_last,
+        )
+
     def on_before_batch_transfer(self, batch, dataloader_idx):
+        # with prefetch_batches > 0 the batch already is on the device here
         return batch
 
     def on_after_batch_transfer(self, batch, dataloader_idx):
+        if self.normalizer is not None:
+            self.normalizer.to(batch[0].device)
+            batch = self.normalizer(batch)
         return batch
 
     def _shared_dataloader_kwargs(self) -> dict:
@@ -204,24 +243,32 @@ class ClimateDataModule(LightningDataModule):
     # resulting tensors sizes:
     # x: (batch_size, sequence_length, lon, lat, in_vars) if channels_last else (batch_size, sequence_lenght, in_vars, lon, lat)
     # y: (batch_size, sequence_length, lon, lat, out_vars) if channels_last else (batch_size, sequence_lenght, out_vars, lon, lat)
+    def _prefetch(self, dataloader: DataLoader, shuffle: bool = False):
+        return prefetch_dataloader(
+            dataloader, self.trainer, self.hparams.prefetch_batches, shuffle=shuffle, seed=self.hparams.seed
+        )
+
     def train_dataloader(self):
-        return DataLoader(
-            dataset=self._data_train,
-            batch_size=self.hparams.batch_size,
+        return self._prefetch(
+            DataLoader(
+                dataset=self._data_train,
+                batch_size=self.hparams.batch_size,
+                shuffle=True,
+                **self._shared_dataloader_kwargs(),
+            ),
             shuffle=True,
-            **self._shared_dataloader_kwargs(),
         )
 
     def val_dataloader(self):
         return (
-            DataLoader(dataset=self._data_val, **self._shared_eval_dataloader_kwargs())
+            self._prefetch(DataLoader(dataset=self._data_val, **self._shared_eval_dataloader_kwargs()))
             if self._data_val is not None
             else None
         )
 
     def test_dataloader(self) -> List[DataLoader]:
         return [
-            DataLoader(dataset=ds_test, **self._shared_eval_dataloader_kwargs())
+            self._prefetch(DataLoader(dataset=ds_test, **self._shared_eval_dataloader_kwargs()))
             for ds_test in self._data_test
         ]
 
@@ -3,7 +3,7 @@ from typing import Optional, List, Callable
 
 from pytorch_lightning import LightningDataModule
 from pytorch_lightning.utilities.types import EVAL_DATALOADERS
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, Dataset
 
 
 import torch
@@ -13,6 +13,21 @@ from emulator.src.utils.utils import get_logger, random_split
 log = get_logger()
 
 
+class DummySuperDataset(Dataset):
+    """Wraps the dummy tensors and assigns the climate models round-robin, yielding super emulation batches (X, Y, model id)."""
+
+    def __init__(self, inputs: torch.Tensor, targets: torch.Tensor, climate_models: List[str]):
+        self.inputs = inputs
+        self.targets = targets
+        self.climate_models = climate_models
+
+    def __len__(self):
+        return len(self.inputs)
+
+    def __getitem__(self, index):
+        return self.inputs[index], self.targets[index], self.climate_models[index % len(self.climate_models)]
+
+
 class DummyDataModule(LightningDataModule):
     """
     This is a Dummy Class for testing purposes.
@@ -44,6 +59,7 @@ class DummyDataModule(LightningDataModule):
         channels_last: bool = True,  # wheather variables come last our after sequence lenght
         batch_size: int = 16,
         eval_batch_size: int = 64,
+        effective_batch_size: Optional[int] = None,
         num_workers: int = 0,
         shuffle:bool = False,
         persistent_workers:bool = False,
@@ -59,6 +75,8 @@ class DummyDataModule(LightningDataModule):
         # input_transform: Optional[AbstractTransform] = None,
         # normalizer: Optional[Normalizer] = None,
         test_set_names: List[str] = ["main", "second"],
+        train_models: Optional[List[str]] = None,
+        test_models: Optional[List[str]] = None,
     ):
         """
         Args:
@@ -74,9 +92,13 @@ class DummyDataModule(LightningDataModule):
             val_split (float): Fraction of data to use for evaluation.
             batch_size (int): Batch size for the training dataloader
             eval_batch_size (int): Batch size for the test and validation dataloader's
+            effective_batch_size (int): Samples per optimizer step, if larger than batch_size the gradients of
+                effective_batch_size / batch_size batches are accumulated (sets trainer.accumulate_grad_batches).
             num_workers (int): Dataloader arg for higher efficiency
             pin_memory (bool): Dataloader arg for higher efficiency
             seed (int): Used to seed the validation-test set split, such that the split will always be the same.
+            train_models (List(str)): If given, batches also contain a (dummy) climate model id per sample, as in super emulation.
+            test_models (List(str)): Only used by the decoder config.
         """
         super().__init__()
 
@@ -150,9 +172,13 @@ class DummyDataModule(LightningDataModule):
                 )
             )
 
-        inputs = inputs.cuda()
-        targets = targets.cuda()
-        dataset = torch.utils.data.TensorDataset(inputs, targets)
+        if torch.cuda.is_available():
+            inputs = inputs.cuda()
+            targets = targets.cuda()
+        if self.hparams.train_models:
+            dataset = DummySuperDataset(inputs, targets, list(self.hparams.train_models))
+        else:
+            dataset = torch.utils.data.TensorDataset(inputs, targets)
         fractions = [
             (1 - (self.hparams.test_split + self.hparams.val_split)),
             self.hparams.test_split,
@@ -0,0 +1,193 @@
+import queue
+import threading
+from collections import deque
+from typing import Any, Callable, List, Optional, Union
+
+import torch
+from torch.utils.data import DataLoader
+from torch.utils.data.distributed import DistributedSampler
+
+from emulator.src.utils.utils import get_logger
+
+log = get_logger()
+
+
+def _apply_to_tensors(batch: Any, fn: Callable[[torch.Tensor], torch.Tensor]) -> Any:
+    """Apply fn to all tensors of a (nested) batch, leaving everything else (e.g. model ids) untouched."""
+    if isinstance(batch, torch.Tensor):
+        return fn(batch)
+    if isinstance(batch, tuple):
+        return tuple(_apply_to_tensors(b, fn) for b in batch)
+    if isinstance(batch, list):
+        return [_apply_to_tensors(b, fn) for b in batch]
+    if isinstance(batch, dict):
+        return {k: _apply_to_tensors(v, fn) for k, v in batch.items()}
+    return batch
+
+
+class PrefetchLoader:
+    """
+    Wraps a dataloader and keeps ``num_batches`` batches staged on the device ahead of the consumer.
+
+    On CUDA, batches are copied into pinned host buffers that are reused across steps and epochs, and the
+    host-to-device copies run on a separate stream so that they overlap with the forward/backward pass.
+    On CPU-only machines, a background thread fetches the next batches while the current one is processed.
+
+    Batches come out already on the device, so Lightning's batch transfer becomes a no-op.
+    """
+
+    def __init__(self, dataloader: DataLoader, device: Union[str, torch.device], num_batches: int = 2):
+        self.dataloader = dataloader
+        self.device = torch.device(device)
+        self.num_batches = max(1, int(num_batches))
+        # one list of pinned tensors per staging slot, in the order the tensors appear in a batch
+        self._pinned_buffers: List[List[torch.Tensor]] = [[] for _ in range(self.num_batches)]
+
+    def __len__(self) -> int:
+        return len(self.dataloader)
+
+    def __getattr__(self, name: str) -> Any:
+        # expose sampler, dataset, batch_size, ... of the wrapped dataloader (e.g. for Lightning's set_epoch)
+        if name == "dataloader":
+            raise AttributeError(name)
+        return getattr(self.dataloader, name)
+
+    def __iter__(self):
+        if self.device.type == "cuda" and torch.cuda.is_available():
+            return self._cuda_iter()
+        return self._thread_iter()
+
+    def _pin(self, batch: Any, slot: int) -> Any:
+        """Copy the tensors of a batch into the reusable pinned buffers of a slot."""
+        buffers = self._pinned_buffers[slot]
+        i = 0
+
+        def pin(tensor: torch.Tensor) -> torch.Tensor:
+            nonlocal i
+            if tensor.is_pinned():
+                # already pinned by the dataloader
+                return tensor
+            if i == len(buffers):
+                buffers.append(torch.empty(tensor.shape, dtype=tensor.dtype, pin_memory=True))
+            elif buffers[i].shape != tensor.shape or buffers[i].dtype != tensor.dtype:
+                # e.g. the last, smaller batch of an epoch
+                buffers[i] = torch.empty(tensor.shape, dtype=tensor.dtype, pin_memory=True)
+            buffer = buffers[i].copy_(tensor)
+            i += 1
+            return buffer
+
+        return _apply_to_tensors(batch, pin)
+
+    def _cuda_iter(self):
+        stream = torch.cuda.Stream(device=self.device)
+        # event of the last copy out of every slot, a slot is only overwritten once its copy has finished
+        slot_events: List[Optional[torch.cuda.Event]] = [None] * self.num_batches
+        staged = deque()
+        slot = 0
+
+        def stage(batch):
+            nonlocal slot
+            if slot_events[slot] is not None:
+                slot_events[slot].synchronize()
+            pinned = self._pin(batch, slot)
+            with torch.cuda.stream(stream):
+                device_batch = _apply_to_tensors(pinned, lambda t: t.to(self.device, non_blocking=True))
+                event = torch.cuda.Event()
+                event.record(stream)
+            slot_events[slot] = event
+            staged.append((device_batch, event))
+            slot = (slot + 1) % self.num_batches
+
+        iterator = iter(self.dataloader)
+        for batch in iterator:
+            stage(batch)
+            if len(staged) == self.num_batches:
+                break
+
+        while staged:
+            device_batch, event = staged.popleft()
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_event(event)
+            # the memory was allocated on the copy stream, make sure it is not reused while still in use
+            _apply_to_tensors(device_batch, lambda t: t.record_stream(current_stream))
+            next_batch = next(iterator, None)
+            if next_batch is not None:
+                stage(next_batch)
+            yield device_batch
+
+    def _thread_iter(self):
+        staged = queue.Queue(maxsize=self.num_batches)
+        stop = threading.Event()
+        done = object()
+
+        def put(item) -> bool:
+            while not stop.is_set():
+                try:
+                    staged.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def worker():
+            try:
+                for batch in self.dataloader:
+                    if not put(_apply_to_tensors(batch, lambda t: t.to(self.device))):
+                        return
+            except Exception as e:
+                put(e)
+                return
+            put(done)
+
+        thread = threading.Thread(target=worker, daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = staged.get()
+                if item is done:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+            thread.join()
+
+
+def prefetch_dataloader(
+    dataloader: DataLoader, trainer, num_batches: int, shuffle: bool = False, seed: int = 0
+) -> Union[DataLoader, PrefetchLoader]:
+    """
+    Wrap a dataloader into a PrefetchLoader onto the device of the trainer, if ``num_batches`` > 0.
+
+    Lightning only injects its DistributedSampler into plain DataLoaders, so under DDP the dataloader is
+    rebuilt with a DistributedSampler before wrapping it (unless it already uses one), keeping all other
+    arguments of the original dataloader.
+    """
+    if not num_batches or trainer is None:
+        return dataloader
+
+    if trainer.world_size > 1 and not isinstance(dataloader.sampler, DistributedSampler):
+        sampler = DistributedSampler(
+            dataloader.dataset, num_replicas=trainer.world_size, rank=trainer.global_rank, shuffle=shuffle, seed=seed
+        )
+        dataloader = DataLoader(
+            dataset=dataloader.dataset,
+            batch_size=dataloader.batch_size,
+            sampler=sampler,
+            num_workers=dataloader.num_workers,
+            collate_fn=dataloader.collate_fn,
+            pin_memory=dataloader.pin_memory,
+            drop_last=dataloader.drop_last,
+            timeout=dataloader.timeout,
+            worker_init_fn=dataloader.worker_init_fn,
+            multiprocessing_context=dataloader.multiprocessing_context,
+            generator=dataloader.generator,
+            prefetch_factor=dataloader.prefetch_factor,
+            persistent_workers=dataloader.persistent_workers,
+            pin_memory_device=dataloader.pin_memory_device,
+        )
+
+    device = trainer.strategy.root_device
+    log.info(f"Prefetching {num_batches} batches onto {device}.")
+    return PrefetchLoader(dataloader, device=device, num_batches=num_batches)
@@ -1,12 +1,18 @@
 import logging
 import copy
+import weakref
 from typing import Optional, List, Callable, Union, Dict
 import os
 from pytorch_lightning import LightningDataModule
 from pytorch_lightning.utilities.types import EVAL_DATALOADERS
 from torch.utils.data import DataLoader
+from torch.utils.data.distributed import DistributedSampler
 from emulator.src.data.super_climate_dataset import (SuperClimateDataset,CMIP6Dataset,Input4MipsDataset)
+from emulator.src.datamodules.prefetch_loader import prefetch_dataloader
+from emulator.src.data.custom_transforms import Normalizer
+from emulator.src.data.memory_accounting import MemoryReport
 import torch
+import torch.distributed as dist
 from emulator.src.data.constants import (
     TEMP_RES,
     SEQ_LEN_MAPPING,
@@ -46,19 +52,31 @@ class StateManager:
         reset_val_index (int): Reset index for validation data.
         reset_train_index (int): Reset index for training data.
         reset_test_index (None): Reset index for test data.
+        rank (int): Rank of this process when the (model, member) blocks are sharded across processes.
+        world_size (int): Number of processes the (model, member) blocks are sharded across.
+        all_climate_models (list): All climate models of the experiment, including those held by other ranks.
     """
     
-    def __init__(self, initial_model_index, initial_member_index, climate_models, out_var_ids, in_var_ids, ds_kwargs, dir, ensembles, mode="train", val_split=0.1):
+    def __init__(self, initial_model_index, initial_member_index, climate_models, out_var_ids, in_var_ids, ds_kwargs, dir, ensembles, mode="train", val_split=0.1, rank=0, world_size=1):
         self.device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
         
         self.cmip6_model_index = initial_model_index
         self.cmip6_member_index = initial_member_index
-        self.climate_models = climate_models
+        self.all_climate_models = list(climate_models)
         self.num_ensembles = self.create_num_ensembles(ensembles)
         self.ds_kwargs = ds_kwargs
+        self.out_var_ids = out_var_ids
         self.dir = dir
-        
-        self.openburning_specs = self.generate_openburning_specs(climate_models)
+        self.rank = rank
+        self.world_size = world_size
+
+        # only keep the (model, member) blocks assigned to this rank
+        self.shard_blocks = self.get_shard_blocks()
+        self.climate_models = [model for model in self.all_climate_models if model in self.shard_blocks]
+        if len(self.climate_models) == 0:
+            raise ValueError(f"Rank {rank} of {world_size} did not get any (model, member) block. Use at most as many ranks as blocks.")
+
+        self.openburning_specs = self.generate_openburning_specs(self.climate_models)
         self.cmip6_ds_model = self.create_cmip6_ds(out_var_ids, mode)
         self.input4mips_ds = self.create_input4mips_datasets(in_var_ids)
         self.index_shifts = self.calculate_index_shifts()
@@ -76,9 +94,27 @@ class StateManager:
     def create_num_ensembles(self, start_val):
         """Create the number of ensembles for each climate model."""
         if isinstance(start_val, int):
-            return [start_val] * len(self.climate_models)
+            return [start_val] * len(self.all_climate_models)
         return start_val
 
+    def get_shard_blocks(self):
+        """
+        Assign the (model, member) blocks round-robin to the ranks.
+
+        Returns:
+            dict: Maps each climate model held by this rank to the ensemble member directories it has to load.
+        """
+        blocks = []
+        for climate_model, num_ensembles in zip(self.all_climate_models, self.num_ensembles):
+            root_dir = os.path.join(self.dir, "outputs/CMIP6", climate_model)
+            blocks += [(climate_model, em) for em in self.get_ensemble_dirs(root_dir, num_ensembles)]
+
+        shard_blocks = {}
+        for i, (climate_model, em) in enumerate(blocks):
+            if i % self.world_size == self.rank:
+                shard_blocks.setdefault(climate_model, []).append(em)
+        return shard_blocks
+
     def model_index_to_spec(self, index):
         """Get the openburning spec for a given model index."""
         return self.openburning_specs[index]
@@ -97,24 +133,22 @@ class StateManager:
     def create_cmip6_ds(self, out_var_ids, mode):
         """Create CMIP6 datasets for each climate model and ensemble."""
         cmip6_ds_model = []
-        for climate_model, num_ensembles, openburning_specs in zip(self.climate_models, self.num_ensembles, self.openburning_specs):
-            cmip6_ds_model_member = self.create_cmip6_model_members(climate_model, num_ensembles, openburning_specs, out_var_ids)
+        for climate_model, openburning_specs in zip(self.climate_models, self.openburning_specs):
+            cmip6_ds_model_member = self.create_cmip6_model_members(climate_model, self.shard_blocks[climate_model], openburning_specs, out_var_ids)
             cmip6_ds_model.append(cmip6_ds_model_member)
         return cmip6_ds_model
 
-    def create_cmip6_model_members(self, climate_model, num_ensembles, openburning_specs, out_var_ids):
+    def create_cmip6_model_members(self, climate_model, ensemble_dirs, openburning_specs, out_var_ids):
         """Create CMIP6 model members for a given climate model."""
         cmip6_ds_model_member = []
-        root_dir = os.path.join(self.dir, "outputs/CMIP6", climate_model)
-        
-        ensemble_dirs = self.get_ensemble_dirs(root_dir, num_ensembles)
         for em in ensemble_dirs:
             cmip6_ds_model_member.append(self.create_cmip6_dataset(em, climate_model, openburning_specs, out_var_ids))
         return cmip6_ds_model_member
 
     def create_cmip6_dataset(self, data_dir, climate_model, openburning_specs, out_var_ids):
         """Create a single CMIP6 dataset."""
-        kwargs = self.ds_kwargs
+        # copy so that the data dir is still available for the Input4MIPs datasets
+        kwargs = dict(self.ds_kwargs)
         if("data_dir" in kwargs):
             kwargs.pop("data_dir")
         return CMIP6Dataset(
@@ -122,12 +156,15 @@ class StateManager:
             climate_model=climate_model,
             openburning_specs=openburning_specs,
             variables=out_var_ids,
+            # when sharded, a rank only sees some members of a model, the combined statistics are written by rank 0
+            write_statistics=self.world_size == 1,
             **kwargs,
         )
 
     def get_ensemble_dirs(self, root_dir, num_ensembles):
         """Get the directories for ensemble members."""
-        ensembles = os.listdir(root_dir)
+        # sorted so that all ranks see the members in the same order
+        ensembles = sorted(os.listdir(root_dir))
         if num_ensembles == 1:
             return [os.path.join(root_dir, ensembles[0])]
         
@@ -144,30 +181,31 @@ class StateManager:
         """Create Input4MIPs datasets."""
         input4mips_ds = {}
         for spec in set(self.openburning_specs):
-            input4mips_ds[spec] = Input4MipsDataset(variables=in_var_ids, openburning_specs=spec, **self.ds_kwargs)
+            # every rank loads the same Input4MIPs data, only one of them writes its statistics
+            input4mips_ds[spec] = Input4MipsDataset(
+                variables=in_var_ids, openburning_specs=spec, write_statistics=self.rank == 0, **self.ds_kwargs
+            )
         return input4mips_ds
 
     def calculate_index_shifts(self):
-        """Calculate shifts in indexes for dataset alignment."""
-        lengths_model = []
+        """Calculate shifts in indexes for dataset alignment (start index of every (model, member) block)."""
+        index_shifts = []
+        shift = 0
+        # models may hold a different number of members (e.g. when sharded across ranks)
         for model in self.cmip6_ds_model:
-            lengths_member = []
+            member_shifts = []
             for member in model:
-                lengths_member.append(member.length)
-            lengths_model.append(lengths_member)
-
-        lengths_model = np.asarray(lengths_model)
-        # roll by one to get the correct shift
-        lengths_model = np.roll(lengths_model, 1)
-        lengths_model[0][0] = 0
-        index = np.cumsum(lengths_model).reshape(lengths_model.shape)
-        return index
+                member_shifts.append(shift)
+                shift += member.length
+            index_shifts.append(member_shifts)
+        return index_shifts
         
     def split_datasets(self, val_split):
         """Split the dataset into training and validation sets."""
         self.total_length = self.get_initial_length()
         self.val_indexes = np.sort(np.random.choice(self.total_length, int(np.round(val_split * self.total_length)), replace=False))
-        self.reset_val_index = self.val_indexes[0]
+        # e.g. no validation samples for very small datasets
+        self.reset_val_index = self.val_indexes[0] if len(self.val_indexes) > 0 else None
         self.train_indexes = np.delete(np.arange(self.total_length), self.val_indexes)
         self.reset_train_index = self.train_indexes[0]
         self.test_indexes = self.total_length
@@ -178,11 +216,13 @@ class StateManager:
         in_lengths = [self.input4mips_ds[spec].length for spec in self.openburning_specs]
         assert all(length == in_lengths[0] for length in in_lengths), "Input4MIPs datasets do not have the same length for each openburning spec!"
 
-        for i, model in enumerate(self.cmip6_ds_model):
+        total_length = 0
+        for model in self.cmip6_ds_model:
             out_lengths = [ds.length for ds in model]
-            assert in_lengths[0] * self.num_ensembles[i] == np.sum(out_lengths), f"CMIP6 must be num_ensembles times the length of Input4MIPs. Got {np.sum(out_lengths)} and {in_lengths[0] * self.num_ensembles[i]}"
+            assert in_lengths[0] * len(model) == np.sum(out_lengths), f"CMIP6 must be num_ensembles times the length of Input4MIPs. Got {np.sum(out_lengths)} and {in_lengths[0] * len(model)}"
+            total_length += np.sum(out_lengths)
 
-        return np.sum(out_lengths) * len(self.cmip6_ds_model)
+        return total_length
 
     def find_interval(self, intervals, number):
         """Find the interval in which a number falls."""
@@ -197,14 +237,148 @@ class StateManager:
         return -1
 
     def increment_cmip6_index(self, index):
-        """Increment the CMIP6 model and member index based on the given index."""
+        """Set the CMIP6 model and member index to the (model, member) block the given index falls into."""
         self.cmip6_model_index = self.find_interval(self.index_shifts, index)
-        if self.cmip6_member_index + 1 >= len(self.cmip6_ds_model[self.cmip6_model_index]):
-            self.cmip6_member_index = 0
-        else:
-            self.cmip6_member_index += 1
+        member_shifts = [[shift] for shift in self.index_shifts[self.cmip6_model_index]]
+        self.cmip6_member_index = self.find_interval(member_shifts, index)
         return self.cmip6_model_index, self.cmip6_member_index
 
+    def cmip6_statistics(self):
+        """Get the element counts and statistics of the local CMIP6 blocks per climate model."""
+        num_vars = self.cmip6_ds_model[0][0].stats["mean"].size
+        return {
+            climate_model: [(member.Data.size / num_vars, member.stats) for member in model]
+            for climate_model, model in zip(self.climate_models, self.cmip6_ds_model)
+        }
+
+    def input4mips_statistics(self):
+        """Get the element counts and statistics of the Input4MIPs data used by the local climate models."""
+        statistics = {}
+        for climate_model, spec in zip(self.climate_models, self.openburning_specs):
+            ds = self.input4mips_ds[spec]
+            statistics[climate_model] = [(ds.Data.size / ds.stats["mean"].size, ds.stats)]
+        return statistics
+
+    def combine_statistics(self, statistics):
+        """
+        Combine block statistics per climate model, across all ranks if sharded.
+
+        The per-model mean and std are computed from the element counts, sums and squared sums of all blocks,
+        min and max (if available) from the block extrema. Ranks without blocks of a model contribute nothing.
+
+        Args:
+            statistics (dict): Maps each local climate model to a list of (count, stats) of its blocks.
+
+        Returns:
+            dict: Maps each climate model to its combined stats with entries of shape (num_vars,).
+        """
+        first = next(iter(statistics.values()))[0][1]
+        num_vars = first["mean"].size
+        with_min_max = "min" in first
+
+        moments = torch.zeros((len(self.all_climate_models), 3, num_vars), dtype=torch.float64)
+        extrema = torch.stack([
+            torch.full((len(self.all_climate_models), num_vars), np.inf, dtype=torch.float64),
+            torch.full((len(self.all_climate_models), num_vars), np.inf, dtype=torch.float64),
+        ])
+        for climate_model, blocks in statistics.items():
+            i = self.all_climate_models.index(climate_model)
+            for count, stats in blocks:
+                mean = stats["mean"].reshape(-1).astype(np.float64)
+                std = stats["std"].reshape(-1).astype(np.float64)
+                moments[i, 0] += count
+                moments[i, 1] += torch.from_numpy(count * mean)
+                moments[i, 2] += torch.from_numpy(count * (std**2 + mean**2))
+                if with_min_max:
+                    # the max is stored negated, so that min and max are reduced with a single MIN
+                    extrema[0, i] = torch.minimum(extrema[0, i], torch.from_numpy(stats["min"].reshape(-1).astype(np.float64)))
+                    extrema[1, i] = torch.minimum(extrema[1, i], -torch.from_numpy(stats["max"].reshape(-1).astype(np.float64)))
+
+        if dist.is_available() and dist.is_initialized() and self.world_size > 1:
+            # nccl can only reduce device tensors
+            device = torch.device("cuda", torch.cuda.current_device()) if dist.get_backend() == "nccl" else torch.device("cpu")
+            moments, extrema = moments.to(device), extrema.to(device)
+            dist.all_reduce(moments, op=dist.ReduceOp.SUM)
+            if with_min_max:
+                dist.all_reduce(extrema, op=dist.ReduceOp.MIN)
+            moments, extrema = moments.cpu(), extrema.cpu()
+
+        moments, extrema = moments.numpy(), extrema.numpy()
+        combined = {}
+        for i, climate_model in enumerate(self.all_climate_models):
+            count, total, total_sq = moments[i]
+            if np.all(count == 0):
+                continue
+            mean = total / count
+            combined[climate_model] = {"mean": mean, "std": np.sqrt(np.maximum(total_sq / count - mean**2, 0.0))}
+            if with_min_max:
+                combined[climate_model].update({"min": extrema[0, i], "max": -extrema[1, i]})
+        return combined
+
+    def save_statistics(self, statistics):
+        """
+        Write the combined CMIP6 statistics of every climate model to its statistics file, once on rank 0, so that
+        e.g. test datasets are normalized with the statistics of all training blocks. The other ranks wait for it.
+
+        Args:
+            statistics (dict): Maps each climate model to its combined stats, as returned by combine_statistics.
+        """
+        ds = self.cmip6_ds_model[0][0]
+        if self.rank == 0 and ds.mode in ["train", "train+val"]:
+            for climate_model, stats in statistics.items():
+                stats_fname = ds.get_save_name_from_kwargs(
+                    mode=ds.mode, file="statistics", kwargs=dict(climate_model=climate_model, variables=self.out_var_ids)
+                )
+                # same layout as the statistics of a single dataset, with the variables first
+                save_file_name = ds.write_dataset_statistics(
+                    stats_fname, {key: value.reshape(-1, 1, 1, 1, 1) for key, value in stats.items()}
+                )
+                log.info(f"Wrote the combined statistics of {climate_model} to {save_file_name}.")
+        if dist.is_available() and dist.is_initialized() and self.world_size > 1:
+            dist.barrier()
+
+    def reduce_statistics(self, statistics=None):
+        """
+        Combine the CMIP6 normalization statistics of all ranks and renormalize the local blocks with them.
+
+        Args:
+            statistics (dict): The combined statistics, if already computed by combine_statistics.
+        """
+        if statistics is None:
+            statistics = self.combine_statistics(self.cmip6_statistics())
+        for climate_model, model in zip(self.climate_models, self.cmip6_ds_model):
+            for member in model:
+                member.renormalize_data(statistics[climate_model])
+
+    def memory_report(self, report: Optional[MemoryReport] = None, prefix: str = "") -> MemoryReport:
+        """
+        Add the arrays of all (model, member) blocks and Input4MIPs datasets to a memory report.
+
+        Args:
+            report (MemoryReport): Report to add to, a new one if None.
+            prefix (str): Prefix of the block names, e.g. to tell apart the copies held by dataloaders.
+
+        Returns:
+            MemoryReport: The report.
+        """
+        report = report if report is not None else MemoryReport()
+        for climate_model, model in zip(self.climate_models, self.cmip6_ds_model):
+            for member in model:
+                report.add_dataset(f"{prefix}cmip6/{climate_model}/{os.path.basename(member.data_dir)}", member)
+        for spec, ds in self.input4mips_ds.items():
+            report.add_dataset(f"{prefix}input4mips/{'+'.join(spec)}", ds)
+        return report
+
+    def drop_raw_data(self) -> int:
+        """
+        Drop the raw data of all datasets that also hold normalized data.
+
+        Returns:
+            int: Number of bytes freed.
+        """
+        datasets = [member for model in self.cmip6_ds_model for member in model] + list(self.input4mips_ds.values())
+        return sum(ds.drop_raw_data() for ds in datasets)
+
     def get_indices(self):
         """Get the current indices of CMIP6 model and member."""
         return self.cmip6_model_index, self.cmip6_member
@@ -249,9 +423,11 @@ class SuperClimateDataModule(LightningDataModule):
         batch_size: int = 16,
         shuffle: bool = False,
         eval_batch_size: int = 64,
+        effective_batch_size: Optional[int] = None,
         num_workers: int = 0,
         persistent_workers: bool = False,
         pin_memory: bool = False,
+        prefetch_batches: int = 0,
         load_train_into_mem: bool = True,
         emissions_tracker: bool = False,
         load_test_into_mem: bool = True,
@@ -264,15 +440,32 @@ class SuperClimateDataModule(LightningDataModule):
         lon: int = LON,
         lat: int = LAT,
         num_levels: int = NUM_LEVELS,
+        shard_across_ranks: bool = False,
+        normalize_on_device: Optional[str] = None,
+        use_block_cache: bool = False,
+        drop_raw_data: bool = False,
         name: str = "super_climate"
     ):
         """
         Args:
             batch_size (int): Batch size for the training dataloader.
             eval_batch_size (int): Batch size for the test and validation dataloaders.
+            effective_batch_size (int): Samples per optimizer step, if larger than batch_size the gradients of
+                effective_batch_size / batch_size batches are accumulated (sets trainer.accumulate_grad_batches).
             num_workers (int): Dataloader arg for higher efficiency.
             pin_memory (bool): Dataloader arg for higher efficiency.
+            prefetch_batches (int): If > 0, keep this many batches staged on the device, copying them asynchronously
+                from reused pinned buffers (see PrefetchLoader).
             seed (int): Used to seed the validation-test set split, such that the split will always be the same.
+            shard_across_ranks (bool): If True, the (model, member) blocks are sharded across the distributed ranks.
+                Each rank only loads its shard in ``setup`` and the normalization statistics are combined via all-reduce.
+            normalize_on_device (str): If set ("z-norm" or "minmax"), the datasets keep the raw data and batches are
+                normalized on the device in ``on_after_batch_transfer`` by a Normalizer with per-model statistics.
+            use_block_cache (bool): If True, raw data is read through a block cache in ``output_save_dir/blocks`` with one
+                block per (model, member, scenario, variable), shared by all datasets, splits and runs on the node,
+                instead of one cache file per dataset config.
+            drop_raw_data (bool): If True, the datasets drop their raw data in ``setup`` once the normalized data exists,
+                instead of keeping both in memory.
         """
         super().__init__()
         self.save_hyperparameters(ignore=["input_transform", "normalizer"])
@@ -294,9 +487,27 @@ class SuperClimateDataModule(LightningDataModule):
         ]
         
         self.emissions_tracker = self.hparams.emissions_tracker
-        self.index_manager = self.create_index_manager()
+        # number of samples every rank iterates over per split, only used when sharding across ranks
+        self._samples_per_rank: Dict[str, int] = {}
+        self.normalizer: Optional[Normalizer] = None
+        # datasets handed to dataloaders (deep copies of the training dataset), for memory accounting
+        self._dataloader_datasets = weakref.WeakValueDictionary()
+
+        if self.hparams.shard_across_ranks:
+            # the rank is only known once the process group is set up, so loading is deferred to setup
+            self.index_manager = None
+            self._data_train = None
+        else:
+            self.index_manager = self.create_index_manager()
+            self._data_train = self.create_train_dataset()
+
+        self.log_text = get_logger()
 
-        self._data_train = SuperClimateDataset(
+    def create_train_dataset(self) -> SuperClimateDataset:
+        """
+        Create the training dataset on top of the index manager.
+        """
+        return SuperClimateDataset(
             index_manager=self.index_manager,
             years=self.hparams.train_years,
             historical_years=self.hparams.train_historical_years,
@@ -308,9 +519,17 @@ class SuperClimateDataModule(LightningDataModule):
             **self.dataset_kwargs(),
         )
 
-        self.log_text = get_logger()
+    def get_rank_and_world_size(self):
+        """
+        Get the rank of this process and the number of processes, from the trainer if attached or from torch.distributed.
+        """
+        if self.trainer is not None:
+            return self.trainer.global_rank, self.trainer.world_size
+        if dist.is_available() and dist.is_initialized():
+            return dist.get_rank(), dist.get_world_size()
+        return 0, 1
 
-    def create_index_manager(self) -> StateManager:
+    def create_index_manager(self, rank: int = 0, world_size: int = 1) -> StateManager:
         """
         Create the index manager used to manage data indices for training and testing.
         """
@@ -336,6 +555,9 @@ class SuperClimateDataModule(LightningDataModule):
             ds_kwargs=ds_kwargs,
             dir=self.hparams.data_dir,
             ensembles=self.hparams.num_ensembles,
+            val_split=self.hparams.val_split,
+            rank=rank,
+            world_size=world_size,
         )
 
     def years_and_historical_years(self):
@@ -375,6 +597,16 @@ class SuperClimateDataModule(LightningDataModule):
 
     def setup(self, stage: Optional[str] = None):
         """Load data and set internal variables for different stages."""
+        if self.hparams.shard_across_ranks and self.index_manager is None:
+            self.setup_shard()
+        if self.hparams.normalize_on_device is not None and self.normalizer is None:
+            self.normalizer = self.create_normalizer()
+        if self.hparams.drop_raw_data:
+            freed = self.index_manager.drop_raw_data()
+            if freed > 0:
+                log.info(f"Dropped the raw data next to the normalized data, freeing {freed / 1024**2:.1f} MB.")
+        log.info(self.memory_report().format())
+
         if stage in ["fit", "validate", None]:
             self._data_train.set_mode(train=True)
 
@@ -384,6 +616,90 @@ class SuperClimateDataModule(LightningDataModule):
         if stage == "predict":
             self._data_predict = self._data_test
 
+    def setup_shard(self):
+        """
+        Load the (model, member) blocks of this rank and combine the statistics of all ranks.
+        """
+        rank, world_size = self.get_rank_and_world_size()
+        log.info(f"Loading shard of rank {rank} out of {world_size}.")
+        self.index_manager = self.create_index_manager(rank=rank, world_size=world_size)
+        statistics = self.index_manager.combine_statistics(self.index_manager.cmip6_statistics())
+        self.index_manager.save_statistics(statistics)
+        if self.hparams.normalize_on_device is None:
+            self.index_manager.reduce_statistics(statistics)
+        self._data_train = self.create_train_dataset()
+
+        # every rank has to do the same number of steps, so all ranks iterate over as many samples as the largest shard
+        local_lengths = torch.tensor(
+            [len(self.index_manager.train_indexes), len(self.index_manager.val_indexes), self.index_manager.total_length],
+            dtype=torch.int64,
+        )
+        if world_size > 1 and dist.is_available() and dist.is_initialized():
+            device = torch.device("cuda", torch.cuda.current_device()) if dist.get_backend() == "nccl" else torch.device("cpu")
+            local_lengths = local_lengths.to(device)
+            dist.all_reduce(local_lengths, op=dist.ReduceOp.MAX)
+        train_length, val_length, test_length = local_lengths.tolist()
+        self._samples_per_rank = {"train": train_length, "val": val_length, "test": test_length}
+
+    def create_normalizer(self, norm_type: Optional[str] = None) -> Normalizer:
+        """
+        Create the Normalizer from the statistics of the raw training data, per training climate model.
+
+        Args:
+            norm_type (str): "z-norm" or "minmax", defaults to normalize_on_device. Without normalization on the
+                device, the datasets are z-normalized and only "z-norm" statistics are available.
+        """
+        input_stats = self.index_manager.combine_statistics(self.index_manager.input4mips_statistics())
+        output_stats = self.index_manager.combine_statistics(self.index_manager.cmip6_statistics())
+        climate_models = list(output_stats.keys())
+        return Normalizer(
+            input_stats={key: np.stack([input_stats[m][key] for m in climate_models]) for key in input_stats[climate_models[0]]},
+            output_stats={key: np.stack([output_stats[m][key] for m in climate_models]) for key in output_stats[climate_models[0]]},
+            norm_type=norm_type or self.hparams.normalize_on_device or "z-norm",
+            channels_last=self.hparams.channels_last,
+            climate_models=climate_models,
+        )
+
+    def memory_report(self) -> MemoryReport:
+        """
+        Report the memory held by the data: bytes per (model, member) block and Input4MIPs dataset, buffers held twice
+        (e.g. by the deep copies of the dataloader datasets) and raw data kept next to normalized data.
+        Use ``memory_report().summary()`` for the numbers and ``memory_report().format()`` for a printable table.
+        """
+        report = MemoryReport()
+        if self.index_manager is None:
+            return report
+        self.index_manager.memory_report(report, prefix="")
+        for name, dataset in list(self._dataloader_datasets.items()):
+            if dataset.index_manager is not self.index_manager:
+                dataset.index_manager.memory_report(report, prefix=f"{name}/")
+        return report
+
+    def _prefetch(self, dataloader: DataLoader, shuffle: bool = False):
+        """
+        Wrap a dataloader into a PrefetchLoader if prefetch_batches > 0.
+        """
+        return prefetch_dataloader(
+            dataloader, self.trainer, self.hparams.prefetch_batches, shuffle=shuffle, seed=self.hparams.seed
+        )
+
+    def _shard_sampler(self, dataset, split: str, shuffle: bool = False) -> Optional["ShardedBlockSampler"]:
+        """
+        Sampler over the local shard of a dataset, None if not sharding across ranks. Only the training shards are
+        padded to the same number of samples on every rank.
+        """
+        if not self.hparams.shard_across_ranks:
+            return None
+        return ShardedBlockSampler(
+            dataset,
+            num_samples=self._samples_per_rank[split],
+            rank=self.index_manager.rank,
+            world_size=self.index_manager.world_size,
+            shuffle=shuffle,
+            seed=self.hparams.seed,
+            pad=split == "train",
+        )
+
     def setup_test_data(self):
         """
         Setup the test datasets for the module.
@@ -410,6 +726,7 @@ class SuperClimateDataModule(LightningDataModule):
     def on_before_batch_transfer(self, batch, dataloader_idx):
         """
         Hook to apply any transformations before transferring the batch to the device.
+        With prefetch_batches > 0 the batch already is on the device here.
         """
         return batch
 
@@ -417,6 +734,9 @@ class SuperClimateDataModule(LightningDataModule):
         """
         Hook to apply any transformations after transferring the batch to the device.
         """
+        if self.normalizer is not None:
+            self.normalizer.to(batch[0].device)
+            batch = self.normalizer(batch)
         return batch
 
     def _shared_dataloader_kwargs(self) -> dict:
@@ -440,28 +760,40 @@ class SuperClimateDataModule(LightningDataModule):
         Returns the training dataloader.
         """
         self._data_train.set_mode(train=True, indexes=self.index_manager.train_indexes, reset_index=self.index_manager.reset_train_index)
-        return DataLoader(
-            dataset=copy.deepcopy(self._data_train),
+        dataset = copy.deepcopy(self._data_train)
+        self._dataloader_datasets["train_dataloader"] = dataset
+        sampler = self._shard_sampler(dataset, "train", shuffle=self.hparams.shuffle)
+        dataloader = DataLoader(
+            dataset=dataset,
             batch_size=self.hparams.batch_size,
-            shuffle=self.hparams.shuffle,
+            shuffle=self.hparams.shuffle if sampler is None else False,
+            sampler=sampler,
             **self._shared_dataloader_kwargs(),
         )
+        return self._prefetch(dataloader, shuffle=self.hparams.shuffle)
 
     def val_dataloader(self):
         """
         Returns the validation dataloader.
         """
         self._data_train.set_mode(train=False, indexes=self.index_manager.val_indexes, reset_index=self.index_manager.reset_val_index)
-        return DataLoader(
-            dataset=copy.deepcopy(self._data_train),
+        dataset = copy.deepcopy(self._data_train)
+        self._dataloader_datasets["val_dataloader"] = dataset
+        dataloader = DataLoader(
+            dataset=dataset,
+            sampler=self._shard_sampler(dataset, "val"),
             **self._shared_eval_dataloader_kwargs(),
         )
+        return self._prefetch(dataloader)
 
     def test_dataloader(self) -> List[DataLoader]:
         """
         Returns a list of test dataloaders.
         """
-        return [DataLoader(dataset=ds_test, **self._shared_eval_dataloader_kwargs()) for ds_test in self._data_test]
+        return [
+            self._prefetch(DataLoader(dataset=ds_test, sampler=self._shard_sampler(ds_test, "test"), **self._shared_eval_dataloader_kwargs()))
+            for ds_test in self._data_test
+        ]
 
     def predict_dataloader(self) -> List[DataLoader]:
         """
@@ -481,10 +813,60 @@ class SuperClimateDataModule(LightningDataModule):
             "channels_last": self.hparams.channels_last,
             "seq_to_seq": self.hparams.seq_to_seq,
             "seq_len": self.hparams.seq_len,
-            "data_dir": self.hparams.data_dir
+            "data_dir": self.hparams.data_dir,
+            "normalize": self.hparams.normalize_on_device is None,
+            "block_cache_dir": os.path.join(self.hparams.output_save_dir, "blocks") if self.hparams.use_block_cache else None,
         }
 
 
+class ShardedBlockSampler(DistributedSampler):
+    """
+    Sampler over the samples of the (model, member) blocks held by this rank.
+
+    In contrast to the default DistributedSampler, the dataset of every rank is already its shard, so the
+    indexes are not split again. With ``pad``, shards are wrapped around to ``num_samples`` so that all ranks do the
+    same number of training steps. Evaluation sets are not padded, since repeated samples would bias the metrics, and
+    every rank visits its shard exactly once. Subclassing DistributedSampler prevents Lightning from replacing the
+    sampler.
+    """
+
+    def __init__(
+        self,
+        dataset,
+        num_samples: int,
+        rank: int,
+        world_size: int,
+        shuffle: bool = False,
+        seed: int = 0,
+        pad: bool = True,
+    ):
+        super().__init__(dataset, num_replicas=world_size, rank=rank, shuffle=shuffle, seed=seed)
+        self.pad = pad
+        self.num_samples = num_samples if pad else len(dataset)
+        self.total_size = self.num_samples * world_size
+
+    def __iter__(self):
+        if self.shuffle:
+            # seeded by epoch and rank so that every rank visits its shard in a different order each epoch
+            g = torch.Generator()
+            g.manual_seed(self.seed + self.epoch * self.num_replicas + self.rank)
+            indices = torch.randperm(len(self.dataset), generator=g).tolist()
+        else:
+            indices = list(range(len(self.dataset)))
+        if not self.pad:
+            return iter(indices)
+        if len(indices) == 0 or self.num_samples == 0:
+            # an empty shard (e.g. fewer validation blocks than ranks) has nothing to wrap around
+            return iter([])
+
+        # wrap around to the common number of samples per rank
+        indices = (indices * int(np.ceil(self.num_samples / len(indices))))[: self.num_samples]
+        return iter(indices)
+
+    def __len__(self) -> int:
+        return self.num_samples if len(self.dataset) > 0 else 0
+
+
 if __name__ == "__main__":
     dm = SuperClimateDataModule(
         seq_to_seq=True,
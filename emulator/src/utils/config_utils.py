@@ -119,9 +119,7 @@ def extras(config: DictConfig) -> None:
         if config.datamodule.get("num_workers"):
             config.datamodule.num_workers = 0
             print("SET NUM_WORKERS to 0")
-        if config.datamodule.get("pin_memory"):
-            config.datamodule.pin_memory = False
-            print("SET PIN_MEMORY to FALSE")
+        # pinned memory is kept: every rank pins its own batches, and the PrefetchLoader needs it to overlap copies
 
 
 
@@ -155,6 +153,7 @@ def extras(config: DictConfig) -> None:
             + config.logger.wandb.id
         )
 
+    set_gradient_accumulation(config)
     check_config_values(config)
     if USE_WANDB:
         wandb_kwargs = {
@@ -178,6 +177,34 @@ def extras(config: DictConfig) -> None:
         save_hydra_config_to_wandb(config)
 
 
+def set_gradient_accumulation(config: DictConfig) -> None:
+    """Set <config.trainer.accumulate_grad_batches> from <config.datamodule.effective_batch_size>, if that is given.
+
+    The effective batch size (per device, as the batch size) is then no longer bound by the memory of the device:
+    the batches of datamodule.batch_size are as large as fits and their gradients are accumulated up to it.
+    Modifies DictConfig in place.
+    """
+    effective_batch_size = config.datamodule.get("effective_batch_size")
+    if not effective_batch_size:
+        return
+    batch_size = config.datamodule.batch_size
+    if effective_batch_size % batch_size != 0:
+        raise ValueError(
+            f"datamodule.effective_batch_size={effective_batch_size} must be a multiple of "
+            f"datamodule.batch_size={batch_size}."
+        )
+    accumulate_grad_batches = effective_batch_size // batch_size
+    configured = config.trainer.get("accumulate_grad_batches", 1)
+    if configured not in [1, accumulate_grad_batches]:
+        raise ValueError(
+            f"trainer.accumulate_grad_batches={configured} contradicts datamodule.effective_batch_size="
+            f"{effective_batch_size} with datamodule.batch_size={batch_size}, set only one of them."
+        )
+    log.info(f"Accumulating the gradients of {accumulate_grad_batches} batches of {batch_size} samples.")
+    with open_dict(config):
+        config.trainer.accumulate_grad_batches = accumulate_grad_batches
+
+
 def check_config_values(config: DictConfig):
     # super emulation
     # datamodule has to be super emulaton
@@ -3,11 +3,12 @@ from typing import Optional, Dict, Sequence, Any
 
 import hydra
 import torch
-from omegaconf import DictConfig
+from omegaconf import DictConfig, OmegaConf
 import wandb
 
 from emulator.src.datamodules.dummy_datamodule import DummyDataModule
-from emulator.src.utils.utils import get_logger
+from emulator.src.utils.utils import get_logger, load_checkpoint, load_state_dict_assign, assert_no_meta_tensors
+from emulator.src.utils.model_registry import ModelRegistry, RegistryEntry
 from emulator.src.utils.wandb_api import (
     load_hydra_config_from_wandb,
     restore_model_from_wandb_cloud,
@@ -98,6 +99,15 @@ def get_model(config: DictConfig, **kwargs):
     return model
 
 
+def get_model_on_meta_device(config: DictConfig, **kwargs):
+    """
+    ``get_model`` on the meta device: the weights are neither allocated nor initialized, so they need to be assigned
+    from a checkpoint with ``model.load_state_dict(state_dict, assign=True)``.
+    """
+    with torch.device("meta"):
+        return get_model(config, **kwargs)
+
+
 def get_datamodule(config: DictConfig) -> DummyDataModule:
     """
     Args:
@@ -154,14 +164,20 @@ def reload_model_from_config_and_ckpt(
     model_path: str,
     device: Optional[torch.device] = None,
     load_datamodule: bool = False,
+    fast: bool = True,
 ) -> Dict[str, Any]:
     """Load a model as defined by ``config.model`` and reload its weights from ``model_path``.
 
+    By default the model is built on the meta device, i.e. without allocating and initializing its weights, and the
+    tensors of the memory-mapped checkpoint are assigned to it, which saves the initialization and a copy of all
+    weights. Models that cannot be built on the meta device are built and initialized as usual.
 
     Args:
         config: The config to use to reload the model
         model_path: The path to the model checkpoint (its weights)
         device: The device to load the model on. Defaults to 'cuda' if available, else 'cpu'.
+        load_datamodule: Whether to also instantiate the datamodule of the config.
+        fast: Whether to reload on the meta device from the memory-mapped checkpoint.
 
     Returns:
         BaseModel: The reloaded model if load_datamodule is ``False``, otherwise a tuple of (reloaded-model, datamodule)
@@ -200,12 +216,25 @@ def reload_model_from_config_and_ckpt(
         data_module = None
 
     # model, data_module = get_model_and_data(config)
-    model = get_model(config)
-    # Reload model
     device = device or torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    model_state = torch.load(model_path, map_location=device)
-    # Reload weights
-    model.load_state_dict(model_state["state_dict"])
+    model = None
+    if fast:
+        # memory-mapped checkpoint, its tensors are assigned to a model built without allocating/initializing weights
+        model_state = load_checkpoint(model_path, map_location="cpu")
+        try:
+            model = get_model_on_meta_device(config)
+            load_state_dict_assign(model, model_state["state_dict"])
+            assert_no_meta_tensors(model)
+        except Exception as e:
+            log.warning(f"Could not reload the model on the meta device ({e}), initializing its weights first.")
+            model = None
+    else:
+        model_state = torch.load(model_path, map_location=device)
+    if model is None:
+        model = get_model(config)
+        # Reload weights
+        model.load_state_dict(model_state["state_dict"])
+    model.to(device)
     epoch, global_step = model_state["epoch"], model_state["global_step"]
     return {
         "model": model,
@@ -215,6 +244,14 @@ def reload_model_from_config_and_ckpt(
     }
 
 
+def _check_wandb_online(run_id: str, registry: ModelRegistry):
+    if os.environ.get("WANDB_MODE") in ["offline", "disabled"]:
+        raise FileNotFoundError(
+            f"Run {run_id} is not (fully) in the registry {registry.db_path} and wandb is {os.environ['WANDB_MODE']}."
+            f" Download it into {registry.root} or pass its checkpoint."
+        )
+
+
 def reload_model_from_id(
     run_id: str,
     direc: str = None,
@@ -222,6 +259,7 @@ def reload_model_from_id(
     project="emulator",
     override_kwargs: Sequence[str] = None,
     allow_resume: bool = True,
+    registry: Optional[ModelRegistry] = None,
 ):
     """
     This function reloads a model from a wandb run id
@@ -229,51 +267,74 @@ def reload_model_from_id(
     If the model was trained using Wandb logging, reloading it and resuming training or testing will be as easy as:
         >>> example_run_id = "22ejv03e"
 
+    The checkpoint and config are looked up in the local registry of pretrained_models/ first (see ModelRegistry),
+    so that runs that are available locally are reloaded without the wandb API (e.g. offline). Runs restored from
+    wandb are added to the registry.
+
     Args:
         run_id: Wandb run id
-        checkpoint_path: An optional local ckpt path to load the weights from. If None, the best one on wandb will be used.
-        config: An optional config to load the model and data from. If None, the config is loaded from Wandb.
+        direc: An optional local ckpt path (or directory with <run_id>/*.ckpt) to load the weights from.
+            If None, the registry's or the best one on wandb will be used.
         group: Wandb group
         project: Wandb project
         override_kwargs: A list of strings (of the form "key=value") to override the given/reloaded config with.
         allow_resume: Wheather resuming of training is allowed or a new instance should be created.
+        registry: The local registry, defaults to the one of $PRETRAINED_MODELS_DIR or ./pretrained_models.
 
     """
     run_path = f"{group}/{project}/{run_id}"
+    registry = registry if registry is not None else ModelRegistry()
+    entry = registry.lookup(run_id)
 
-    if os.path.isdir(os.path.join(direc, run_id)):
+    if direc is not None and os.path.isdir(os.path.join(direc, run_id)):
         saved_ckpts = [
             f for f in os.listdir(os.path.join(direc, run_id)) if f.endswith(".ckpt")
         ]
-        log.info(" Checkpoints saved:", saved_ckpts)
+        log.info(f" Checkpoints saved: {saved_ckpts}")
         if "last.ckpt" in saved_ckpts:
             log.info("Reloading from last.ckpt")
             checkpoint_path = os.path.join(direc, f"{run_id}/last.ckpt")
         else:
-            log.info("Reloading from", saved_ckpts[0])
+            log.info(f"Reloading from {saved_ckpts[0]}")
             checkpoint_path = os.path.join(direc, f"{run_id}/{saved_ckpts[0]}")
     else:
         checkpoint_path = direc
 
-    if checkpoint_path is not None:  # local loading
+    if checkpoint_path is not None and checkpoint_path.endswith(".ckpt") and os.path.isfile(checkpoint_path):
         print("Loading checkpoint from local.")
-        if checkpoint_path.endswith(".ckpt"):
-            best_model_path = checkpoint_path
-        else:
-            try:
-                best_model_path = checkpoint_path + "/" + get_wandb_ckpt_name(run_path)
-            except IndexError:
-                saved_files = [f.name for f in wandb.Api().run(run_path).files()]
-                log.warning(
-                    f"Run {run_id} does not have a saved ckpt in {checkpoint_path}. All saved files: {saved_files}"
-                )
-                best_model_path = restore_model_from_wandb_cloud(run_path)
+        best_model_path = checkpoint_path
+    elif entry is not None:
+        log.info(f"Loading checkpoint {entry.ckpt_path} from the registry.")
+        best_model_path = entry.ckpt_path
+    elif checkpoint_path is not None and not checkpoint_path.endswith(".ckpt"):  # local loading
+        print("Loading checkpoint from local.")
+        _check_wandb_online(run_id, registry)
+        try:
+            best_model_path = checkpoint_path + "/" + get_wandb_ckpt_name(run_path)
+        except IndexError:
+            saved_files = [f.name for f in wandb.Api().run(run_path).files()]
+            log.warning(
+                f"Run {run_id} does not have a saved ckpt in {checkpoint_path}. All saved files: {saved_files}"
+            )
+            best_model_path = restore_model_from_wandb_cloud(run_path)
     else:
+        _check_wandb_online(run_id, registry)
         best_model_path = restore_model_from_wandb_cloud(run_path)
 
-    config = load_hydra_config_from_wandb(run_path, override_kwargs)
-
-    if not (allow_resume):
+    if entry is not None and entry.config is not None:
+        config = entry.config
+    else:
+        _check_wandb_online(run_id, registry)
+        config = load_hydra_config_from_wandb(run_path)
+        # cache the run, so that the next reloads are offline
+        if entry is None:
+            entry = RegistryEntry(run_id=run_id, ckpt_path=os.path.abspath(best_model_path), source="wandb")
+        entry.config = config
+        registry.add(entry)
+    if override_kwargs:
+        config = OmegaConf.unsafe_merge(config, OmegaConf.from_dotlist(list(override_kwargs)))
+
+    if not (allow_resume) and OmegaConf.select(config, "logger.wandb") is not None:
         config.logger["wandb"]["resume"] = False
         config.logger["wandb"]["reinit"] = False
 
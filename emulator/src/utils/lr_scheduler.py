@@ -7,14 +7,12 @@ import math
 import warnings
 from typing import List
 
-from pytorch_lightning.utilities.cli import LR_SCHEDULER_REGISTRY
 from torch.optim import Optimizer
 from torch.optim.lr_scheduler import _LRScheduler
 
 from typing import Dict
 
 
-@LR_SCHEDULER_REGISTRY
 class LinearWarmupCosineAnnealingLR(_LRScheduler):
     """Sets the learning rate of each parameter group to follow a linear warmup schedule between
     warmup_start_lr and base_lr followed by a cosine annealing schedule between base_lr and
@@ -0,0 +1,289 @@
+import json
+import os
+import re
+import sqlite3
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+from omegaconf import DictConfig, OmegaConf
+
+from emulator.src.utils.utils import get_logger
+
+log = get_logger(__name__)
+
+REGISTRY_FILENAME = "registry.sqlite"
+CONFIG_FILENAME = "hydra_config.yaml"
+SUMMARY_FILENAME = "wandb-summary.json"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id TEXT PRIMARY KEY,
+    experiment_type TEXT,
+    model_name TEXT,
+    experiment_name TEXT,
+    run_dir TEXT,
+    ckpt_path TEXT,
+    config TEXT,
+    metrics TEXT,
+    source TEXT,
+    mtime REAL,
+    indexed_at REAL
+)
+"""
+
+
+def default_root() -> str:
+    """The pretrained_models/ directory of download_pretrained_models.py, or $PRETRAINED_MODELS_DIR."""
+    return os.environ.get("PRETRAINED_MODELS_DIR", os.path.join(os.getcwd(), "pretrained_models"))
+
+
+def select_checkpoint(ckpt_files: List[str]) -> str:
+    """last.ckpt if saved, else the checkpoint of the latest epoch (e.g. epoch=49-step=2950.ckpt), else the newest."""
+    names = {os.path.basename(f): f for f in ckpt_files}
+    if "last.ckpt" in names:
+        return names["last.ckpt"]
+    epochs = {name: re.search(r"epoch=?(\d+)", name) for name in names}
+    if all(epochs.values()):
+        return names[max(names, key=lambda name: int(epochs[name].group(1)))]
+    return max(ckpt_files, key=os.path.getmtime)
+
+
+@dataclass
+class RegistryEntry:
+    """One indexed run: its checkpoint, the hydra config it was trained with and its final (wandb summary) metrics."""
+
+    run_id: str
+    ckpt_path: str
+    config: Optional[DictConfig] = None
+    metrics: Dict[str, float] = field(default_factory=dict)
+    run_dir: Optional[str] = None
+    experiment_type: Optional[str] = None
+    model_name: Optional[str] = None
+    experiment_name: Optional[str] = None
+    source: str = "local"
+
+
+class ModelRegistry:
+    """
+    Local SQLite index over the pretrained_models/ tree, mapping wandb run ids to their checkpoint, hydra config
+    and metrics, so that reloading (``reload_model_from_id``) and scoring runs do not need the wandb API.
+
+    The tree is laid out as created by download_pretrained_models.py (and internal/python_scripts):
+        pretrained_models/<experiment type>/<model name>/<experiment name>/<run id>/checkpoints/*.ckpt
+    with the run's hydra_config.yaml and wandb run directory (files/wandb-summary.json) next to the checkpoints.
+    Runs restored from wandb on a miss are added to the index as well, so they are available offline afterwards.
+
+    Example:
+        registry = ModelRegistry("pretrained_models")
+        registry.scan()
+        entry = registry.lookup("0ltetwu3")
+        model = reload_model_from_config_and_ckpt(entry.config, entry.ckpt_path)["model"]
+        df = registry.metrics_frame(model_name="ClimaX")
+    """
+
+    def __init__(self, root: Optional[str] = None, db_path: Optional[str] = None):
+        """
+        Args:
+            root (str): The pretrained_models/ directory, defaults to $PRETRAINED_MODELS_DIR or ./pretrained_models.
+            db_path (str): The SQLite file, defaults to <root>/registry.sqlite.
+        """
+        self.root = os.path.abspath(root or default_root())
+        self.db_path = db_path or os.path.join(self.root, REGISTRY_FILENAME)
+        self._scanned = False
+        os.makedirs(os.path.dirname(os.path.abspath(self.db_path)), exist_ok=True)
+        with self._connect() as connection:
+            connection.execute(SCHEMA)
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.db_path, timeout=30)
+        connection.row_factory = sqlite3.Row
+        return connection
+
+    def _abspath(self, path: Optional[str]) -> Optional[str]:
+        return path if path is None or os.path.isabs(path) else os.path.join(self.root, path)
+
+    def _relpath(self, path: Optional[str]) -> Optional[str]:
+        """Paths inside the root are stored relative to it, so that the tree can be moved with its index."""
+        if path is None:
+            return None
+        path = os.path.abspath(path)
+        return os.path.relpath(path, self.root) if path.startswith(self.root + os.sep) else path
+
+    def __len__(self) -> int:
+        with self._connect() as connection:
+            return connection.execute("SELECT COUNT(*) FROM runs").fetchone()[0]
+
+    def __contains__(self, run_id: str) -> bool:
+        return self.get(run_id) is not None
+
+    def scan(self, force: bool = False) -> int:
+        """
+        Index all runs with checkpoints under the root, re-reading only runs whose files changed since the last scan.
+
+        Args:
+            force (bool): Re-read all runs.
+
+        Returns:
+            int: The number of (re-)indexed runs.
+        """
+        if not os.path.isdir(self.root):
+            log.warning(f"The pretrained models directory {self.root} does not exist.")
+            return 0
+        with self._connect() as connection:
+            known = {row["run_id"]: row["mtime"] for row in connection.execute("SELECT run_id, mtime FROM runs")}
+        num_indexed = 0
+        for run_dir, ckpt_files in self._find_runs():
+            run_id = os.path.basename(run_dir)
+            files = self._run_files(run_dir)
+            mtime = max(os.path.getmtime(f) for f in ckpt_files + [f for f in files.values() if f is not None])
+            if not force and known.get(run_id) == mtime:
+                continue
+            self._index_run(run_id, run_dir, ckpt_files, files, mtime)
+            num_indexed += 1
+        self._scanned = True
+        log.info(f"Indexed {num_indexed} runs in {self.db_path}, {len(self)} in total.")
+        return num_indexed
+
+    def _find_runs(self):
+        """(run dir, checkpoint files) of every run, i.e. <run id>/checkpoints/*.ckpt or <run id>/*.ckpt."""
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            dirnames[:] = [d for d in dirnames if not d.startswith("run-") and d != "wandb"]
+            ckpt_files = [os.path.join(dirpath, f) for f in filenames if f.endswith(".ckpt")]
+            if not ckpt_files:
+                continue
+            run_dir = os.path.dirname(dirpath) if os.path.basename(dirpath) == "checkpoints" else dirpath
+            yield run_dir, ckpt_files
+
+    @staticmethod
+    def _run_files(run_dir: str) -> Dict[str, Optional[str]]:
+        """The shallowest hydra config and wandb summary of a run."""
+        files = {CONFIG_FILENAME: None, SUMMARY_FILENAME: None}
+        for dirpath, dirnames, filenames in os.walk(run_dir):
+            dirnames.sort()
+            for name in files:
+                if files[name] is None and name in filenames:
+                    files[name] = os.path.join(dirpath, name)
+        return files
+
+    def _index_run(self, run_id: str, run_dir: str, ckpt_files: List[str], files: Dict[str, str], mtime: float):
+        config, metrics = None, {}
+        if files[CONFIG_FILENAME] is not None:
+            try:
+                config = OmegaConf.load(files[CONFIG_FILENAME])
+            except Exception as e:
+                log.warning(f"Could not read the config of run {run_id}: {e}")
+        if files[SUMMARY_FILENAME] is not None:
+            with open(files[SUMMARY_FILENAME]) as f:
+                metrics = json.load(f)
+        parts = os.path.relpath(run_dir, self.root).split(os.sep)
+        experiment_type, model_name, experiment_name = parts[:-1] if len(parts) == 4 else (None, None, None)
+        self.add(
+            RegistryEntry(
+                run_id=run_id,
+                ckpt_path=select_checkpoint(ckpt_files),
+                config=config,
+                metrics=metrics,
+                run_dir=run_dir,
+                experiment_type=experiment_type,
+                model_name=model_name,
+                experiment_name=experiment_name,
+            ),
+            mtime=mtime,
+        )
+
+    def add(self, entry: RegistryEntry, mtime: Optional[float] = None):
+        """Add or replace a run, e.g. after restoring it from wandb."""
+        metrics = {k: v for k, v in entry.metrics.items() if isinstance(v, (int, float)) and not isinstance(v, bool)}
+        if entry.model_name is None and entry.config is not None:
+            target = OmegaConf.select(entry.config, "model._target_", default=None)
+            entry.model_name = target.split(".")[-1] if target else None
+        with self._connect() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO runs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    entry.run_id,
+                    entry.experiment_type,
+                    entry.model_name,
+                    entry.experiment_name,
+                    self._relpath(entry.run_dir),
+                    self._relpath(entry.ckpt_path),
+                    OmegaConf.to_yaml(entry.config) if entry.config is not None else None,
+                    json.dumps(metrics),
+                    entry.source,
+                    mtime if mtime is not None else os.path.getmtime(entry.ckpt_path),
+                    time.time(),
+                ),
+            )
+
+    def _entry(self, row: sqlite3.Row) -> RegistryEntry:
+        return RegistryEntry(
+            run_id=row["run_id"],
+            ckpt_path=self._abspath(row["ckpt_path"]),
+            config=OmegaConf.create(row["config"]) if row["config"] is not None else None,
+            metrics=json.loads(row["metrics"]),
+            run_dir=self._abspath(row["run_dir"]),
+            experiment_type=row["experiment_type"],
+            model_name=row["model_name"],
+            experiment_name=row["experiment_name"],
+            source=row["source"],
+        )
+
+    def get(self, run_id: str) -> Optional[RegistryEntry]:
+        """The indexed run, None if it is not indexed or its checkpoint was removed."""
+        with self._connect() as connection:
+            row = connection.execute("SELECT * FROM runs WHERE run_id = ?", (run_id,)).fetchone()
+        if row is None:
+            return None
+        entry = self._entry(row)
+        if not os.path.isfile(entry.ckpt_path):
+            log.warning(f"The indexed checkpoint {entry.ckpt_path} of run {run_id} does not exist anymore.")
+            return None
+        return entry
+
+    def lookup(self, run_id: str) -> Optional[RegistryEntry]:
+        """Like ``get``, but (once per registry) rescans the tree on a miss, e.g. for newly downloaded runs."""
+        entry = self.get(run_id)
+        if entry is None and not self._scanned:
+            self.scan()
+            entry = self.get(run_id)
+        return entry
+
+    def runs(
+        self,
+        experiment_type: Optional[str] = None,
+        model_name: Optional[str] = None,
+        experiment_name: Optional[str] = None,
+    ) -> List[RegistryEntry]:
+        """All indexed runs, optionally only of an experiment type, model and/or experiment."""
+        filters = {"experiment_type": experiment_type, "model_name": model_name, "experiment_name": experiment_name}
+        filters = {k: v for k, v in filters.items() if v is not None}
+        where = " AND ".join(f"{k} = ?" for k in filters)
+        query = "SELECT * FROM runs" + (f" WHERE {where}" if where else "") + " ORDER BY run_id"
+        with self._connect() as connection:
+            return [self._entry(row) for row in connection.execute(query, tuple(filters.values()))]
+
+    def metrics_frame(self, metrics: Optional[List[str]] = None, **filters):
+        """
+        The metrics of the indexed runs as a pandas DataFrame with one row per run, for scoring many runs at once.
+
+        Args:
+            metrics (list): The metrics (e.g. "test/ssp245_NorESM2-LM/rmse") to include, defaults to all.
+            **filters: experiment_type, model_name and/or experiment_name, as for ``runs``.
+        """
+        import pandas as pd
+
+        rows = []
+        for entry in self.runs(**filters):
+            run_metrics = entry.metrics if metrics is None else {m: entry.metrics.get(m) for m in metrics}
+            rows.append(
+                {
+                    "run_id": entry.run_id,
+                    "experiment_type": entry.experiment_type,
+                    "model_name": entry.model_name,
+                    "experiment_name": entry.experiment_name,
+                    "ckpt_path": entry.ckpt_path,
+                    **run_metrics,
+                }
+            )
+        return pd.DataFrame(rows).set_index("run_id") if rows else pd.DataFrame()
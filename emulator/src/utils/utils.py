@@ -1,4 +1,5 @@
 import logging
+import warnings
 from omegaconf import DictConfig, OmegaConf
 
 from typing import Union, Sequence, List, Dict, Optional, Callable
@@ -198,6 +199,57 @@ def no_op(*args, **kwargs):
     pass
 
 
+def to_default_device(module: nn.Module) -> nn.Module:
+    """
+    Move a module to the GPU if one is available. Modules built on the meta device (to reload a checkpoint into,
+    see ``load_checkpoint``) stay there, their weights are only assigned when the checkpoint is loaded.
+    """
+    if any(p.is_meta for p in module.parameters()):
+        return module
+    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    return module.to(device)
+
+
+def load_checkpoint(path: str, map_location=None) -> Dict:
+    """
+    Load a checkpoint memory-mapped (``torch.load(mmap=True)``), so that tensors are only read from disk when used
+    and, with ``load_state_dict(assign=True)``, without copying them into freshly initialized weights.
+    Checkpoints in the legacy (not zip) format are loaded entirely.
+    """
+    try:
+        return torch.load(path, map_location=map_location, mmap=True)
+    except RuntimeError as e:
+        if "mmap" not in str(e):
+            raise
+        return torch.load(path, map_location=map_location)
+
+
+def load_state_dict_assign(module: nn.Module, state_dict: Dict[str, torch.Tensor], strict: bool = True):
+    """
+    ``module.load_state_dict(state_dict, assign=True)``, i.e. without copying the tensors (e.g. of a memory-mapped
+    checkpoint or into a module built on the meta device), but keeping the dtypes of the module's tensors and which
+    of its parameters are frozen, like when copying.
+    """
+    module_state = module.state_dict(keep_vars=True)
+    requires_grad = {name: p.requires_grad for name, p in module.named_parameters()}
+    state_dict = {
+        # non-tensor entries are extra states (see nn.Module.get_extra_state), e.g. fitted scikit-learn estimators
+        k: v.to(module_state[k].dtype) if k in module_state and isinstance(v, torch.Tensor) and v.is_floating_point() else v
+        for k, v in state_dict.items()
+    }
+    msg = module.load_state_dict(state_dict, strict=strict, assign=True)
+    for name, p in module.named_parameters():
+        p.requires_grad_(requires_grad.get(name, p.requires_grad))
+    return msg
+
+
+def assert_no_meta_tensors(module: nn.Module):
+    """Raise if weights of a module built on the meta device were not assigned from a checkpoint."""
+    meta_tensors = [name for name, t in list(module.named_parameters()) + list(module.named_buffers()) if t.is_meta]
+    if meta_tensors:
+        raise RuntimeError(f"Tensors without data after loading the checkpoint: {meta_tensors}")
+
+
 def random_split(dataset, lengths, generator=default_generator):
     """
     Randomly split a dataset into non-overlapping new datasets of given lengths.
@@ -0,0 +1,163 @@
+"""
+Emulate many emission pathways with one trained emulator and reduce them online to global and regional means
+and their percentiles across the pathways, instead of writing the fields.
+
+The pathways are base Input4MIPs scenarios with every input variable scaled by a factor (constant, or ramped
+linearly from 1 in the first year with --ramp). The factors are either a grid (--factors) or drawn uniformly
+(--random). The model, statistics and overrides are handled as in emulate.py.
+
+Run from the root of the repository:
+
+    python -m emulator.sweep --ckpt checkpoints/last.ckpt --scenarios ssp126 ssp245 ssp585 \\
+        --factors BC_sum=0.5,1,1.5 SO2_sum=0,0.5,1,1.5,2 --regions europe=35,70,-10,40 --out sweeps/grid.nc \\
+        --stats emulated/stats.npz experiment=superemulator/<experiment>
+    python -m emulator.sweep --ckpt checkpoints/last.ckpt --scenarios ssp245 --random 10000 --low 0 --high 2 \\
+        --ramp --climate-model NorESM2-LM --out sweeps/random.nc --stats emulated/stats.npz experiment=<experiment>
+"""
+
+import argparse
+import os
+from typing import Dict, List, Tuple
+
+import torch
+
+from emulator.emulate import get_config, get_normalizer
+from emulator.src.core.emulation import ScenarioEmulator, load_input4mips_scenario
+from emulator.src.core.sweep import OnlineReducer, ScalingSweep, run_sweep
+from emulator.src.data.constants import AVAILABLE_MODELS_FIRETYPE, OPENBURNING_MODEL_MAPPING
+from emulator.src.utils.utils import get_logger
+
+log = get_logger()
+
+
+def parse_factors(factors: List[str]) -> Dict[str, List[float]]:
+    """["BC_sum=0.5,1,1.5"] -> {"BC_sum": [0.5, 1.0, 1.5]}"""
+    parsed = {}
+    for factor in factors:
+        var, _, values = factor.partition("=")
+        parsed[var] = [float(v) for v in values.split(",")]
+    return parsed
+
+
+def parse_regions(regions: List[str]) -> Dict[str, Tuple[float, float, float, float]]:
+    """["europe=35,70,-10,40"] -> {"europe": (35.0, 70.0, -10.0, 40.0)}"""
+    parsed = {}
+    for region in regions:
+        name, _, box = region.partition("=")
+        bounds = tuple(float(v) for v in box.split(","))
+        if len(bounds) != 4:
+            raise ValueError(f"Region {region} is not of the form name=lat_min,lat_max,lon_min,lon_max.")
+        parsed[name] = bounds
+    return parsed
+
+
+def main(args: argparse.Namespace):
+    if args.cpu:
+        os.environ["CUDA_VISIBLE_DEVICES"] = ""
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    from emulator.src.utils.interface import reload_model_from_config_and_ckpt
+
+    config = get_config(args.overrides)
+    datamodule_config = config.datamodule
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    model = reload_model_from_config_and_ckpt(config, args.ckpt, device=device)["model"]
+    normalizer = get_normalizer(config, args)
+    climate_model = args.climate_model
+    if climate_model is None and (
+        getattr(model, "super_decoder", False) or (normalizer is not None and normalizer.climate_models is not None)
+    ):
+        climate_model = datamodule_config.train_models[0]
+        log.info(f"Emulating the first training climate model, {climate_model}.")
+
+    emulator = ScenarioEmulator(
+        model,
+        normalizer,
+        in_var_ids=datamodule_config.in_var_ids,
+        out_var_ids=datamodule_config.out_var_ids,
+        channels_last=datamodule_config.channels_last,
+        seq_len=datamodule_config.seq_len,
+        batch_size=args.batch_size,
+        device=device,
+        precision=args.precision,
+    )
+
+    first_year, last_year = map(int, args.years.split("-"))
+    openburning_specs = OPENBURNING_MODEL_MAPPING[climate_model if climate_model in AVAILABLE_MODELS_FIRETYPE else "other"]
+    bases, spatial_coords = {}, None
+    for scenario in args.scenarios:
+        emissions = load_input4mips_scenario(
+            args.data_dir or datamodule_config.data_dir,
+            scenario,
+            range(first_year, last_year + 1),
+            emulator.in_var_ids,
+            openburning_specs,
+        )
+        bases[scenario] = emulator.read_years(emissions)
+        spatial_coords = emulator.spatial_coords(emissions)
+
+    if args.random is not None:
+        base_names, factors = ScalingSweep.random(
+            args.scenarios, args.random, emulator.in_var_ids, args.low, args.high, args.scaled_vars, args.seed
+        )
+    else:
+        base_names, factors = ScalingSweep.grid(args.scenarios, parse_factors(args.factors), emulator.in_var_ids)
+    sweep = ScalingSweep(bases, emulator.in_var_ids, base_names, factors, emulator.channels_last, ramp=args.ramp)
+    log.info(f"Sweeping {sweep.num_members} pathways of {sweep.num_years} years.")
+
+    reducer = OnlineReducer(
+        sweep.num_members,
+        sweep.num_years,
+        emulator.out_var_ids,
+        spatial_coords,
+        regions=parse_regions(args.regions),
+        field_stats=args.field_stats,
+        device=device,
+    )
+    summary = run_sweep(emulator, sweep, reducer, climate_model=climate_model)
+
+    results = reducer.results(args.percentiles, years=range(first_year, last_year + 1))
+    members = sweep.members()
+    results["base"] = ("member", members["base"])
+    for i, var in enumerate(emulator.in_var_ids):
+        results[f"{var}_factor"] = ("member", members["factors"][:, i])
+    results.attrs.update(
+        {"climate_model": climate_model or "", "ramp": int(args.ramp), "checkpoint": os.path.abspath(args.ckpt)}
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+    results.to_netcdf(args.out)
+    print(f"Wrote {args.out}: {summary['members']} pathways at {summary['members_per_sec']:.1f} pathways/s")
+
+
+def get_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--ckpt", type=str, required=True, help="Checkpoint with the weights of the model.")
+    parser.add_argument("--scenarios", nargs="+", required=True, help="Base Input4MIPs scenarios, e.g. ssp245.")
+    parser.add_argument("--years", type=str, default="2015-2100", help="Years of the base scenarios.")
+    parser.add_argument("--data-dir", type=str, default=None, help="Defaults to datamodule.data_dir.")
+    parser.add_argument("--climate-model", type=str, default=None, help="Defaults to the first training model.")
+    members = parser.add_mutually_exclusive_group(required=True)
+    members.add_argument("--factors", nargs="+", help="Grid of factors per variable, e.g. BC_sum=0.5,1,1.5.")
+    members.add_argument("--random", type=int, help="Number of pathways with uniformly drawn factors.")
+    parser.add_argument("--low", type=float, default=0.0, help="Lowest random factor.")
+    parser.add_argument("--high", type=float, default=2.0, help="Highest random factor.")
+    parser.add_argument("--scaled-vars", nargs="+", default=None, help="Variables with random factors, default all.")
+    parser.add_argument("--ramp", action="store_true", help="Ramp the factors linearly from 1 in the first year.")
+    parser.add_argument("--regions", nargs="*", default=[], help="Regions name=lat_min,lat_max,lon_min,lon_max.")
+    parser.add_argument("--percentiles", nargs="+", type=float, default=[5, 50, 95])
+    parser.add_argument("--field-stats", action="store_true", help="Also write mean and std fields per year.")
+    parser.add_argument("--out", type=str, required=True, help="NetCDF with the reductions.")
+    parser.add_argument("--stats", type=str, default=None, help="Normalization statistics written with --save-stats.")
+    parser.add_argument("--save-stats", type=str, default=None, help="Write the normalization statistics to a .npz.")
+    parser.add_argument("--batch-size", type=int, default=64, help="(pathway, year) samples per forward pass.")
+    parser.add_argument("--precision", type=str, default="32", choices=["32", "bf16"])
+    parser.add_argument("--threads", type=int, default=0, help="torch threads, 0 keeps the default.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the random factors.")
+    parser.add_argument("--cpu", action="store_true", help="Run on CPU even if a GPU is available.")
+    parser.add_argument("overrides", nargs="*", help="Hydra overrides of the training config.")
+    return parser
+
+
+if __name__ == "__main__":
+    main(get_parser().parse_args())